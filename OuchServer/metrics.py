@@ -0,0 +1,48 @@
+import math
+from collections import deque
+
+
+class Timing:
+    '''
+    Running count, mean and maximum of a measurement (a duration in seconds, a queue depth...), with
+    percentiles over the most recent samples.
+    '''
+    def __init__(self, window = 1024):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.recent = deque(maxlen = window)
+
+    def record(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+        self.recent.append(seconds)
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, fraction):
+        '''the fraction (0-1) percentile of the recent samples, 0.0 if there are none'''
+        if not self.recent:
+            return 0.0
+        ordered = sorted(self.recent)
+        return ordered[min(len(ordered), max(1, math.ceil(fraction * len(ordered)))) - 1]
+
+    def stats(self):
+        return {'count': self.count, 'mean': self.mean, 'max': self.max,
+                'p50': self.percentile(0.5), 'p99': self.percentile(0.99)}
+
+
+class Metrics(dict):
+    '''
+    Timings by name, created on first use.
+    '''
+    def __missing__(self, name):
+        timing = self[name] = Timing()
+        return timing
+
+    def stats(self):
+        return {name: timing.stats() for (name, timing) in self.items()}
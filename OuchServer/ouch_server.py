@@ -8,12 +8,14 @@ import asyncio.streams
 import configargparse
 import logging as log
 import itertools
-from collections import namedtuple
+import time
+from collections import namedtuple, deque
 from functools import partial
 import datetime
 import pytz
 
 from .ouch_messages import OuchClientMessages, OuchServerMessages
+from .metrics import Metrics
 
 DEFAULT_TIMEZONE = pytz.timezone('US/Pacific')
 
@@ -24,19 +26,258 @@ options, args = p.parse_known_args()
 
 
 
-class ProtocolMessageServer(object): 
+class ProtocolMessageProtocol(asyncio.BufferedProtocol):
+    """
+    One client connection of a ProtocolMessageServer read through
+    asyncio.BufferedProtocol instead of streams.  The socket reads into a
+    reusable buffer; every complete message in it is framed by its
+    header's payload size, and the messages of each read are handed to
+    the listeners as one batch by the client's task.  Messages are framed
+    in place, and only the complete ones are copied out of the buffer, in
+    one piece, so the views given to listeners stay valid after the buffer
+    is reused.  The protocol is also the client's writer.
+    """
+    max_pending_batches = 64    # reading pauses while this many batches wait for the listeners
+
+    def __init__(self, server, buffer_size=65536):
+        self.server = server
+        self.buffer = bytearray(buffer_size)
+        self.buffer_view = memoryview(self.buffer)
+        self.filled = 0     # bytes of buffer holding data not yet framed
+        self.batches = deque()  # lists of framed messages, then None once the connection is lost
+        self.batch_waiter = None    # future the client's task waits on while batches is empty
+        self.transport = None
+        self.reading_paused = False
+        self.write_resumed = None   # future to wait on while the transport's write buffer is full
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.server._add_client(self._handle_client_requests, None, self)
+
+    def get_buffer(self, sizehint):
+        return self.buffer_view[self.filled:]
+
+    def buffer_updated(self, nbytes):
+        end = self.filled + nbytes
+        (frames, framed) = self.server.frame_offsets(self.buffer_view, end)
+        if frames:
+            data = memoryview(bytes(self.buffer_view[:framed]))
+            self.add_batch([message_type.view(data, offset) for (message_type, offset) in frames])
+            if len(self.batches) >= self.max_pending_batches:
+                self.reading_paused = True
+                self.transport.pause_reading()
+            # move the partial message at the end to the front of the buffer
+            self.buffer[:end - framed] = self.buffer[framed:end]
+        self.filled = end - framed
+
+    def eof_received(self):
+        return False
+
+    def connection_lost(self, exc):
+        if self.filled:
+            log.error('Connection terminated mid-packet!')
+        else:
+            log.info('no more messages; connection terminated')
+        self.add_batch(None)
+        if self.write_resumed is not None and not self.write_resumed.done():
+            self.write_resumed.set_result(None)
+
+    def add_batch(self, batch):
+        self.batches.append(batch)
+        waiter = self.batch_waiter
+        if waiter is not None:
+            self.batch_waiter = None
+            if not waiter.done():
+                waiter.set_result(None)
+
+    async def _handle_client_requests(self, client_token):
+        batches = self.batches
+        while True:
+            if not batches:
+                self.batch_waiter = asyncio.get_event_loop().create_future()
+                await self.batch_waiter
+            batch = batches.popleft()
+            if batch is None:
+                break
+            for client_msg in batch:
+                client_msg.meta = client_token
+            await self.server.broadcast_batch_to_listeners(batch)
+            if self.reading_paused and len(batches) < self.max_pending_batches // 2:
+                self.reading_paused = False
+                self.transport.resume_reading()
+
+    # writer side, as used by ProtocolMessageServer
+
+    def write(self, data):
+        self.transport.write(data)
+
+    def pause_writing(self):
+        self.write_resumed = asyncio.get_event_loop().create_future()
+
+    def resume_writing(self):
+        if self.write_resumed is not None:
+            self.write_resumed.set_result(None)
+            self.write_resumed = None
+
+    async def drain(self):
+        if self.write_resumed is not None:
+            await self.write_resumed
+
+    def writelines(self, chunks):
+        self.transport.writelines(chunks)
+
+    def close(self):
+        self.transport.close()
+
+
+class ClientOutbox(object):
+    """
+    Outbound queue of one client connection, emptied by its own writer
+    task so that whoever queues bytes never waits on the socket.  The
+    task writes everything queued so far with a single writelines and
+    then waits for the writer to drain; whatever is queued meanwhile
+    goes out together in the next write.
+
+    Once the bytes queued or being written reach high_water, policy
+    says what happens to a slow client:
+        'conflate' - market data replaces the queued message of the
+            same kind, so the client gets only the latest of each
+        'drop' - market data is dropped
+        'disconnect' - the connection is closed
+    Replies to the client's own orders are never conflated or dropped:
+    under 'conflate' and 'drop' they are queued until the replies waiting
+    for the next write reach high_water too, and then the client is
+    disconnected, so a reader that has stalled holds at most about twice
+    high_water.
+    """
+    policies = ('conflate', 'drop', 'disconnect')
+
+    def __init__(self, writer, high_water = 1 << 20, policy = 'conflate'):
+        if policy not in self.policies:
+            raise ValueError('unknown slow consumer policy %r' % (policy,))
+        self.writer = writer
+        self.high_water = high_water
+        self.policy = policy
+        self.chunks = []    # bytes queued since the last write
+        self.latest = {}    # kind of market data -> index in chunks of its latest message, for conflation
+        self.buffered = 0   # bytes in chunks and in the write being drained
+        self.queued_replies = 0     # bytes of replies in chunks
+        self.closed = False
+        self.ready = None   # future the writer task waits on while chunks is empty
+        self.metrics = Metrics()    # buffered_bytes at each write
+        self.conflated = 0  # market data messages replaced by a later one
+        self.dropped = 0    # market data messages dropped
+        self.task = asyncio.ensure_future(self._write_queued())
+
+    def put(self, data):
+        """queue a reply to the client"""
+        if self.closed:
+            return
+        if self.buffered >= self.high_water and self.policy == 'disconnect':
+            self.disconnect()
+            return
+        if self.queued_replies >= self.high_water:
+            self.disconnect()
+            return
+        self.queued_replies += len(data)
+        self._append(data)
+
+    def put_market_data(self, data, kind):
+        """queue a broadcast message, which may be conflated with a later one of the same kind"""
+        if self.closed:
+            return
+        if self.buffered >= self.high_water:
+            if self.policy == 'disconnect':
+                self.disconnect()
+                return
+            if self.policy == 'drop':
+                self.dropped += 1
+                return
+            index = self.latest.get(kind)
+            if index is not None:
+                # blank the stale message rather than overwrite it, so the latest keeps its place after replies
+                self.buffered -= len(self.chunks[index])
+                self.chunks[index] = b''
+                self.conflated += 1
+        self.latest[kind] = len(self.chunks)
+        self._append(data)
+
+    def _append(self, data):
+        self.chunks.append(data)
+        self.buffered += len(data)
+        ready = self.ready
+        if ready is not None:
+            self.ready = None
+            if not ready.done():
+                ready.set_result(None)
+
+    async def _write_queued(self):
+        writer = self.writer
+        buffered_bytes = self.metrics['buffered_bytes']
+        try:
+            while True:
+                if not self.chunks:
+                    self.ready = asyncio.get_event_loop().create_future()
+                    await self.ready
+                chunks, self.chunks = self.chunks, []
+                self.latest = {}
+                self.queued_replies = 0
+                writing = self.buffered
+                buffered_bytes.record(writing)
+                writer.writelines(chunks)
+                await writer.drain()
+                self.buffered -= writing
+        except ConnectionError as err:
+            log.info('outbound connection lost: %s', err)
+        finally:
+            self.closed = True
+            self.chunks = []
+
+    def disconnect(self):
+        log.warning('closing slow client connection with %d bytes buffered', self.buffered)
+        self.close()
+        self.writer.close()
+
+    def close(self):
+        self.closed = True
+        self.chunks = []
+        self.latest = {}
+        self.queued_replies = 0
+        if not self.task.done():
+            self.task.cancel()
+
+    def stats(self):
+        return {'buffered': self.buffered, 'conflated': self.conflated, 'dropped': self.dropped,
+                'buffered_bytes': self.metrics['buffered_bytes'].stats()}
+
+
+class ProtocolMessageServer(object):
     """
     
     """
-    ClientInfo = namedtuple('ClientInfo', ['task', 'reader', 'writer'])
+    ClientInfo = namedtuple('ClientInfo', ['task', 'reader', 'writer', 'outbox'])
+    read_size = 65536   # most bytes taken off a client's stream at once
     
-    def __init__(self, ProtocolMessageTypes):
+    def __init__(self, ProtocolMessageTypes, transport='streams',
+            outbound_high_water=1 << 20, slow_consumer_policy='conflate'):
+        """
+        transport - 'streams' to read clients through asyncio streams, or
+            'buffered' to read them through a ProtocolMessageProtocol
+        outbound_high_water, slow_consumer_policy - bytes buffered for a
+            client before it is treated as slow, and what is done then;
+            see ClientOutbox
+        """
         self._ProtocolMessageCls = ProtocolMessageTypes.get_message_class()
         self._ProtocolMessageTypes = ProtocolMessageTypes
         self._tokens = itertools.count(0,2)  # evens
+        self.transport = transport
+        self.outbound_high_water = outbound_high_water
+        self.slow_consumer_policy = slow_consumer_policy
+        self.metrics = Metrics()    # broadcast_fanout: seconds to queue one broadcast message for every client
         self.server = None # encapsulates the server sockets
         self.clients = {}  # token -> ClientInfo
         self.listeners = {}  # token -> callback    
+        self.batch_listeners = {}  # token -> callback taking a list of messages
     @property
     def ProtocolMessageCls(self):
         return self._ProtocolMessageCls
@@ -46,20 +287,31 @@ class ProtocolMessageServer(object):
         
     def _accept_client(self, client_reader, client_writer):
         """
-        This method accepts a new client connection and creates a Task
-        to handle this client.  self.clients is updated to keep track
+        This method accepts a new client connection from streams.
+        """
+        self._add_client(
+            lambda client_token: self._handle_client_requests(client_token, client_reader),
+            client_reader, client_writer)
+
+    def _add_client(self, handle_client_requests, client_reader, client_writer):
+        """
+        Creates a Task to handle a new client, running the coroutine
+        handle_client_requests(client_token) returns, and the ClientOutbox
+        writing to client_writer.  self.clients is updated to keep track
         of the new client.
         """
         
         # start a new Task to handle this specific client connection
         client_token = next(self._tokens)
-        task = asyncio.Task(self._handle_client_requests(client_token, client_reader))
+        task = asyncio.ensure_future(handle_client_requests(client_token))
         
         log.info('client task %s created: %s', str(client_token), task)
-        self.clients[client_token] = self.ClientInfo(task, client_reader, client_writer)
+        outbox = ClientOutbox(client_writer, self.outbound_high_water, self.slow_consumer_policy)
+        self.clients[client_token] = self.ClientInfo(task, client_reader, client_writer, outbox)
 
         def client_done(task):
             log.info('client task %s done: %s', str(client_token), task)
+            outbox.close()
             del self.clients[client_token]
 
         task.add_done_callback(client_done)
@@ -67,44 +319,110 @@ class ProtocolMessageServer(object):
     async def _handle_client_requests(self, client_token, client_reader):
         """
         This method actually does the work to handle the requests for
-        a specific client.  The protocol is line oriented, so there is
-        a main loop that reads a line with a request and then sends
-        out one or more lines back to the client with the result.
+        a specific client.  Whatever the client has sent is read in one
+        go, and the complete messages in it are handed to the listeners
+        as one batch of views over the bytes read, so that nothing is
+        copied out and fields are only decoded when a listener reads
+        them.  A partial message at the end waits for the next read.
         """
-        header_size = self._ProtocolMessageCls.get_header_class().size
+        pending = b''
         while True:
             try:
-                header_bytes = (await client_reader.readexactly(header_size))
-            except asyncio.IncompleteReadError:
-                log.info('no more messages; connection terminated')
+                received = await client_reader.read(self.read_size)
+            except ConnectionError as err:
+                log.info('connection lost: %s', err)
                 break
-            message_type = (self._ProtocolMessageTypes
-                            .lookup_by_header_bytes(header_bytes))
-            payload_size = message_type.payload_size
-            try:
-                payload_bytes = (await client_reader.readexactly(payload_size))
-            except asyncio.IncompleteReadError as err:
-                log.error('Connection terminated mid-packet!')
+            if not received:
+                if pending:
+                    log.error('Connection terminated mid-packet!')
+                else:
+                    log.info('no more messages; connection terminated')
                 break
+            data = pending + received if pending else received
+            (batch, framed) = self.frame_messages(data)
+            pending = data[framed:]
+            if batch:
+                for client_msg in batch:
+                    client_msg.meta = client_token
+                await self.broadcast_batch_to_listeners(batch)
 
-            client_msg = message_type.from_bytes(payload_bytes, header=False)
-            client_msg.meta = client_token
-            await self.broadcast_to_listeners(client_msg)
+    def frame_messages(self, data):
+        """
+        Split the complete messages off the start of data, by the
+        payload size of each one's header: returns views over data of
+        them and the number of bytes they take up.
+        """
+        (frames, framed) = self.frame_offsets(data, len(data))
+        buffer = memoryview(data)
+        return [message_type.view(buffer, offset) for (message_type, offset) in frames], framed
+
+    def frame_offsets(self, data, end):
+        """
+        Find the complete messages in the first end bytes of data, any
+        bytes-like object, without copying it: returns the message type
+        and offset of each and the number of bytes they take up.
+        """
+        header_size = self._ProtocolMessageCls.get_header_class().size
+        lookup_by_header_bytes = self._ProtocolMessageTypes.lookup_by_header_bytes
+        offset = 0
+        frames = []
+        while end - offset >= header_size:
+            message_type = lookup_by_header_bytes(bytes(data[offset:offset + header_size]))
+            message_end = offset + header_size + message_type.payload_size
+            if message_end > end:
+                break
+            frames.append((message_type, offset))
+            offset = message_end
+        return frames, offset
             
     async def send_server_response(self, server_msg):
+        """
+        Queue server_msg for the client its meta names; the client's
+        outbox writes it, so this never waits on the client's socket.
+        """
         client_token = server_msg.meta
         try:
-            client_writer = self.clients[client_token].writer
+            client_outbox = self.clients[client_token].outbox
         except KeyError:
             return
-        client_writer.write(bytes(server_msg))
-        await client_writer.drain()
+        client_outbox.put(bytes(server_msg))
+
+    async def send_server_responses(self, server_msgs):
+        """
+        Queue server_msgs for the clients their metas name, joined into
+        one buffer per client, in order.
+        """
+        by_client = {}
+        for server_msg in server_msgs:
+            by_client.setdefault(server_msg.meta, []).append(bytes(server_msg))
+        for (client_token, encoded) in by_client.items():
+            try:
+                client_outbox = self.clients[client_token].outbox
+            except KeyError:
+                continue
+            client_outbox.put(encoded[0] if len(encoded) == 1 else b''.join(encoded))
 
     async def broadcast_server_message(self, server_msg):
+        await self.broadcast_server_messages([server_msg])
+
+    async def broadcast_server_messages(self, server_msgs):
+        """
+        Queue server_msgs for every client.  Each message is encoded
+        once and the same bytes are queued for all clients, which get
+        the whole list in one write of their outbox.
+        """
+        started = time.perf_counter()
+        encoded = [(bytes(server_msg), server_msg.message_type) for server_msg in server_msgs]
         for client in self.clients.values():
-            client.writer.write(bytes(server_msg))
-        for client in self.clients.values():
-            await client.writer.drain()
+            put_market_data = client.outbox.put_market_data
+            for (data, kind) in encoded:
+                put_market_data(data, kind)
+        if encoded:
+            self.metrics['broadcast_fanout'].record((time.perf_counter() - started) / len(encoded))
+
+    def outbound_stats(self):
+        """client token -> bytes buffered and slow consumer counts of its outbox"""
+        return {client_token: client.outbox.stats() for (client_token, client) in self.clients.items()}
     
     def register_listener(self, callback):
         listener_token = next(self._tokens)
@@ -112,13 +430,35 @@ class ProtocolMessageServer(object):
         log.info('added listener %s', str(listener_token))
         return listener_token
     
+    def register_batch_listener(self, callback):
+        """
+        callback is awaited with the list of messages of each read of a
+        client, in order, instead of with one message at a time
+        """
+        listener_token = next(self._tokens)
+        self.batch_listeners[listener_token] = callback
+        log.info('added batch listener %s', str(listener_token))
+        return listener_token
+
     def deregister_listener(self, listener_token):
-        del self.listeners[listener_token]
+        if listener_token in self.batch_listeners:
+            del self.batch_listeners[listener_token]
+        else:
+            del self.listeners[listener_token]
         log.info('removed listener %s', str(listener_token))
     
     async def broadcast_to_listeners(self, client_msg):
         for callback in self.listeners.values():
             await callback(client_msg)
+        for callback in self.batch_listeners.values():
+            await callback([client_msg])
+
+    async def broadcast_batch_to_listeners(self, client_msgs):
+        for callback in self.listeners.values():
+            for client_msg in client_msgs:
+                await callback(client_msg)
+        for callback in self.batch_listeners.values():
+            await callback(client_msgs)
         
     def start(self, loop):
         """
@@ -127,11 +467,14 @@ class ProtocolMessageServer(object):
         called.  This method runs the loop until the server sockets
         are ready to accept connections.
         """
-        self.server = loop.run_until_complete(
-            asyncio.streams.start_server(self._accept_client,
-                                         options.host, 
-                                         options.port,
-                                         loop=loop))
+        if self.transport == 'buffered':
+            serving = loop.create_server(lambda: ProtocolMessageProtocol(self),
+                                         options.host, options.port)
+        else:
+            serving = asyncio.streams.start_server(self._accept_client,
+                                                   options.host, 
+                                                   options.port)
+        self.server = loop.run_until_complete(serving)
 
     def stop(self, loop):
         """
@@ -36,6 +36,36 @@ class ProtocolField(object):
 class ProtocolFieldEnum(ProtocolField, DuplicateFreeEnum):
     pass
 
+_INIT_SOURCE = """
+def __init__(self, *args, {keywords}, **unknown):
+    if args:
+        if unknown or {any_keyword}:
+            raise ValueError('NamedFieldSequence can only take one of positional or keyword arguments')
+        if len(args) != {count}:
+            raise ValueError('%s has %d slots, got %d values'
+                             % (self.__class__, {count}, len(args)))
+        ({targets}) = args
+    else:
+        ({targets}) = ({values})
+"""
+
+_BYTES_SOURCE = """
+def __bytes__(self):
+    try:
+        return pack({values})
+    except struct.error:
+        for slot in self.__slots__:
+            assert getattr(self, slot) is not None, 'slot %s has value None' % (slot)
+        raise
+"""
+
+_FROM_BYTES_SOURCE = """
+def from_bytes(cls, source_bytes):
+    self = new(cls)
+    ({targets}) = unpack(source_bytes)
+    return self
+"""
+
 class NamedFieldSequenceSerializerMeta(type):
     def __init__(cls, name, bases, namespace):
         cls._struct_formatter = struct.Struct(
@@ -43,6 +73,39 @@ class NamedFieldSequenceSerializerMeta(type):
             ''.join(cls._protocol_fields[field].type_spec
                     for field in cls.__slots__))
         super().__init__(name, bases, namespace)
+        cls._field_structs = {}     # field -> (offset, Struct.unpack_from), for reading single fields in place
+        offset = 0
+        for slot in cls.__slots__:
+            field = struct.Struct(cls._wire_format + cls._protocol_fields[slot].type_spec)
+            cls._field_structs[slot] = (offset, field.unpack_from)
+            offset += field.size
+        cls._compile_methods(namespace)
+
+    def _compile_methods(cls, namespace):
+        '''
+        Generate __init__, __bytes__ and from_bytes for the fields of this class, so that building, encoding
+        and decoding a message reads and writes its slots directly instead of looping over __slots__.
+        Methods the class defines itself are kept.
+        '''
+        slots = cls.__slots__
+        if not slots or cls._protocol_fields is None:
+            return
+        targets = ''.join('self.{}, '.format(slot) for slot in slots)
+        source = [_BYTES_SOURCE.format(values=targets)]
+        if '__init__' not in namespace:
+            source.append(_INIT_SOURCE.format(count=len(slots), targets=targets,
+                keywords=', '.join('{}=None'.format(slot) for slot in slots),
+                any_keyword=' or '.join('{} is not None'.format(slot) for slot in slots),
+                values=''.join('{}, '.format(slot) for slot in slots)))
+            source.append(_FROM_BYTES_SOURCE.format(targets=targets))
+        compiled = {'struct': struct, 'new': object.__new__,
+                    'pack': cls._struct_formatter.pack, 'unpack': cls._struct_formatter.unpack}
+        exec(''.join(source), compiled)
+        if '__bytes__' not in namespace:
+            cls.__bytes__ = compiled['__bytes__']
+        if '__init__' not in namespace:
+            cls.__init__ = compiled['__init__']
+            cls.from_bytes = classmethod(compiled['from_bytes'])
 
     @property
     def size(cls):
@@ -130,7 +193,8 @@ class ProtocolMessage(object):
 
     @classmethod
     def from_payload_bytes(cls, message_type_spec, payload_bytes):
-        message = cls(message_type_spec)
+        message = cls.__new__(cls)
+        message._message_type_spec = message_type_spec
         message.payload = message_type_spec.PayloadCls.from_bytes(payload_bytes)
         return message
     @classmethod
@@ -146,9 +210,17 @@ class ProtocolMessage(object):
     @property
     def message_type(self):
         return self._message_type_spec
+    @property
+    def raw(self):
+        '''the message's bytes, header included, as any bytes-like object'''
+        return bytes(self)
 
     def __bytes__(self):
-        return bytes(self._message_type_spec.header) + bytes(self.payload)
+        return self._message_type_spec.header_bytes + bytes(self.payload)
+
+    def detach(self):
+        '''make the message independent of any buffer it was read from, for keeping it; returns it'''
+        return self
 
     def __len__(self):
         return len(self.payload)
@@ -176,6 +248,79 @@ class ProtocolMessage(object):
     def __str__(self):
         return '{self.header!s}: {self.payload!s}'.format(self=self)
 
+class ProtocolMessageView(ProtocolMessage):
+    '''
+    A received message read in place: wraps the buffer the message arrived in, e.g. a memoryview of the
+    bytes read off the socket, and unpacks each field from it with struct.unpack_from the first time it is
+    read. MessageTypeSpec.view makes one; it can stand in for the ProtocolMessage from_bytes would give.
+    A view keeps its buffer alive for as long as it is kept itself: detach it to keep it for longer.
+    '''
+    __slots__ = ('_buffer', '_start', '_fields')
+    # set per message type by MessageTypeSpec
+    _message_type_spec = None
+    _field_structs = None
+    _header_size = 0
+    _payload_size = 0
+
+    def __init__(self, buffer, offset=0):
+        '''
+        buffer - bytes-like object holding the message, header included, at offset
+        '''
+        self._buffer = buffer
+        self._start = offset + self._header_size
+        self._fields = {}
+
+    @property
+    def payload(self):
+        start = self._start
+        return self._message_type_spec.PayloadCls.from_bytes(
+            self._buffer[start:start + self._payload_size])
+
+    @property
+    def raw(self):
+        # a slice of the buffer, without copying if it is a memoryview
+        start = self._start
+        return self._buffer[start - self._header_size:start + self._payload_size]
+
+    def __bytes__(self):
+        start = self._start
+        return bytes(self._buffer[start - self._header_size:start + self._payload_size])
+
+    def detach(self):
+        # copy the message's own bytes out of the buffer, which is released, unless they are all it holds
+        if type(self._buffer) is not bytes or len(self._buffer) != self._header_size + self._payload_size:
+            self._buffer = bytes(self)
+            self._start = self._header_size
+        return self
+
+    def __len__(self):
+        return len(self._field_structs)
+    def __iter__(self):
+        yield from iter(self._field_structs)
+    def iteritems(self):
+        yield from ((key, self[key]) for key in self._field_structs)
+
+    def __getitem__(self, key):
+        value = self._fields.get(key)    # no field unpacks to None
+        if value is None:
+            try:
+                (offset, unpack_from) = self._field_structs[key]
+            except KeyError:
+                raise KeyError('key %s not found' % (key)) from None
+            value = self._fields[key] = unpack_from(self._buffer, self._start + offset)[0]
+        return value
+
+    def __setitem__(self, key, value):
+        # rarely done to a received message: re-encode it into a buffer of its own
+        payload = self.payload
+        payload[key] = value
+        self._buffer = self._message_type_spec.header_bytes + bytes(payload)
+        self._start = self._header_size
+        self._fields.clear()
+
+    def __contains__(self, key):
+        return key in self._field_structs
+
 class MessageTypeSpec(object):
     _MessageCls = None
 
@@ -186,22 +331,38 @@ class MessageTypeSpec(object):
         HeaderCls = cls._MessageCls.get_header_class()
         PayloadBaseCls = cls._MessageCls.get_payload_base_class()
         self._header = HeaderCls(**header_field_values)
+        self._header_bytes = bytes(self._header)    # message type headers never change: encode them once
         self._PayloadCls = type(
             name, (PayloadBaseCls,),
             {'__slots__': payload_fields})
+        self._ViewCls = type(
+            name + 'View', (ProtocolMessageView, cls._MessageCls),
+            {'__slots__': (), '_message_type_spec': self,
+             '_field_structs': self._PayloadCls._field_structs,
+             '_header_size': len(self._header_bytes), '_payload_size': self._PayloadCls.size})
 
     def __call__(self, *args, **kwargs):
-        return self._MessageCls(self, *args, **kwargs)
+        message = self._MessageCls.__new__(self._MessageCls)
+        message._message_type_spec = self
+        message.payload = self._PayloadCls(*args, **kwargs)
+        return message
 
     def from_bytes(self, message_bytes, header=True):
         if header:
-            header_len = self._MessageCls._HeaderCls.size
+            header_len = len(self._header_bytes)
             header_bytes = message_bytes[:header_len]
             message_bytes = message_bytes[header_len:]
-            if header_bytes != self.header_bytes:
+            if header_bytes != self._header_bytes:
                 raise ValueError('header mismatch!')
         return self._MessageCls.from_payload_bytes(self, message_bytes)
 
+    def view(self, buffer, offset=0):
+        '''
+        the message of this type at offset in buffer, header included, as a ProtocolMessageView that
+        unpacks its fields from buffer as they are read
+        '''
+        return self._ViewCls(buffer, offset)
+
     @classmethod
     def get_message_class(self):
         return self._MessageCls
@@ -210,7 +371,7 @@ class MessageTypeSpec(object):
         return self._header
     @property
     def header_bytes(self):
-        return bytes(self._header)
+        return self._header_bytes
     @property
     def PayloadCls(self):
         return self._PayloadCls
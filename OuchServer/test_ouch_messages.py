@@ -0,0 +1,123 @@
+import struct
+import unittest
+from OuchServer.ouch_messages import OuchClientMessages, OuchServerMessages
+from OuchServer.protocol_message_primitives import NamedFieldSequence
+
+
+def sample_value(type_spec, seed):
+    '''a value of the given struct type, different for each seed'''
+    code = type_spec[-1]
+    if code == 's':
+        return '{:0{}d}'.format(seed, int(type_spec[:-1]))[-int(type_spec[:-1]):].encode('ascii')
+    if code == 'c':
+        return b'BS'[seed % 2:seed % 2 + 1]
+    if code == '?':
+        return seed % 2 == 1
+    return 7 * seed + 1
+
+def sample_fields(spec, seed = 3):
+    payload_cls = spec.PayloadCls
+    return dict((slot, sample_value(payload_cls._protocol_fields[slot].type_spec, seed + i))
+                for (i, slot) in enumerate(payload_cls.__slots__))
+
+def baseline_bytes(spec, fields):
+    '''the message encoded as NamedFieldSequence does it, field by field, without the generated methods'''
+    payload = spec.PayloadCls.__new__(spec.PayloadCls)
+    NamedFieldSequence.__init__(payload, **fields)
+    return spec.header_bytes + NamedFieldSequence.__bytes__(payload)
+
+MESSAGE_TYPES = list(OuchClientMessages) + list(OuchServerMessages)
+
+class TestGeneratedCodecs(unittest.TestCase):
+
+    def test_encoding_matches_baseline(self):
+        for spec in MESSAGE_TYPES:
+            fields = sample_fields(spec)
+            message = spec(**fields)
+            self.assertEqual(bytes(message), baseline_bytes(spec, fields), spec)
+            self.assertEqual(len(bytes(message)), len(spec.header_bytes) + spec.payload_size, spec)
+            positional = spec(*(fields[slot] for slot in spec.PayloadCls.__slots__))
+            self.assertEqual(bytes(positional), bytes(message), spec)
+
+    def test_decoding_round_trips(self):
+        for spec in MESSAGE_TYPES:
+            fields = sample_fields(spec, seed = 11)
+            data = baseline_bytes(spec, fields)
+            message = spec.from_bytes(data)
+            self.assertEqual(dict(message.iteritems()), fields, spec)
+            self.assertIs(message.message_type, spec)
+            self.assertEqual(bytes(message), data, spec)
+            self.assertEqual(message.to_bytes(), data[len(spec.header_bytes):], spec)
+
+    def test_missing_field_is_reported(self):
+        fields = sample_fields(OuchClientMessages.CancelOrder)
+        del fields['shares']
+        with self.assertRaisesRegex(AssertionError, 'slot shares has value None'):
+            bytes(OuchClientMessages.CancelOrder(**fields))
+
+    def test_argument_errors(self):
+        with self.assertRaises(ValueError):
+            OuchClientMessages.CancelOrder(b'00000000000001', shares = 1)
+        with self.assertRaises(ValueError):
+            OuchClientMessages.CancelOrder(b'00000000000001')
+
+    def test_header_mismatch(self):
+        data = bytes(OuchClientMessages.CancelOrder(**sample_fields(OuchClientMessages.CancelOrder)))
+        with self.assertRaises(ValueError):
+            OuchClientMessages.EnterOrder.from_bytes(data)
+
+class TestMessageViews(unittest.TestCase):
+
+    def read_buffer(self):
+        """messages of every type back to back, after some stray bytes, as a memoryview like a socket read"""
+        messages = [spec(**sample_fields(spec, seed = i)) for (i, spec) in enumerate(MESSAGE_TYPES)]
+        buffer = bytearray(b'junk')
+        offsets = []
+        for message in messages:
+            offsets.append(len(buffer))
+            buffer += bytes(message)
+        return messages, memoryview(bytes(buffer)), offsets
+
+    def test_view_reads_like_decoded_message(self):
+        (messages, buffer, offsets) = self.read_buffer()
+        for (message, offset) in zip(messages, offsets):
+            spec = message.message_type
+            view = spec.view(buffer, offset)
+            self.assertIsInstance(view, spec.get_message_class())
+            self.assertIs(view.message_type, spec)
+            self.assertEqual(bytes(view), bytes(message), spec)
+            self.assertEqual(bytes(view.raw), bytes(message), spec)
+            self.assertEqual(list(view), list(message), spec)
+            self.assertEqual(dict(view.iteritems()), dict(message.iteritems()), spec)
+            self.assertEqual(str(view), str(message), spec)
+            self.assertEqual(len(view), len(message), spec)
+            with self.assertRaises(KeyError):
+                view['no_such_field']
+
+    def test_setting_a_field_reencodes(self):
+        (messages, buffer, offsets) = self.read_buffer()
+        view = OuchClientMessages.EnterOrder.view(buffer, offsets[0])
+        view['shares']      # cached before the change
+        view['shares'] = 123
+        self.assertEqual(view['shares'], 123)
+        messages[0]['shares'] = 123
+        self.assertEqual(bytes(view), bytes(messages[0]))
+        self.assertEqual(bytes(buffer[offsets[0]:offsets[1]]), bytes(OuchClientMessages.EnterOrder(
+            **sample_fields(OuchClientMessages.EnterOrder, seed = 0))))
+
+    def test_detach_releases_the_buffer(self):
+        (messages, buffer, offsets) = self.read_buffer()
+        view = OuchClientMessages.CancelOrder.view(buffer, offsets[2])
+        view.meta = 5
+        shares = view['shares']
+        self.assertIs(view.detach(), view)
+        self.assertEqual(type(view.raw), bytes)
+        self.assertEqual(bytes(view), bytes(messages[2]))
+        self.assertEqual((view['shares'], view['order_token'], view.meta),
+                         (shares, messages[2]['order_token'], 5))
+        buffer.release()
+        self.assertEqual(bytes(view), bytes(messages[2]))
+        self.assertIs(messages[2].detach(), messages[2])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,193 @@
+import asyncio
+import unittest
+from random import Random
+from OuchServer.ouch_messages import OuchClientMessages
+from OuchServer.ouch_server import ProtocolMessageServer, ProtocolMessageProtocol, ClientOutbox
+from OuchServer.test_ouch_messages import sample_fields
+
+
+def client_stream(count, rng):
+    '''count random client messages, as the bytes a client sends'''
+    specs = [OuchClientMessages.EnterOrder, OuchClientMessages.CancelOrder, OuchClientMessages.ReplaceOrder]
+    return [bytes(spec(**sample_fields(spec, seed = i))) for (i, spec) in
+            enumerate(rng.choice(specs) for _ in range(count))]
+
+class PausableTransport:
+    def __init__(self):
+        self.reading = True
+
+    def pause_reading(self):
+        self.reading = False
+
+    def resume_reading(self):
+        self.reading = True
+
+def make_protocol(**kwargs):
+    protocol = ProtocolMessageProtocol(ProtocolMessageServer(OuchClientMessages), **kwargs)
+    protocol.transport = PausableTransport()
+    return protocol
+
+class TestBufferedFraming(unittest.TestCase):
+
+    def receive(self, protocol, data):
+        '''what the event loop does with data read off the socket'''
+        buffer = protocol.get_buffer(len(data))
+        buffer[:len(data)] = data
+        protocol.buffer_updated(len(data))
+
+    def test_reads_split_anywhere(self):
+        rng = Random(5)
+        for buffer_size in (100, 65536):
+            messages = client_stream(200, rng)
+            stream = b''.join(messages)
+            protocol = make_protocol(buffer_size = buffer_size)
+            offset = 0
+            while offset < len(stream):
+                size = min(rng.randrange(1, 100), len(stream) - offset, buffer_size - protocol.filled)
+                self.receive(protocol, stream[offset:offset + size])
+                offset += size
+            # the views still read what was sent, though the buffer has been reused since
+            received = [bytes(view) for batch in protocol.batches for view in batch]
+            self.assertEqual(received, messages)
+            self.assertEqual(protocol.filled, 0)
+            for batch in protocol.batches:
+                self.assertIsNot(batch[0].raw.obj, protocol.buffer)
+
+    def test_partial_message_waits_for_the_rest(self):
+        (first, second) = client_stream(2, Random(1))
+        protocol = make_protocol()
+        self.receive(protocol, first + second[:3])
+        self.assertEqual([[bytes(view) for view in batch] for batch in protocol.batches], [[first]])
+        self.assertEqual((protocol.filled, bytes(protocol.buffer[:3])), (3, second[:3]))
+        self.receive(protocol, second[3:])
+        self.assertEqual([bytes(view) for view in protocol.batches[1]], [second])
+        self.assertEqual(protocol.filled, 0)
+
+class BlockingWriter:
+    """a client writer whose drain waits until the test lets it, or fails if the connection is lost"""
+    def __init__(self):
+        self.writes = []
+        self.closed = False
+        self.drained = None
+
+    def writelines(self, chunks):
+        self.writes.append(b''.join(chunks))
+
+    async def drain(self):
+        self.drained = asyncio.get_event_loop().create_future()
+        await self.drained
+
+    def close(self):
+        self.closed = True
+
+class TestClientOutbox(unittest.TestCase):
+
+    def run_outbox(self, policy, steps):
+        """
+        run steps(outbox, writer, settle) on an outbox of policy with a high water of 10 bytes, the writer
+        held in its first drain; settle lets the writer task run
+        """
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        writer = BlockingWriter()
+        async def settle():
+            for _ in range(3):
+                await asyncio.sleep(0)
+        async def run():
+            outbox = ClientOutbox(writer, high_water = 10, policy = policy)
+            await steps(outbox, writer, settle)
+            outbox.close()
+            await asyncio.gather(outbox.task, return_exceptions = True)
+            return outbox
+        return loop.run_until_complete(run()), writer
+
+    def release(self, writer):
+        writer.drained.set_result(None)
+
+    def test_queued_bytes_go_out_in_one_write(self):
+        async def steps(outbox, writer, settle):
+            outbox.put(b'first')
+            await settle()
+            for data in (b'a', b'b', b'c'):
+                outbox.put(data)
+            outbox.put_market_data(b'quote', 'bbo')
+            self.assertEqual(outbox.buffered, 13)
+            self.release(writer)
+            await settle()
+            self.assertEqual(outbox.buffered, 8)
+        (outbox, writer) = self.run_outbox('conflate', steps)
+        self.assertEqual(writer.writes, [b'first', b'abcquote'])
+
+    def test_conflate_keeps_the_latest_market_data(self):
+        async def steps(outbox, writer, settle):
+            outbox.put(b'0123456789')     # reaches high water, held in the drain
+            await settle()
+            outbox.put_market_data(b'bbo1', 'bbo')
+            outbox.put_market_data(b'trade1', 'trade')
+            outbox.put(b'reply')
+            outbox.put_market_data(b'bbo2', 'bbo')
+            self.release(writer)
+            await settle()
+        (outbox, writer) = self.run_outbox('conflate', steps)
+        self.assertEqual(writer.writes, [b'0123456789', b'trade1replybbo2'])
+        self.assertEqual((outbox.conflated, outbox.dropped), (1, 0))
+
+    def test_drop_keeps_replies(self):
+        async def steps(outbox, writer, settle):
+            outbox.put(b'0123456789')
+            await settle()
+            outbox.put_market_data(b'bbo1', 'bbo')
+            outbox.put(b'reply')
+            self.release(writer)
+            await settle()
+            outbox.put_market_data(b'bbo2', 'bbo')   # below high water again
+            self.release(writer)
+            await settle()
+        (outbox, writer) = self.run_outbox('drop', steps)
+        self.assertEqual(writer.writes, [b'0123456789', b'reply', b'bbo2'])
+        self.assertEqual((outbox.conflated, outbox.dropped), (0, 1))
+
+    def test_stalled_reader_disconnected_once_its_replies_reach_high_water(self):
+        for policy in ('conflate', 'drop'):
+            async def steps(outbox, writer, settle):
+                outbox.put(b'0123456789')
+                await settle()
+                for _ in range(3):
+                    outbox.put(b'four')
+                self.assertFalse(outbox.closed)
+                with self.assertLogs(level = 'WARNING'):
+                    outbox.put(b'four')
+                self.assertTrue(outbox.closed)
+            (outbox, writer) = self.run_outbox(policy, steps)
+            self.assertTrue(writer.closed)
+            self.assertEqual(writer.writes, [b'0123456789'])
+
+    def test_disconnect_closes_the_slow_client(self):
+        async def steps(outbox, writer, settle):
+            outbox.put(b'0123456789')
+            await settle()
+            with self.assertLogs(level = 'WARNING'):
+                outbox.put(b'reply')
+            self.assertTrue(outbox.closed)
+            outbox.put_market_data(b'bbo', 'bbo')
+        (outbox, writer) = self.run_outbox('disconnect', steps)
+        self.assertTrue(writer.closed)
+        self.assertEqual(writer.writes, [b'0123456789'])
+
+    def test_lost_connection_closes_the_outbox(self):
+        async def steps(outbox, writer, settle):
+            outbox.put(b'data')
+            await settle()
+            writer.drained.set_exception(ConnectionResetError())
+            await settle()
+            self.assertTrue(outbox.closed)
+            outbox.put(b'more')
+        (outbox, writer) = self.run_outbox('conflate', steps)
+        self.assertEqual(writer.writes, [b'data'])
+
+    def test_unknown_policy(self):
+        with self.assertRaises(ValueError):
+            ClientOutbox(BlockingWriter(), policy = 'block')
+
+if __name__ == '__main__':
+    unittest.main()
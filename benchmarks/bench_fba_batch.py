@@ -0,0 +1,54 @@
+"""
+FBA batch benchmark: batch_process latency as the book deepens.
+
+For each depth, rests that many bid and ask price levels without crossing,
+runs one untimed batch, then repeatedly enters a handful of orders near the
+touch and runs a batch, timing batch_process alone. --engine numpy clears the
+batches with the NumpyBatchEngine instead.
+"""
+
+import timeit
+from random import Random
+import configargparse
+
+from exchange.order_books.fba_book import FBABook
+
+p = configargparse.ArgParser()
+p.add('--depths', default='10,100,1000,10000,30000', help="Comma separated numbers of resting levels per side")
+p.add('--batches', default=200, type=int, help="Batches timed per depth")
+p.add('--orders', default=10, type=int, help="Orders entered before each batch")
+p.add('--engine', default='python', choices=['python', 'numpy'], help="Batch clearing engine")
+options, args = p.parse_known_args()
+
+def build(depth):
+    if options.engine == 'numpy':
+        from exchange.order_books.numpy_batch_engine import NumpyBatchEngine
+        book = FBABook(batch_engine = NumpyBatchEngine())
+    else:
+        book = FBABook()
+    for level in range(depth):
+        book.enter_buy(2 * level, 100000 - level, 1, True)
+        book.enter_sell(2 * level + 1, 100001 + level, 1, True)
+    book.batch_process()
+    return book
+
+def time_batches(depth):
+    rng = Random(depth)
+    book = build(depth)
+    order_id = 2 * depth
+    elapsed = 0
+    for _ in range(options.batches):
+        for _ in range(options.orders):
+            enter = book.enter_buy if rng.random() < 0.5 else book.enter_sell
+            enter(order_id, rng.randrange(99990, 100011), rng.randrange(1, 5), True)
+            order_id += 1
+        elapsed += timeit.timeit(book.batch_process, number=1)
+    return elapsed / options.batches * 1e6
+
+def main():
+    print('{:>8} {:>14}'.format('levels', 'us/batch'))
+    for depth in [int(d) for d in options.depths.split(',')]:
+        print('{:>8} {:>14.1f}'.format(depth, time_batches(depth)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,37 @@
+"""
+FBA shuffle benchmark: cost of randomizing time priority within a batch.
+
+Enters `orders` bids at one price level within a single batch, then closes
+the batch, comparing placing each order at random as it arrives against
+queueing arrivals and shuffling the level once at the close (shuffle_seed).
+"""
+
+import timeit
+import configargparse
+
+from exchange.order_books.fba_book import FBABook
+
+p = configargparse.ArgParser()
+p.add('--orders', default='10,100,1000,10000', help="Comma separated numbers of orders per batch")
+p.add('--repeat', default=5, type=int)
+options, args = p.parse_known_args()
+
+def one_batch(shuffle_seed, orders):
+    book = FBABook(shuffle_seed = shuffle_seed)
+    for order_id in range(orders):
+        book.enter_buy(order_id, 100, 1, True)
+    book.shuffle_batches()
+
+def time_batch(shuffle_seed, orders):
+    best = min(timeit.repeat(lambda: one_batch(shuffle_seed, orders), number=1, repeat=options.repeat))
+    return best / orders * 1e6
+
+def main():
+    print('{:>8} {:>14} {:>14}'.format('orders', 'on arrival', 'at close'))
+    for orders in [int(n) for n in options.orders.split(',')]:
+        on_arrival = time_batch(None, orders)
+        at_close = time_batch(1, orders)
+        print('{:>8} {:>11.2f} us {:>11.2f} us ({:.1f}x)'.format(orders, on_arrival, at_close, on_arrival / at_close))
+
+if __name__ == '__main__':
+    main()
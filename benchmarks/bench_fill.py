@@ -0,0 +1,51 @@
+"""
+Fill benchmark: cost per fill on the CDABook.enter_buy sweep path.
+
+Rests `orders` one-share asks on each of `levels` price levels, then sweeps
+them with aggressive buys of `sweep` shares each and reports the time per
+resting order filled. The book is rebuilt between repeats and the rebuild is
+not timed.
+"""
+
+import time
+import configargparse
+
+from exchange.order_books.cda_book import CDABook
+
+p = configargparse.ArgParser()
+p.add('--levels', default=50, type=int)
+p.add('--orders', default=200, type=int, help="Resting orders per level")
+p.add('--sweep', default=25, type=int, help="Shares per aggressive buy")
+p.add('--repeat', default=5, type=int)
+options, args = p.parse_known_args()
+
+def build():
+    book = CDABook()
+    order_id = 0
+    for price in range(100, 100 + options.levels):
+        for _ in range(options.orders):
+            book.enter_sell(order_id, price, 1, True)
+            order_id += 1
+    return book, order_id
+
+def sweep(book, order_id):
+    fills = 0
+    while len(book.asks):
+        (crosses, entered, bbo) = book.enter_buy(order_id, 100 + options.levels, options.sweep, False)
+        fills += len(crosses)
+        order_id += 1
+    return fills
+
+def main():
+    best = None
+    for _ in range(options.repeat):
+        book, next_id = build()
+        start = time.perf_counter()
+        fills = sweep(book, next_id)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    print('{} fills, best of {}: {:.3f} s, {:.0f} ns/fill'.format(
+        fills, options.repeat, best, best / fills * 1e9))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,44 @@
+"""
+Level cache benchmark: flickering quotes on a CDABook with and without the
+LevelCache.
+
+Each step rests a one-share ask at one of `prices` price levels and takes it
+out again with a crossing buy, so the level is created and emptied every time.
+Reports the time per step and the ask side's cache counters.
+"""
+
+import timeit
+from random import Random
+import configargparse
+
+from exchange.order_books.cda_book import CDABook
+
+p = configargparse.ArgParser()
+p.add('--prices', default=8, type=int, help="Number of flickering price levels")
+p.add('--steps', default=20000, type=int)
+p.add('--repeat', default=5, type=int)
+options, args = p.parse_known_args()
+
+def flicker(book, prices):
+    for order_id, price in enumerate(prices):
+        book.enter_sell(2 * order_id, price, 1, True)
+        book.enter_buy(2 * order_id + 1, price, 1, True)
+
+def time_book(level_cache_size, prices):
+    book = CDABook(level_cache_size = level_cache_size)
+    best = min(timeit.repeat(lambda: flicker(book, prices), number=1, repeat=options.repeat))
+    return best / len(prices) * 1e6, book.level_cache_stats()
+
+def main():
+    rng = Random(1)
+    prices = [100 + rng.randrange(options.prices) for _ in range(options.steps)]
+    uncached, _ = time_book(0, prices)
+    cached, stats = time_book(128, prices)
+    print('no cache: {:.2f} us/step'.format(uncached))
+    print('cache:    {:.2f} us/step ({:.1f}x)'.format(cached, uncached / cached))
+    asks = stats['asks']
+    print('asks: hit rate {:.3f}, {} parked, {} bytes held, {} evictions'.format(
+        asks['hit_rate'], asks['parked'], asks['bytes_held'], asks['evictions']))
+
+if __name__ == '__main__':
+    main()
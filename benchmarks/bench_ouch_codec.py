@@ -0,0 +1,57 @@
+"""
+OUCH codec benchmark: encode and decode throughput per message type.
+
+Builds one message of every OUCH client and server message type, with a value
+of the right type in each field, then times constructing it from keyword
+arguments, encoding it with bytes() and decoding it back with the type's
+from_bytes, and reports ns per operation for each.
+"""
+
+import time
+import configargparse
+
+from OuchServer.ouch_messages import OuchFields, OuchClientMessages, OuchServerMessages
+
+p = configargparse.ArgParser()
+p.add('--count', default=20000, type=int, help="Operations timed per message type and repeat")
+p.add('--repeat', default=5, type=int)
+p.add('--types', default=None, help="Comma separated message type names, default all")
+options, args = p.parse_known_args()
+
+def field_value(type_spec):
+    if type_spec.endswith('s'):
+        return b'x' * int(type_spec[:-1])
+    if type_spec == 'c':
+        return b'x'
+    if type_spec == '?':
+        return True
+    return 1
+
+def best_time(func, arg):
+    best = None
+    for _ in range(options.repeat):
+        start = time.perf_counter()
+        for _ in range(options.count):
+            func(arg)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best / options.count * 1e9
+
+def main():
+    wanted = options.types.split(',') if options.types else None
+    print('{:<28}{:>12}{:>12}{:>12}'.format('message type', 'construct', 'encode', 'decode'))
+    for messages in (OuchClientMessages, OuchServerMessages):
+        print(messages.__name__)
+        for spec in messages:
+            if wanted is not None and spec.name not in wanted:
+                continue
+            fields = {slot: field_value(OuchFields[slot].type_spec) for slot in spec.PayloadCls.__slots__}
+            message = spec(**fields)
+            message_bytes = bytes(message)
+            construct = best_time(lambda fields: spec(**fields), fields)
+            encode = best_time(bytes, message)
+            decode = best_time(spec.from_bytes, message_bytes)
+            print('  {:<26}{:>9.0f} ns{:>9.0f} ns{:>9.0f} ns'.format(spec.name, construct, encode, decode))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+"""
+Transport benchmark: streams against BufferedProtocol client intake.
+
+Serves a CDA Exchange from a ProtocolMessageServer on the given transport and
+has `clients` connections each send `orders` rounds of the exchange_client
+load (enter, replace twice, cancel), yielding between rounds as that client
+does, while reading the replies. Reports the time until the exchange has handled every
+message, and messages per second.
+"""
+
+import asyncio
+import time
+import configargparse
+
+from OuchServer import ouch_server
+from OuchServer.ouch_server import ProtocolMessageServer
+from OuchServer.ouch_messages import OuchClientMessages
+from exchange.exchange import Exchange
+from exchange.exchange_client import order_requests
+from exchange.order_books.cda_book import CDABook
+
+p = configargparse.ArgParser()
+p.add('--transport', choices=['streams', 'buffered', 'both'], default='both')
+p.add('--clients', default=4, type=int, help="Connections sending orders, at most 10")
+p.add('--orders', default=5000, type=int, help="Rounds of the exchange_client load per connection")
+p.add('--repeat', default=3, type=int)
+p.add('--no_exchange', dest='exchange', action='store_false', help="Drop the messages instead of matching them, to time intake alone")
+options, args = p.parse_known_args()
+
+def encode_rounds(client):
+    return [[bytes(request) for request in order_requests(index)]
+            for index in range(client * 10**6, client * 10**6 + options.orders)]
+
+async def send_orders(rounds, handled):
+    reader, writer = await asyncio.open_connection(ouch_server.options.host, ouch_server.options.port)
+
+    async def read_replies():
+        while await reader.read(65536):
+            pass
+    replies = asyncio.ensure_future(read_replies())
+    for requests in rounds:
+        for request in requests:
+            writer.write(request)
+            await writer.drain()
+        await asyncio.sleep(0)  # as exchange_client does between rounds
+    await handled
+    writer.close()
+    await replies
+
+def trial(transport, rounds):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    server = ProtocolMessageServer(OuchClientMessages, transport=transport)
+    exchange = Exchange(order_book=CDABook(), order_reply=server.send_server_response,
+                        order_reply_batch=server.send_server_responses,
+                        message_broadcast=server.broadcast_server_message,
+                        message_broadcast_batch=server.broadcast_server_messages, loop=loop)
+    handled = loop.create_future()
+    total = 4 * options.orders * options.clients
+    count = 0
+
+    async def listener(messages):
+        nonlocal count
+        if options.exchange:
+            await exchange.process_messages(messages)
+        count += len(messages)
+        if count == total:
+            handled.set_result(time.perf_counter())
+    server.register_batch_listener(listener)
+    server.start(loop)
+    start = time.perf_counter()
+    loop.run_until_complete(asyncio.gather(*(send_orders(client_rounds, handled) for client_rounds in rounds)))
+    elapsed = handled.result() - start
+    server.stop(loop)
+    loop.close()
+    return elapsed, total
+
+def main():
+    transports = ['streams', 'buffered'] if options.transport == 'both' else [options.transport]
+    rounds = [encode_rounds(client) for client in range(options.clients)]
+    for transport in transports:
+        best = None
+        for _ in range(options.repeat):
+            elapsed, total = trial(transport, rounds)
+            best = elapsed if best is None else min(best, elapsed)
+        print('{:<9} {} messages, best of {}: {:.3f} s, {:.0f} messages/s'.format(
+            transport, total, options.repeat, best, total / best))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+"""
+Price ladder benchmark: walk-from-start SortedIndexedDefaultList vs
+BisectIndexedDefaultList vs a DenseIndexedDefaultList covering the band.
+
+For each book depth, fills both ladders with that many resting price levels and
+then times a churn of creating and removing levels at random prices inside the
+band, which is what CDABook/FBABook do as orders enter and levels empty out.
+"""
+
+import timeit
+from functools import partial
+from random import Random
+import configargparse
+
+from exchange.order_books.book_price_q import BookPriceQ
+from exchange.order_books.list_elements import SortedIndexedDefaultList, BisectIndexedDefaultList, DenseIndexedDefaultList
+
+p = configargparse.ArgParser()
+p.add('--depths', default='4,16,64,256,1024,4096', help="Comma separated numbers of resting levels")
+p.add('--churn', default=2000, type=int, help="Level insert/remove pairs timed per depth")
+p.add('--repeat', default=3, type=int)
+options, args = p.parse_known_args()
+
+def build(cls, depth, rng):
+    ladder = cls(index_func = lambda bq: bq.price,
+                 initializer = lambda p: BookPriceQ(p),
+                 index_multiplier = -1)
+    for price in rng.sample(range(0, 4 * depth), depth):
+        ladder[price]
+    return ladder
+
+def churn(ladder, prices):
+    for price in prices:
+        if price in ladder:
+            continue
+        ladder[price]
+        ladder.remove(price)
+
+def dense(depth):
+    return partial(DenseIndexedDefaultList, min_index = 0, max_index = 4 * depth)
+
+def time_ladder(cls, depth):
+    rng = Random(depth)
+    ladder = build(cls, depth, rng)
+    prices = [rng.randrange(0, 4 * depth) for _ in range(options.churn)]
+    best = min(timeit.repeat(lambda: churn(ladder, prices), number=1, repeat=options.repeat))
+    return best / options.churn * 1e6
+
+def main():
+    print('{:>8} {:>14} {:>14} {:>14} {:>8}'.format('levels', 'linked us/op', 'bisect us/op', 'dense us/op', 'speedup'))
+    for depth in [int(d) for d in options.depths.split(',')]:
+        linked = time_ladder(SortedIndexedDefaultList, depth)
+        bisect = time_ladder(BisectIndexedDefaultList, depth)
+        dense_ = time_ladder(dense(depth), depth)
+        print('{:>8} {:>14.2f} {:>14.2f} {:>14.2f} {:>7.1f}x'.format(
+            depth, linked, bisect, dense_, linked / bisect))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+"""
+Snapshot benchmark: how long the engine stops to take a snapshot.
+
+Rests `orders` live orders, bids and asks that do not cross spread over
+`levels` price levels on each side, on a CDA exchange, then times
+take_snapshot, which the engine task runs between two batches while matching
+waits, and write_snapshot, which the Snapshotter's writer thread runs while
+matching carries on. Reports the best of `repeat` of each, and the size of
+the snapshot file.
+"""
+
+import os
+import time
+import asyncio
+import tempfile
+import configargparse
+
+from exchange.exchange import Exchange, client_message
+from exchange.order_books.cda_book import CDABook
+from exchange.snapshot import take_snapshot, write_snapshot
+from exchange.test_order_store import enter_order
+
+p = configargparse.ArgParser()
+p.add('--orders', default=100000, type=int, help="Live orders in the book")
+p.add('--levels', default=100, type=int, help="Price levels on each side")
+p.add('--repeat', default=5, type=int)
+options, args = p.parse_known_args()
+
+async def ignore(messages):
+    pass
+
+def build(loop):
+    exchange = Exchange(CDABook(), None, loop, order_reply_batch = ignore, message_broadcast_batch = ignore,
+                        clock = lambda: 1)
+    messages = []
+    for index in range(options.orders):
+        order = enter_order(index)
+        level = index % options.levels
+        if index % 2:
+            order['buy_sell_indicator'] = b'S'
+            order['price'] = 1000 + level
+        else:
+            order['price'] = 999 - level
+        order['time_in_force'] = 99999 if index % 4 else 600
+        messages.append(client_message(bytes(order), 0))
+    loop.run_until_complete(exchange.process_messages(messages, 1))
+    return exchange
+
+def best(func):
+    times = []
+    for _ in range(options.repeat):
+        start = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+def main():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    exchange = build(loop)
+    (pause, snapshot) = best(lambda: take_snapshot(exchange))
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'snap')
+        (write, _) = best(lambda: write_snapshot(path, snapshot))
+        size = os.path.getsize(path)
+    print('{} live orders, best of {}: engine paused {:.1f} ms ({:.2f} us/order), written in {:.1f} ms, '
+          '{:.1f} MB'.format(len(exchange.order_store.orders), options.repeat, pause * 1e3,
+                             pause / options.orders * 1e6, write * 1e3, size / 1e6))
+    loop.close()
+
+if __name__ == '__main__':
+    main()
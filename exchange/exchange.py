@@ -12,6 +12,9 @@ from OuchServer.ouch_messages import OuchClientMessages, OuchServerMessages
 from OuchServer.ouch_server import nanoseconds_since_midnight
 
 from exchange.order_store import OrderStore
+from exchange.expiry_scheduler import ExpiryScheduler
+from exchange.journal import EXPIRY
+from exchange.token_interner import TokenInterner
 
 ###
 # TODOs:
@@ -22,9 +25,18 @@ from exchange.order_store import OrderStore
 ##      
 
 
+def client_message(data, meta = None):
+    '''the client message in data, header included, as a view on it carrying meta'''
+    header_size = OuchClientMessages.get_message_class().get_header_class().size
+    message = OuchClientMessages.lookup_by_header_bytes(data[:header_size]).view(data)
+    message.meta = meta
+    return message
+
 
 class Exchange:
-    def __init__(self, order_book, order_reply, loop, message_broadcast = None):
+    def __init__(self, order_book, order_reply, loop, message_broadcast = None, order_store = None,
+            inbound_size = 1024, message_broadcast_batch = None, order_reply_batch = None, journal = None,
+            clock = nanoseconds_since_midnight):
         '''
         order_book - the book!
         order_reply - post office reply function, takes in 
@@ -32,16 +44,33 @@ class Exchange:
                 original order
                 context
             and does whatever we need to get that info back to order sender                             
+        order_store - OrderStore to keep the orders in, e.g. one archiving retired orders; a new one by default
+        inbound_size - batches of client messages queued for the engine task before enqueue_messages waits, see run_engine
+        message_broadcast_batch - takes the list of every message a handler broadcasts at once, in place of
+                calling message_broadcast with each
+        order_reply_batch - likewise takes the list of every reply of a handler, in place of order_reply
+        journal - Journal the engine task records each batch of client messages in before handling it
+        clock - returns the time in nanoseconds since midnight messages are stamped with; replays substitute their own
         '''
-        self.order_store = OrderStore()
+        self.order_store = order_store if order_store is not None else OrderStore()
+        self.tokens = TokenInterner()   # order token <-> the order id used by the store, the book and the expiries
+        self.touched_orders = []    # ids of the orders changed by the message being handled, see settle_orders
         self.order_book = order_book
         self.order_reply = order_reply
+        self.order_reply_batch = order_reply_batch
         self.message_broadcast = message_broadcast
+        self.message_broadcast_batch = message_broadcast_batch
         self.next_match_number = 0
         self.loop = loop
+        self.expiries = ExpiryScheduler(loop, self.on_expiry)  # time in force of resting orders
         self.outgoing_messages = deque()
         self.order_ref_numbers = itertools.count(1, 2)  # odds    
         self.outgoing_broadcast_messages = deque()  # ali
+        self.inbound = asyncio.Queue(maxsize = inbound_size)   # batches of client messages, and calls, for run_engine
+        self.events = deque()   # coroutine functions of the exchange's timers, for run_engine; see post_event
+        self.journal = journal
+        self.clock = clock
+        self.engine = None  # the task running run_engine, once start_engine is called
         self.handlers = { 
             OuchClientMessages.EnterOrder: self.enter_order_atomic,
             OuchClientMessages.ReplaceOrder: self.replace_order_atomic,
@@ -52,6 +81,8 @@ class Exchange:
     def system_start_atomic(self, system_event_message, timestamp):  
         self.order_store.clear_order_store()
         self.order_book.reset_book()
+        self.expiries.clear()
+        self.tokens.clear()
         m = OuchServerMessages.SystemEvent(event_code=b'S', timestamp=timestamp)
         m.meta = system_event_message.meta
         self.outgoing_messages.append(m)
@@ -95,15 +126,15 @@ class Exchange:
         m.meta = replace_order_message.meta
         return m
 
-    def order_cancelled_from_cancel(self, original_enter_message, timestamp, amount_canceled, reason=b'U',order_token = None):
+    def order_cancelled_from_cancel(self, store_entry, timestamp, amount_canceled, reason=b'U',order_token = None):
 
-        order_token = original_enter_message['order_token'] if order_token is None else order_token
+        order_token = store_entry.token if order_token is None else order_token
         m = OuchServerMessages.Canceled(timestamp = timestamp,
                             order_token = order_token,
                             decrement_shares = amount_canceled,
                             reason = reason,
-                            midpoint_peg = original_enter_message['midpoint_peg'])
-        m.meta = original_enter_message.meta
+                            midpoint_peg = store_entry.midpoint_peg)
+        m.meta = store_entry.owner
         return m
     
     def best_quote_update(self, order_message, new_bbo, timestamp):
@@ -117,63 +148,78 @@ class Exchange:
 
     def process_cross(self, id, fulfilling_order_id, price, volume, timestamp, liquidity_flag = b'?'):
         log.debug('Orders (%s, %s) crossed at price %s, volume %s', id, fulfilling_order_id, price, volume)
-        order_message = self.order_store.orders[id].first_message
-        fulfilling_order_message = self.order_store.orders[fulfilling_order_id].first_message
-        log.debug('incoming order message: %s, fullfilling order message: %s',order_message,fulfilling_order_message)
+        order_entry = self.order_store.orders[id]
+        fulfilling_order_entry = self.order_store.orders[fulfilling_order_id]
+        log.debug('incoming order: %s, fullfilling order: %s', order_entry, fulfilling_order_entry)
         match_number = self.next_match_number
         self.next_match_number += 1
-        original_enter_message = self.order_store.orders[id].original_enter_message
         r1 = OuchServerMessages.Executed(
                 timestamp = timestamp,
-                order_token = id,
+                order_token = self.tokens.token(id),
                 executed_shares = volume,
                 execution_price = price,
                 liquidity_flag = liquidity_flag,
                 match_number = match_number,
-                midpoint_peg = original_enter_message['midpoint_peg']
+                midpoint_peg = order_entry.midpoint_peg
                 )
-        r1.meta = order_message.meta
-        self.order_store.add_to_order(r1['order_token'], r1)
-        fulfilling_original_enter_message = self.order_store.orders[fulfilling_order_id].original_enter_message
+        r1.meta = order_entry.owner
+        self.order_store.add_to_order(id, r1)
         r2 = OuchServerMessages.Executed(
                 timestamp = timestamp,
-                order_token = fulfilling_order_id,
+                order_token = self.tokens.token(fulfilling_order_id),
                 executed_shares = volume,
                 execution_price = price,
                 liquidity_flag = liquidity_flag,
                 match_number = match_number,
-                midpoint_peg = fulfilling_original_enter_message['midpoint_peg']
+                midpoint_peg = fulfilling_order_entry.midpoint_peg
                 )
-        r2.meta = fulfilling_order_message.meta
-        self.order_store.add_to_order(r2['order_token'], r2)
+        r2.meta = fulfilling_order_entry.owner
+        self.order_store.add_to_order(fulfilling_order_id, r2)
+        self.touched_orders.append(id)
+        self.touched_orders.append(fulfilling_order_id)
         return [r1, r2]
 
+    def settle_orders(self):
+        '''
+        Retire the orders touched since the last call that are no longer in the book, dropping their expiries
+        and releasing their ids. Called once a message, batch or expiry has been handled in full.
+        '''
+        touched_orders, self.touched_orders = self.touched_orders, []
+        for order_id in touched_orders:
+            if order_id not in self.order_book and order_id in self.order_store:
+                self.expiries.unschedule(order_id)
+                self.order_store.retire(order_id)
+                self.tokens.release(order_id)
+
     def enter_order_atomic(self, enter_order_message, timestamp, executed_quantity = 0):
-        order_stored = self.order_store.store_order( 
-            id = enter_order_message['order_token'], 
-            message = enter_order_message, 
-            executed_quantity = executed_quantity)
-        if not order_stored:
-            log.debug('Order already stored with id %s, order ignored', enter_order_message['order_token'])
+        order_token = enter_order_message['order_token']
+        if order_token in self.tokens:
+            log.debug('Order already stored with id %s, order ignored', order_token)
             return []
         else:
+            order_id = self.tokens.intern(order_token)
+            self.order_store.store_order( 
+                id = order_id, 
+                message = enter_order_message, 
+                executed_quantity = executed_quantity)
             time_in_force = enter_order_message['time_in_force']
             enter_into_book = True if time_in_force > 0 else False    
             if time_in_force > 0 and time_in_force < 99998:     #schedule a cancellation at some point in the future
-                cancel_order_message = self.cancel_order_from_enter_order( enter_order_message )
-                self.loop.call_later(time_in_force, partial(self.cancel_order_atomic, cancel_order_message, timestamp))
+                self.expiries.schedule(order_id, time_in_force)
             
             enter_order_func = self.order_book.enter_buy if enter_order_message['buy_sell_indicator'] == b'B' else self.order_book.enter_sell
             (crossed_orders, entered_order, new_bbo) = enter_order_func(
-                    enter_order_message['order_token'],
+                    order_id,
                     enter_order_message['price'],
                     enter_order_message['shares'],
-                    enter_into_book)
+                    enter_into_book,
+                    entry_time = timestamp)
             #log.debug("Resulting book: %s", self.order_book)
             m=self.accepted_from_enter(enter_order_message, 
                 order_reference_number=next(self.order_ref_numbers),
                 timestamp=timestamp)
-            self.order_store.add_to_order(m['order_token'], m)
+            self.order_store.add_to_order(order_id, m)
+            self.touched_orders.append(order_id)
             self.outgoing_messages.append(m)
             cross_messages = [m for ((id, fulfilling_order_id), price, volume) in crossed_orders 
                                 for m in self.process_cross(id, fulfilling_order_id, price, volume, timestamp=timestamp)]
@@ -184,19 +230,19 @@ class Exchange:
 
     def cancel_order_atomic(self, cancel_order_message, timestamp, reason=b'U'):
 
-        #if cancel_order_message['order_token'] not in self.order_store.orders.get():
-        if self.order_store.orders.get(cancel_order_message['order_token']) is None:
+        order_id = self.tokens.id_of(cancel_order_message['order_token'])
+        if self.order_store.orders.get(order_id) is None:
             log.debug(f"No such order to cancel, ignored. Token to cancel: {cancel_order_message['order_token']}")
         else:
-            store_entry = self.order_store.orders[cancel_order_message['order_token']]
-            original_enter_message = store_entry.original_enter_message
+            store_entry = self.order_store.orders[order_id]
             cancelled_orders, new_bbo = self.order_book.cancel_order(
-                id = cancel_order_message['order_token'],
-                price = store_entry.first_message['price'],
-                volume = cancel_order_message['shares'],
-                buy_sell_indicator = store_entry.original_enter_message['buy_sell_indicator'])
-            cancel_messages = [ self.order_cancelled_from_cancel(original_enter_message, timestamp, amount_canceled, reason,order_token= cancel_order_message['order_token'])
+                id = order_id,
+                volume = cancel_order_message['shares'])
+            cancel_messages = [ self.order_cancelled_from_cancel(store_entry, timestamp, amount_canceled, reason,order_token= cancel_order_message['order_token'])
                         for (id, amount_canceled) in cancelled_orders ]
+            for (id, amount_canceled) in cancelled_orders:
+                self.order_store.cancel_quantity(id, amount_canceled)
+                self.touched_orders.append(id)
 
             self.outgoing_messages.extend(cancel_messages) 
             #log.debug("Resulting book: %s", self.order_book)
@@ -222,61 +268,61 @@ class Exchange:
         #         either a Replaced Message or an Atomically Replaced and Canceled Message.
         # """
     def replace_order_atomic(self, replace_order_message, timestamp):
-        if replace_order_message['existing_order_token'] not in self.order_store.orders:
+        existing_id = self.tokens.id_of(replace_order_message['existing_order_token'])
+        if existing_id not in self.order_store.orders:
             log.debug('Existing token %s unknown, siliently ignoring', replace_order_message['existing_order_token'])
             return []
-        elif replace_order_message['replacement_order_token'] in self.order_store.orders:
+        elif replace_order_message['replacement_order_token'] in self.tokens:
             log.debug('Replacement token %s unknown, siliently ignoring', replace_order_message['existing_order_token'])
             return []
         else:
-            store_entry = self.order_store.orders[replace_order_message['existing_order_token']]
+            store_entry = self.order_store.orders[existing_id]
             log.debug('store_entry: %s', store_entry)
             cancelled_orders, new_bbo_post_cancel = self.order_book.cancel_order(
-                id = replace_order_message['existing_order_token'],
-                price = store_entry.first_message['price'],
-                volume = 0,
-                buy_sell_indicator = store_entry.original_enter_message['buy_sell_indicator'])  # Fully cancel
+                id = existing_id,
+                volume = 0)  # Fully cancel
             
             if len(cancelled_orders)==0:
                 log.debug('No orders cancelled, siliently ignoring')
                 return []
             else:
                 (id_cancelled, amount_cancelled) = cancelled_orders[0]
-                original_enter_message = store_entry.original_enter_message
-                first_message = store_entry.first_message
-                shares_diff = replace_order_message['shares'] - first_message['shares'] 
+                self.order_store.cancel_quantity(id_cancelled, amount_cancelled)
+                self.touched_orders.append(id_cancelled)
+                shares_diff = replace_order_message['shares'] - store_entry.shares
                 liable_shares = max(0, amount_cancelled + shares_diff )
                 if liable_shares == 0:
                     log.debug('No remaining liable shares on the book to replace')
                     #send cancel
                 else:
+                    replacement_id = self.tokens.intern(replace_order_message['replacement_order_token'])
                     self.order_store.store_order(
-                            id = replace_order_message['replacement_order_token'], 
+                            id = replacement_id, 
                             message = replace_order_message,
-                            original_enter_message = original_enter_message)
+                            original = store_entry)
                     time_in_force = replace_order_message['time_in_force']
                     enter_into_book = True if time_in_force > 0 else False    
                     if time_in_force > 0 and time_in_force < 99998:     #schedule a cancellation at some point in the future
-                        cancel_order_message = self.cancel_order_from_replace_order( replace_order_message )
-                        self.loop.call_later(time_in_force, partial(self.cancel_order_atomic, cancel_order_message, timestamp))
+                        self.expiries.schedule(replacement_id, time_in_force)
                     
-                    enter_order_func = self.order_book.enter_buy if original_enter_message['buy_sell_indicator'] == b'B' else self.order_book.enter_sell
+                    enter_order_func = self.order_book.enter_buy if store_entry.side == b'B' else self.order_book.enter_sell
                     crossed_orders, entered_order, new_bbo_post_enter = enter_order_func(
-                            replace_order_message['replacement_order_token'],
+                            replacement_id,
                             replace_order_message['price'],
                             liable_shares,
-                            enter_into_book)
+                            enter_into_book,
+                            entry_time = timestamp)
                     #log.debug("Resulting book: %s", self.order_book)
 
                     r = OuchServerMessages.Replaced(
                             timestamp=timestamp,
                             replacement_order_token = replace_order_message['replacement_order_token'],
-                            buy_sell_indicator=original_enter_message['buy_sell_indicator'],
+                            buy_sell_indicator=store_entry.side,
                             shares=liable_shares,
-                            stock=original_enter_message['stock'],
+                            stock=store_entry.stock,
                             price=replace_order_message['price'],
                             time_in_force=replace_order_message['time_in_force'],
-                            firm=original_enter_message['firm'],
+                            firm=store_entry.firm,
                             display=replace_order_message['display'],
                             order_reference_number=next(self.order_ref_numbers), 
                             capacity=b'*',
@@ -286,11 +332,12 @@ class Exchange:
                             order_state=b'L' if entered_order is not None else b'D',
                             previous_order_token=replace_order_message['existing_order_token'],
                             bbo_weight_indicator=b'*',
-                            midpoint_peg=original_enter_message['midpoint_peg']
+                            midpoint_peg=store_entry.midpoint_peg
                             )
                     r.meta = replace_order_message.meta
                     self.outgoing_messages.append(r)
-                    self.order_store.add_to_order(r['replacement_order_token'], r)        
+                    self.order_store.add_to_order(replacement_id, r)        
+                    self.touched_orders.append(replacement_id)
                     cross_messages = [m for ((id, fulfilling_order_id), price, volume) in crossed_orders 
                                         for m in self.process_cross(id, 
                                                     fulfilling_order_id, 
@@ -311,28 +358,240 @@ class Exchange:
 
         #log.debug("Resulting orderstore: %s", self.order_store)
 
+    def expire_orders(self, order_ids, timestamp):
+        '''
+        Cancel the orders whose time in force ran out, as one batch against the book, stamped at timestamp
+        '''
+        cancelled_orders, new_bbo = self.order_book.cancel_orders([(order_id, 0) for order_id in order_ids])
+        canceled_message = None
+        for (order_id, amount_canceled) in cancelled_orders:
+            self.order_store.cancel_quantity(order_id, amount_canceled)
+            self.touched_orders.append(order_id)
+            canceled_message = self.order_cancelled_from_cancel(self.order_store.orders[order_id], timestamp,
+                amount_canceled, order_token = self.tokens.token(order_id))
+            self.outgoing_messages.append(canceled_message)
+        if new_bbo:
+            bbo_message = self.best_quote_update(canceled_message, new_bbo, timestamp)
+            self.outgoing_broadcast_messages.append(bbo_message)
+
+    def on_expiry(self, order_ids):
+        '''
+        called by self.expiries when a tick's orders run out of time: the engine expires them, see run_expiries.
+        They are named by their tokens from here on, as an order done with before then may give its id to another.
+        '''
+        self.post_event(partial(self.run_expiries, [self.expiry_message(order_id) for order_id in order_ids]))
+
+    async def run_expiries(self, messages):
+        '''
+        Expire the orders of expiry_messages, on the engine task. The expiries are journaled first, with the
+        timestamp they are stamped with, for replays to expire the orders just as they were here.
+        '''
+        timestamp = self.clock()
+        if self.journal is not None:
+            self.journal.append_batch(messages, timestamp)
+        await self.process_expiries(messages, timestamp)
+
+    def expiry_message(self, order_id):
+        '''the journal record of the expiry of an order: a CancelOrder for it from EXPIRY'''
+        message = OuchClientMessages.CancelOrder(order_token = self.tokens.token(order_id), shares = 0)
+        message.meta = EXPIRY
+        return message
+
+    async def process_expiries(self, messages, timestamp):
+        '''
+        Expire the orders of expiry records at timestamp, those still live. Replays and warm starts hold
+        self.expiries and expire orders by this, from the records run_expiries journaled.
+        '''
+        order_ids = [self.tokens.id_of(message['order_token']) for message in messages]
+        order_ids = [order_id for order_id in order_ids if order_id is not None]
+        for order_id in order_ids:
+            self.expiries.unschedule(order_id)
+        self.expire_orders(order_ids, timestamp)
+        self.settle_orders()
+        await self.send_outgoing_messages()
+        await self.send_outgoing_broadcast_messages()
+
     async def send_outgoing_broadcast_messages(self):
+        if self.message_broadcast_batch is not None:
+            if self.outgoing_broadcast_messages:
+                messages = list(self.outgoing_broadcast_messages)
+                self.outgoing_broadcast_messages.clear()
+                await self.message_broadcast_batch(messages)
+            return
         while len(self.outgoing_broadcast_messages)>0:
             m = self.outgoing_broadcast_messages.popleft()
             await self.message_broadcast(m)
             
 
     async def send_outgoing_messages(self):
+        if self.order_reply_batch is not None:
+            if self.outgoing_messages:
+                messages = list(self.outgoing_messages)
+                self.outgoing_messages.clear()
+                await self.order_reply_batch(messages)
+            return
         while len(self.outgoing_messages)>0:
             m = self.outgoing_messages.popleft()
             await self.order_reply(m)
 
-    async def process_message(self, message):
+    def handle_message(self, message, timestamp = None):
         log.debug('Processing message %s', message)
         if message.message_type in self.handlers:
-            timestamp = nanoseconds_since_midnight()
+            if timestamp is None:
+                timestamp = self.clock()
             self.handlers[message.message_type](message, timestamp)
-            await self.send_outgoing_messages()
-            await self.send_outgoing_broadcast_messages()
+            self.settle_orders()
+            return True
         else:
             log.error("Unknown message type %s", message.message_type)
             return False
 
+    async def process_message(self, message, timestamp = None):
+        if not self.handle_message(message, timestamp):
+            return False
+        await self.send_outgoing_messages()
+        await self.send_outgoing_broadcast_messages()
+
+    async def process_messages(self, messages, timestamp = None):
+        '''
+        Process a batch of messages in order, as by process_message: each one's replies and broadcasts
+        go out before the next is handled, so clients see the same sequence either way. With a timestamp,
+        every message in the batch is stamped with it rather than with the clock.
+        '''
+        for message in messages:
+            if self.handle_message(message, timestamp):
+                await self.send_outgoing_messages()
+                await self.send_outgoing_broadcast_messages()
+
+    async def enqueue_messages(self, messages):
+        '''
+        Batch listener handing a client's messages to the engine task. Waits only while the inbound queue is
+        full, which holds back reading from the clients until the engine catches up.
+        '''
+        await self.inbound.put(messages)
+
+    def call_between_batches(self, func):
+        '''
+        Have the engine task call and await the coroutine function func after the batches already queued,
+        before the next, when no message is half handled. Returns False, without queueing it, if the inbound
+        queue is full.
+        '''
+        try:
+            self.inbound.put_nowait(func)
+        except asyncio.QueueFull:
+            return False
+        return True
+
+    def post_event(self, func):
+        '''
+        Have the engine task call and await the coroutine function func before it takes the next batch of
+        client messages. The exchange's timers change it this way, rather than from their callbacks or tasks
+        of their own, so that only the engine ever does, and so that an event that fails stops it as a batch
+        that fails does. A replay runs the events itself, see replay.apply_batch.
+        '''
+        self.events.append(func)
+        if self.inbound.empty():
+            self.inbound.put_nowait(None)     # wakes the engine if it waits for a batch
+
+    async def run_events(self):
+        '''call and await the events posted so far, in order'''
+        events = self.events
+        while events:
+            await events.popleft()()
+
+    def start_engine(self):
+        self.engine = asyncio.ensure_future(self.run_engine())
+        self.engine.add_done_callback(self.engine_done)
+        return self.engine
+
+    def engine_done(self, engine):
+        # a failed engine leaves nothing to serve clients with: stop the loop so that the process ends
+        if not engine.cancelled() and engine.exception() is not None:
+            self.loop.stop()
+
+    async def run_engine(self):
+        '''
+        The engine: the one task handling client messages, taking batches off the inbound queue in arrival
+        order, and running the events of the exchange's timers before each. Replies and broadcasts are handed
+        to order_reply and message_broadcast, which only queue them for the clients' writer tasks, so matching
+        never waits on a client's socket. Each batch is stamped
+        once as it is taken off the queue, and with a journal recorded in it under that timestamp before it
+        is handled, so that replaying the journal stamps the messages just as they were stamped here. The
+        engine stops on the first batch or event that fails, as the exchange is left with it half applied.
+        '''
+        inbound = self.inbound
+        journal = self.journal
+        while True:
+            messages = await inbound.get()
+            try:
+                await self.run_events()
+            except Exception:
+                log.critical('Engine failed on an event, stopping it', exc_info = True)
+                raise
+            if messages is None:       # from post_event
+                continue
+            if callable(messages):     # from call_between_batches
+                try:
+                    await messages()
+                except Exception:
+                    log.exception('Engine failed on a call between batches')
+                continue
+            timestamp = self.clock()
+            if journal is not None:
+                journal.append_batch(messages, timestamp)
+            try:
+                await self.process_messages(messages, timestamp)
+            except Exception:
+                log.critical('Engine failed on a batch of %d messages, stopping it', len(messages), exc_info = True)
+                raise
+
+    def can_snapshot(self):
+        '''whether snapshot_state can be taken now'''
+        return True
+
+    def snapshot_state(self):
+        '''
+        Everything the exchange needs to carry on from where it is, as plain data for a snapshot: the book,
+        the orders in the store, the order tokens used, the expiries and
+        the numbering of matches and accepted orders. To be taken between messages, see Snapshotter.
+        '''
+        next_order_ref_number = next(self.order_ref_numbers)
+        self.order_ref_numbers = itertools.count(next_order_ref_number, 2)
+        return {
+            'book': self.order_book.snapshot_state(),
+            'orders': [(order_id,) + entry.snapshot() for (order_id, entry) in self.order_store.orders.items()],
+            'tokens': self.tokens.snapshot(),
+            'expiries': self.expiries.remaining(),
+            'next_match_number': self.next_match_number,
+            'next_order_ref_number': next_order_ref_number}
+
+    def restore_state(self, state):
+        '''
+        Take up the state of a snapshot_state in place of the exchange's own. Expiries run on from the time
+        they had left when the snapshot was taken. Orders keep the client tokens of the process that took it
+        as their owners, for a replay to send to; see detach_owners.
+        '''
+        self.order_store.orders.clear()
+        self.expiries.clear()
+        self.tokens.clear()
+        self.order_book.restore_state(state['book'])
+        self.tokens.restore(state['tokens'])
+        for (order_id, *fields) in state['orders']:
+            self.order_store.restore_order(order_id, fields)
+        for (order_id, delay) in state['expiries']:
+            self.expiries.schedule(order_id, max(delay, 0))
+        self.next_match_number = state['next_match_number']
+        self.order_ref_numbers = itertools.count(state['next_order_ref_number'], 2)
+
+    def detach_owners(self):
+        '''
+        Drop the owners of the live orders. Client tokens are handed out afresh by each process, so after a
+        restart those of the process that entered the orders name other clients, or none; what the orders
+        are sent from now on goes to no client.
+        '''
+        for entry in self.order_store.orders.values():
+            entry.owner = None
+
     async def modify_order(self, modify_order_message):
         raise NotImplementedError()
 
@@ -30,6 +30,53 @@ def rounduprounddown(i, minlimit, maxlimit, roundeddown, roundedup):
         return i
 
 
+def order_requests(index):
+    """
+    the messages the client sends for its index-th order: enter it, replace it twice and cancel it
+    """
+    request = OuchClientMessages.EnterOrder(
+        order_token='{:014d}'.format(index).encode('ascii'),
+        buy_sell_indicator=b'B' if randint(0,1)==1 else b'S',
+        shares=1,#randrange(1,10**6-1),
+        stock=b'AMAZGOOG',
+        price=rounduprounddown(randrange(1,100), 40, 60, 0, 2147483647 ),
+        time_in_force=options.time_in_force,
+        firm=b'OUCH',
+        display=b'N',
+        capacity=b'O',
+        intermarket_sweep_eligibility=b'N',
+        minimum_quantity=1,
+        cross_type=b'N',
+        customer_type=b' ',
+        midpoint_peg=False)
+
+    reprequest = OuchClientMessages.ReplaceOrder(
+        existing_order_token='{:014d}'.format(index).encode('ascii'),
+        replacement_order_token='{:014d}'.format(900000000+index).encode('ascii'),
+        shares=2*request['shares'],
+        price=request['price'],
+        time_in_force=options.time_in_force,
+        display=b'N',
+        intermarket_sweep_eligibility=b'N',
+        minimum_quantity=1)
+
+    reprequestii = OuchClientMessages.ReplaceOrder(
+        existing_order_token='{:014d}'.format(900000000+index).encode('ascii'),
+        replacement_order_token='{:014d}'.format(910000000+index).encode('ascii'),
+        shares=2*request['shares'],
+        price=request['price'],
+        time_in_force=options.time_in_force,
+        display=b'N',
+        intermarket_sweep_eligibility=b'N',
+        minimum_quantity=1)
+
+    cancelhalf = OuchClientMessages.CancelOrder(
+        order_token='{:014d}'.format(910000000+index).encode('ascii'),
+        shares=request['shares'])
+
+    return [request, reprequest, reprequestii, cancelhalf]
+
+
 class Client():
     def __init__(self):
         self.reader = None
@@ -94,57 +141,8 @@ class Client():
             self.writer = writer
 
         for index in itertools.count():
-            request = OuchClientMessages.EnterOrder(
-                order_token='{:014d}'.format(index).encode('ascii'),
-                buy_sell_indicator=b'B' if randint(0,1)==1 else b'S',
-                shares=1,#randrange(1,10**6-1),
-                stock=b'AMAZGOOG',
-                price=rounduprounddown(randrange(1,100), 40, 60, 0, 2147483647 ),
-                time_in_force=options.time_in_force,
-                firm=b'OUCH',
-                display=b'N',
-                capacity=b'O',
-                intermarket_sweep_eligibility=b'N',
-                minimum_quantity=1,
-                cross_type=b'N',
-                customer_type=b' ')
-            #print('send message: ', request)
-            #log.info("Sending Ouch message: %s", request)
-            await self.send(request)
-
-            reprequest = OuchClientMessages.ReplaceOrder(
-                existing_order_token='{:014d}'.format(index).encode('ascii'),
-                replacement_order_token='{:014d}'.format(900000000+index).encode('ascii'),
-                shares=2*request['shares'],
-                price=request['price'],
-                time_in_force=options.time_in_force,
-                display=b'N',
-                intermarket_sweep_eligibility=b'N',
-                minimum_quantity=1)
-            #print('send message: ', request)
-            #log.info("Sending Ouch message: %s", request)
-            await self.send(reprequest)
-
-            reprequestii = OuchClientMessages.ReplaceOrder(
-                existing_order_token='{:014d}'.format(900000000+index).encode('ascii'),
-                replacement_order_token='{:014d}'.format(910000000+index).encode('ascii'),
-                shares=2*request['shares'],
-                price=request['price'],
-                time_in_force=options.time_in_force,
-                display=b'N',
-                intermarket_sweep_eligibility=b'N',
-                minimum_quantity=1)
-            #print('send message: ', request)
-            #log.info("Sending Ouch message: %s", request)
-            await self.send(reprequestii)
-
-
-            cancelhalf = OuchClientMessages.CancelOrder(
-                order_token='{:014d}'.format(910000000+index).encode('ascii'),
-                shares=request['shares'])
-            #print('send message: ', request)
-            #log.info("Sending Ouch message: %s", request)
-            await self.send(cancelhalf)            
+            for request in order_requests(index):
+                await self.send(request)
 
             if index % 1000 == 0:
                 print('sent {} messages'.format(index))   
@@ -0,0 +1,102 @@
+import heapq
+import math
+import logging as log
+
+
+class ExpiryScheduler:
+    '''
+    Time in force expiries of live orders, bucketed by tick of the event loop clock. Scheduling and
+    unscheduling an order are dict operations; a heap holds each tick that has a bucket once, and a single
+    timer is armed for the earliest of them. When a tick comes due, every order still in its bucket is handed
+    to expire in one call. While held, orders are scheduled and unscheduled as usual but none expire.
+    '''
+    def __init__(self, loop, expire, tick = 0.001):
+        '''
+        expire - called with the list of order tokens whose time in force ran out, in the order they were scheduled
+        tick - bucket width in seconds: an order expires at the end of the tick its time in force runs out in
+        '''
+        self.loop = loop
+        self.expire = expire
+        self.tick = tick
+        self.buckets = {}       # tick -> {order token: None}, in order of scheduling
+        self.ticks = []         # heap of the ticks in buckets
+        self.expiry_ticks = {}  # order token -> tick of its bucket
+        self.timer = None       # TimerHandle for the earliest tick
+        self.timer_tick = None
+        self.held = False       # whether expiries are held, see hold
+
+    def __len__(self):
+        return len(self.expiry_ticks)
+
+    def __contains__(self, token):
+        return token in self.expiry_ticks
+
+    def schedule(self, token, delay):
+        '''expire token delay seconds from now, replacing any expiry it already had'''
+        self.unschedule(token)
+        tick = math.ceil((self.loop.time() + delay) / self.tick)
+        bucket = self.buckets.get(tick)
+        if bucket is None:
+            bucket = self.buckets[tick] = {}
+            heapq.heappush(self.ticks, tick)
+        bucket[token] = None
+        self.expiry_ticks[token] = tick
+        if not self.held and (self.timer_tick is None or tick < self.timer_tick):
+            self.arm(tick)
+
+    def unschedule(self, token):
+        '''drop the expiry of token, if it has one'''
+        tick = self.expiry_ticks.pop(token, None)
+        if tick is not None:
+            del self.buckets[tick][token]
+
+    def remaining(self):
+        '''(order token, seconds until it expires) for every scheduled expiry, in the order they will fire'''
+        now = self.loop.time()
+        return [(token, tick * self.tick - now) for tick in sorted(self.buckets) for token in self.buckets[tick]]
+
+    def clear(self):
+        '''drop every scheduled expiry'''
+        if self.timer is not None:
+            self.timer.cancel()
+        self.buckets = {}
+        self.ticks = []
+        self.expiry_ticks = {}
+        self.timer = None
+        self.timer_tick = None
+
+    def hold(self):
+        '''stop orders expiring, e.g. while a replay expires them as its journal recorded, until release'''
+        self.held = True
+        if self.timer is not None:
+            self.timer.cancel()
+        self.timer = self.timer_tick = None
+
+    def release(self):
+        '''let orders expire again, at once for those whose time ran out while held'''
+        self.held = False
+        if self.ticks:
+            self.arm(self.ticks[0])
+
+    def arm(self, tick):
+        if self.timer is not None:
+            self.timer.cancel()
+        self.timer_tick = tick
+        self.timer = self.loop.call_at(tick * self.tick, self.fire)
+
+    def fire(self):
+        # the loop may run a timer up to its clock resolution early: the tick it was armed for is due regardless
+        due = max(self.timer_tick, math.floor(self.loop.time() / self.tick))
+        self.timer = self.timer_tick = None
+        expired = []
+        ticks = self.ticks
+        while ticks and ticks[0] <= due:
+            bucket = self.buckets.pop(heapq.heappop(ticks))
+            for token in bucket:
+                del self.expiry_ticks[token]
+            expired.extend(bucket)
+        if ticks:
+            self.arm(ticks[0])
+        if expired:
+            log.debug('Time in force ran out for %d orders', len(expired))
+            self.expire(expired)
@@ -1,21 +1,47 @@
+import math
 import logging as log
 import asyncio
+from functools import partial
 from exchange.exchange import Exchange
-from OuchServer.ouch_server import nanoseconds_since_midnight
-from OuchServer.ouch_messages import OuchServerMessages
+from exchange.journal import BATCH
+from OuchServer.metrics import Metrics
+from OuchServer.ouch_messages import OuchClientMessages, OuchServerMessages
+
+BATCH_CLOSE = b'C'  # event codes of the journal records of batches, see batch_message
+BATCH_MERGE = b'M'
 
 
 class FBAExchange(Exchange):
-    def __init__(self, interval, *args, **kwargs):
+    def __init__(self, interval, *args, clearing_executor = None, **kwargs):
+        '''
+        clearing_executor - concurrent.futures executor batches are cleared in, None for the loop's default one
+        '''
         self.interval = interval
+        self.clearing_executor = clearing_executor
+        self.clearing_book = None   # book of the batch being cleared in the executor, if one is
+        self.clearing = None        # future of its batch_process
+        self.clearing_timestamp = None  # timestamp it was closed at, which its fills are stamped with
+        self.clearing_ids = frozenset()     # ids of the orders in clearing_book, taken as it was frozen
+        self.deferred = []          # handlers for messages touching clearing_book's orders, run once it is back
+        self.batch_timer = None     # the task of run_batch_repeating, once started
+        self.metrics = Metrics()    # batch_clearing, intake_during_clearing and timer_drift timings, in seconds
         super().__init__(*args, **kwargs)
 
     def start(self):
-        asyncio.ensure_future(self.run_batch_repeating())
+        self.batch_timer = asyncio.ensure_future(self.run_batch_repeating())
+        self.batch_timer.add_done_callback(self.batch_timer_done)
 
-    def run_batch_atomic(self):
-        timestamp = nanoseconds_since_midnight()
-        crossed_orders, clearing_price = self.order_book.batch_process()
+    def batch_timer_done(self, batch_timer):
+        # no more batches would close: stop the loop, as a failed engine does
+        if not batch_timer.cancelled() and batch_timer.exception() is not None:
+            log.critical('Batch timer failed, stopping the loop', exc_info = batch_timer.exception())
+            self.loop.stop()
+
+    def post_batch(self, crossed_orders, clearing_price, bbo, timestamp, post_timestamp = None):
+        '''
+        Send the fills of a batch, stamped at timestamp, and broadcast its PostBatch, stamped at post_timestamp or
+        by the clock
+        '''
         cross_messages = [m for ((id, fulfilling_order_id), price, volume) 
                                             in crossed_orders 
                             for m in self.process_cross(
@@ -23,10 +49,10 @@ class FBAExchange(Exchange):
                                 price, volume, 
                                 timestamp=timestamp)]
         self.outgoing_messages.extend(cross_messages)
-        best_bid, best_ask, next_bid, next_ask, v_bb, v_bo = self.order_book.bbo
+        best_bid, best_ask, next_bid, next_ask, v_bb, v_bo = bbo
         self.outgoing_broadcast_messages.append(
             OuchServerMessages.PostBatch(
-                    timestamp=nanoseconds_since_midnight(),
+                    timestamp=self.clock() if post_timestamp is None else post_timestamp,
                     stock=b'AMAZGOOG',
                     clearing_price=clearing_price,
                     transacted_volume=len(crossed_orders),
@@ -37,9 +63,172 @@ class FBAExchange(Exchange):
                     volume_at_best_bid=v_bb,
                     volume_at_best_ask=v_bo))
 
+    def run_batch_atomic(self):
+        timestamp = self.clock()
+        crossed_orders, clearing_price = self.order_book.batch_process()
+        self.post_batch(crossed_orders, clearing_price, self.order_book.bbo, timestamp)
+        self.settle_orders()
+
+    def close_batch(self, timestamp):
+        '''
+        Close the batch at timestamp: start clearing the book in clearing_executor while a fresh book takes new
+        orders. Cancels and replaces of orders in the closing batch wait for merge_batch. Returns the future of
+        the clearing.
+        '''
+        self.clearing_timestamp = timestamp
+        closing = self.order_book
+        self.order_book = closing.freeze()
+        self.clearing_book = closing
+        # the executor changes closing's index as it clears: the loop only ever reads this copy of it
+        self.clearing_ids = frozenset(closing.order_index)
+        started = self.loop.time()
+        self.clearing = self.loop.run_in_executor(self.clearing_executor, closing.batch_process)
+        self.clearing.add_done_callback(lambda _: self.metrics['batch_clearing'].record(self.loop.time() - started))
+        return self.clearing
+
+    async def merge_batch(self, timestamp):
+        '''
+        Once the batch clearing is done, merge the orders the fresh book took meanwhile back behind its residuals,
+        send the fills, stamped as the batch closed, and the PostBatch, stamped at timestamp, and handle the
+        messages deferred for the batch.
+        '''
+        closing = self.clearing_book
+        if closing is None:
+            return
+        try:
+            crossed_orders, clearing_price = await self.clearing
+        finally:
+            if self.clearing_book is closing:
+                bbo = closing.bbo
+                closing.merge_batch(self.order_book)
+                self.order_book = closing
+                self.clearing_book = None
+                self.clearing = None
+                self.clearing_ids = frozenset()
+        if self.order_book is not closing:
+            log.debug('Book reset while batch %s cleared, batch dropped', closing.batch_number - 1)
+            return
+        self.post_batch(crossed_orders, clearing_price, bbo, self.clearing_timestamp, timestamp)
+        deferred, self.deferred = self.deferred, []
+        for handler in deferred:
+            handler()
+        self.settle_orders()
+        await self.send_outgoing_messages()
+        await self.send_outgoing_broadcast_messages()
+
+    def batch_message(self, event_code, timestamp):
+        '''the journal record of the close or the merge of a batch: a SystemStart with event_code, from BATCH'''
+        message = OuchClientMessages.SystemStart(timestamp = timestamp, event_code = event_code)
+        message.meta = BATCH
+        return message
+
+    def journal_batch(self, event_code, timestamp):
+        if self.journal is not None:
+            self.journal.append_batch([self.batch_message(event_code, timestamp)], timestamp)
+
+    async def run_batch_buffered(self):
+        '''close the batch and merge it once it is cleared, as run_batch_close and the merge it posts do'''
+        timestamp = self.clock()
+        self.journal_batch(BATCH_CLOSE, timestamp)
+        await self.run_batch_merge(self.close_batch(timestamp))
+
+    async def run_batch_close(self):
+        '''
+        The batch timer's event: close the batch, merging the last one first if it is still clearing, and have
+        the engine merge this one once it is cleared. Closes and merges are journaled with the timestamps they
+        are stamped with, for replays to run the batches just as they ran here.
+        '''
+        await self.run_batch_merge()
+        timestamp = self.clock()
+        self.journal_batch(BATCH_CLOSE, timestamp)
+        clearing = self.close_batch(timestamp)
+        clearing.add_done_callback(lambda _: self.post_event(partial(self.run_batch_merge, clearing)))
+
+    async def run_batch_merge(self, clearing = None):
+        '''
+        Merge the batch of clearing, a future close_batch returned, once it is cleared, unless it has been merged
+        already or dropped by a reset; by default the batch clearing now, if one is.
+        '''
+        clearing = self.clearing if clearing is None else clearing
+        if clearing is None:
+            return
+        await asyncio.wait([clearing])
+        if clearing is not self.clearing:
+            return
+        timestamp = self.clock()
+        self.journal_batch(BATCH_MERGE, timestamp)
+        await self.merge_batch(timestamp)
+
+    async def process_batch_events(self, messages, timestamp):
+        '''
+        Close and merge batches as the journal records of messages say, at timestamp. Replays and warm starts
+        run batches by this, from the records run_batch_close and run_batch_merge journaled, rather than by
+        the batch timer; a batch whose merge was not journaled is merged by the timer's first close.
+        '''
+        for message in messages:
+            if message['event_code'] == BATCH_CLOSE:
+                self.close_batch(timestamp)
+            else:
+                await self.merge_batch(timestamp)
+
     async def run_batch_repeating(self):
+        '''the batch timer: has the engine close a batch now and at every multiple of interval of the loop's clock'''
+        timer_drift = self.metrics['timer_drift']
+        boundary = math.floor(self.loop.time() / self.interval)
         while True:
-            self.run_batch_atomic()
-            await self.send_outgoing_messages()
-            await self.send_outgoing_broadcast_messages()
-            await asyncio.sleep(self.interval - (self.loop.time() % self.interval))
\ No newline at end of file
+            self.post_event(self.run_batch_close)
+            # boundaries are counted, as the loop may wake a little early, or late enough to have missed some
+            boundary = max(boundary + 1, math.floor(self.loop.time() / self.interval) + 1)
+            wake_time = boundary * self.interval
+            await asyncio.sleep(wake_time - self.loop.time())
+            timer_drift.record(self.loop.time() - wake_time)
+
+    def in_clearing_batch(self, order_token):
+        return self.tokens.id_of(order_token) in self.clearing_ids
+
+    def cancel_order_atomic(self, cancel_order_message, timestamp, reason=b'U'):
+        if self.in_clearing_batch(cancel_order_message['order_token']):
+            self.deferred.append(partial(self.cancel_order_atomic, cancel_order_message, timestamp, reason))
+        else:
+            super().cancel_order_atomic(cancel_order_message, timestamp, reason)
+
+    def replace_order_atomic(self, replace_order_message, timestamp):
+        if self.in_clearing_batch(replace_order_message['existing_order_token']):
+            self.deferred.append(partial(self.replace_order_atomic, replace_order_message, timestamp))
+        else:
+            return super().replace_order_atomic(replace_order_message, timestamp)
+
+    def expire_orders(self, order_ids, timestamp):
+        if not self.clearing_ids:
+            return super().expire_orders(order_ids, timestamp)
+        frozen = [order_id for order_id in order_ids if order_id in self.clearing_ids]
+        if frozen:
+            self.deferred.append(partial(self.expire_orders, frozen, timestamp))
+        super().expire_orders([order_id for order_id in order_ids if order_id not in self.clearing_ids], timestamp)
+
+    def can_snapshot(self):
+        # the book is split between the batch clearing and the next one until they merge
+        return self.clearing_book is None
+
+    def system_start_atomic(self, system_event_message, timestamp):
+        # the batch being cleared belongs to the session being ended
+        self.clearing_book = None
+        self.clearing = None
+        self.clearing_ids = frozenset()
+        self.deferred.clear()
+        super().system_start_atomic(system_event_message, timestamp)
+
+    async def process_message(self, message, timestamp = None):
+        if self.clearing_book is None:
+            return await super().process_message(message, timestamp)
+        started = self.loop.time()
+        result = await super().process_message(message, timestamp)
+        self.metrics['intake_during_clearing'].record(self.loop.time() - started)
+        return result
+
+    async def process_messages(self, messages, timestamp = None):
+        if self.clearing_book is None:
+            return await super().process_messages(messages, timestamp)
+        started = self.loop.time()
+        await super().process_messages(messages, timestamp)
+        self.metrics['intake_during_clearing'].record(self.loop.time() - started)
@@ -1,8 +1,8 @@
-import asyncio
 import logging as log
+from collections import deque
 from functools import partial
-from exchange.exchange import Exchange
-from OuchServer.ouch_server import nanoseconds_since_midnight
+from exchange.exchange import Exchange, client_message
+from OuchServer.metrics import Metrics
 from OuchServer.ouch_messages import OuchClientMessages, OuchServerMessages
 from .order_books.cda_book import MIN_BID, MAX_ASK
 
@@ -16,28 +16,98 @@ class IEXExchange(Exchange):
     def __init__(self, delay, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.delay = delay
+        self.delay_line = deque()       # (release time, message, timestamp) of delayed messages, in arrival order
+        self.release_timer = None       # TimerHandle for the release of the head of delay_line, until it is released
+        self.metrics = Metrics()        # delay_line_depth (messages) and release_lag (seconds)
         self.previous_peg_state = 0
         self.handlers.update({
             OuchClientMessages.ExternalFeedChange: self.external_feed_change,
         })
     
-    async def process_message(self, message):
+    async def process_message(self, message, timestamp = None):
         if message.message_type not in self.handlers:
             log.error("Unknown message type %s", message.message_type)
             return False
         log.debug('Processing message %s', message)
 
         if message.message_type in self.delayed_message_types:
-            self.loop.call_later(self.delay, self._process_message, message)
+            release_time = self.loop.time() + self.delay
+            # stamped as due out of the speed bump, rather than as whenever the timer gets to it
+            if timestamp is None:
+                timestamp = self.clock()
+            self.delay_line.append((release_time, message, timestamp + int(self.delay * 1e9)))
+            if self.release_timer is None:
+                self.release_timer = self.loop.call_at(release_time, self.post_event, self.release_delayed_messages)
         else:
-            self._process_message(message)
+            await self._process_message(message, timestamp)
 
-    def _process_message(self, message):
-        """actually process a message. called, possibly after a delay, by process_message"""
-        timestamp = nanoseconds_since_midnight()
+    async def process_messages(self, messages, timestamp = None):
+        # orders go through the speed bump one at a time; replies are sent as they are released
+        for message in messages:
+            await self.process_message(message, timestamp)
+
+    async def _process_message(self, message, timestamp = None):
+        """actually process a message not held in the speed bump. called by process_message"""
+        self.handle_message(message, timestamp)
+        await self.send_outgoing_messages()
+        await self.send_outgoing_broadcast_messages()
+
+    def handle_message(self, message, timestamp = None):
+        if timestamp is None:
+            timestamp = self.clock()
         self.handlers[message.message_type](message, timestamp)
-        asyncio.ensure_future(self.send_outgoing_messages())
-        asyncio.ensure_future(self.send_outgoing_broadcast_messages())
+        self.settle_orders()
+
+    async def release_delayed_messages(self):
+        """
+        the event of the speed bump's one timer: process every delayed message that is due, in arrival
+        order, send the replies once, and re-arm for the next message in the delay line
+        """
+        now = self.loop.time()
+        delay_line = self.delay_line
+        self.metrics['delay_line_depth'].record(len(delay_line))
+        release_lag = self.metrics['release_lag']
+        try:
+            while delay_line and delay_line[0][0] <= now:
+                (release_time, message, timestamp) = delay_line.popleft()
+                release_lag.record(now - release_time)
+                self.handle_message(message, timestamp)
+        finally:
+            if delay_line:
+                self.release_timer = self.loop.call_at(delay_line[0][0], self.post_event,
+                                                       self.release_delayed_messages)
+            else:
+                self.release_timer = None
+        await self.send_outgoing_messages()
+        await self.send_outgoing_broadcast_messages()
+
+    def snapshot_state(self):
+        '''as Exchange.snapshot_state, with the peg state last sent and the messages still in the speed bump'''
+        state = super().snapshot_state()
+        now = self.loop.time()
+        state['previous_peg_state'] = self.previous_peg_state
+        state['delay_line'] = [(release_time - now, bytes(message), getattr(message, 'meta', None), timestamp)
+            for (release_time, message, timestamp) in self.delay_line]
+        return state
+
+    def detach_owners(self):
+        '''as Exchange.detach_owners, for the messages still in the speed bump too'''
+        super().detach_owners()
+        for (_, message, _) in self.delay_line:
+            message.meta = None
+
+    def restore_state(self, state):
+        super().restore_state(state)
+        self.previous_peg_state = state['previous_peg_state']
+        if self.release_timer is not None:
+            self.release_timer.cancel()
+            self.release_timer = None
+        now = self.loop.time()
+        self.delay_line = deque((now + max(delay, 0), client_message(data, meta), timestamp)
+            for (delay, data, meta, timestamp) in state['delay_line'])
+        if self.delay_line:
+            self.release_timer = self.loop.call_at(self.delay_line[0][0], self.post_event,
+                                                   self.release_delayed_messages)
 
     def external_feed_change(self, message, timestamp):
         if message['e_best_bid'] == MIN_BID or message['e_best_offer'] >= MAX_ASK:
@@ -56,32 +126,35 @@ class IEXExchange(Exchange):
 
     # kind of a bummer that so much of this has to be repeated, but I can't think of a better way
     def enter_order_atomic(self, enter_order_message, timestamp, executed_quantity = 0):
-        order_stored = self.order_store.store_order( 
-            id = enter_order_message['order_token'], 
-            message = enter_order_message, 
-            executed_quantity = executed_quantity)
-        if not order_stored:
-            log.debug('Order already stored with id %s, order ignored', enter_order_message['order_token'])
+        order_token = enter_order_message['order_token']
+        if order_token in self.tokens:
+            log.debug('Order already stored with id %s, order ignored', order_token)
             return []
         else:
+            order_id = self.tokens.intern(order_token)
+            self.order_store.store_order( 
+                id = order_id, 
+                message = enter_order_message, 
+                executed_quantity = executed_quantity)
             time_in_force = enter_order_message['time_in_force']
             enter_into_book = True if time_in_force > 0 else False    
             if time_in_force > 0 and time_in_force < 99998:     #schedule a cancellation at some point in the future
-                cancel_order_message = self.cancel_order_from_enter_order( enter_order_message )
-                self.loop.call_later(time_in_force, partial(self.cancel_order_atomic, cancel_order_message, timestamp))
+                self.expiries.schedule(order_id, time_in_force)
             
             enter_order_func = self.order_book.enter_buy if enter_order_message['buy_sell_indicator'] == b'B' else self.order_book.enter_sell
             (crossed_orders, entered_order, new_bbo) = enter_order_func(
-                    enter_order_message['order_token'],
+                    order_id,
                     enter_order_message['price'],
                     enter_order_message['shares'],
                     enter_into_book,
-                    enter_order_message['midpoint_peg'])
+                    enter_order_message['midpoint_peg'],
+                    entry_time = timestamp)
             log.debug("Resulting book: %s", self.order_book)
             m=self.accepted_from_enter(enter_order_message, 
                 order_reference_number=next(self.order_ref_numbers),
                 timestamp=timestamp)
-            self.order_store.add_to_order(m['order_token'], m)
+            self.order_store.add_to_order(order_id, m)
+            self.touched_orders.append(order_id)
             self.outgoing_messages.append(m)
             cross_messages = [m for ((id, fulfilling_order_id), price, volume) in crossed_orders 
                                 for m in self.process_cross(id, fulfilling_order_id, price, volume, timestamp=timestamp)]
@@ -92,89 +165,88 @@ class IEXExchange(Exchange):
             self.check_for_peg_update(timestamp)
 
     def cancel_order_atomic(self, cancel_order_message, timestamp, reason=b'U'):
-        if cancel_order_message['order_token'] not in self.order_store.orders:
+        order_id = self.tokens.id_of(cancel_order_message['order_token'])
+        if order_id not in self.order_store.orders:
            log.debug(f"No such order to cancel, ignored. Token to cancel: {cancel_order_message['order_token']}")
         else:
-            store_entry = self.order_store.orders[cancel_order_message['order_token']]
-            original_enter_message = store_entry.original_enter_message
+            store_entry = self.order_store.orders[order_id]
             cancelled_orders, new_bbo = self.order_book.cancel_order(
-                order_id = cancel_order_message['order_token'],
-                price = store_entry.first_message['price'],
-                volume = cancel_order_message['shares'],
-                buy_sell_indicator = original_enter_message['buy_sell_indicator'],
-                midpoint_peg = original_enter_message['midpoint_peg'])
-            cancel_messages = [ self.order_cancelled_from_cancel(original_enter_message, timestamp, amount_canceled, reason, order_token= cancel_order_message['order_token'])
+                order_id = order_id,
+                volume = cancel_order_message['shares'])
+            cancel_messages = [ self.order_cancelled_from_cancel(store_entry, timestamp, amount_canceled, reason, order_token= cancel_order_message['order_token'])
                         for (id, amount_canceled) in cancelled_orders ]
+            for (id, amount_canceled) in cancelled_orders:
+                self.order_store.cancel_quantity(id, amount_canceled)
+                self.touched_orders.append(id)
 
             self.outgoing_messages.extend(cancel_messages) 
             log.debug("Resulting book: %s", self.order_book)
             if new_bbo:
                 bbo_message = self.best_quote_update(cancel_order_message, new_bbo, timestamp)
                 self.outgoing_broadcast_messages.append(bbo_message)
-            if original_enter_message['midpoint_peg']:
+            if store_entry.midpoint_peg:
                 self.send_peg_state_update(timestamp)
 
     # replace for iex is a little weird, right now it maintains the litness of any replaced order.
     # it doesn't really make sense to replace a pegged order at all for our implementation, so this should work fine.
     # however, if different peg points are added later this may need to be rethought
     def replace_order_atomic(self, replace_order_message, timestamp):
-        if replace_order_message['existing_order_token'] not in self.order_store.orders:
+        existing_id = self.tokens.id_of(replace_order_message['existing_order_token'])
+        if existing_id not in self.order_store.orders:
             log.debug('Existing token %s unknown, siliently ignoring', replace_order_message['existing_order_token'])
             return []
-        elif replace_order_message['replacement_order_token'] in self.order_store.orders:
+        elif replace_order_message['replacement_order_token'] in self.tokens:
             log.debug('Replacement token %s unknown, siliently ignoring', replace_order_message['existing_order_token'])
             return []
         else:
-            store_entry = self.order_store.orders[replace_order_message['existing_order_token']]
-            original_enter_message = store_entry.original_enter_message
+            store_entry = self.order_store.orders[existing_id]
             log.debug('store_entry: %s', store_entry)
             cancelled_orders, new_bbo_post_cancel = self.order_book.cancel_order(
-                order_id = replace_order_message['existing_order_token'],
-                price = store_entry.first_message['price'],
-                volume = 0,
-                buy_sell_indicator = original_enter_message['buy_sell_indicator'],
-                midpoint_peg=original_enter_message['midpoint_peg'])  # Fully cancel
+                order_id = existing_id,
+                volume = 0)  # Fully cancel
             
             if len(cancelled_orders)==0:
                 log.debug('No orders cancelled, siliently ignoring')
                 return []
             else:
                 (id_cancelled, amount_cancelled) = cancelled_orders[0]
-                first_message = store_entry.first_message
-                shares_diff = replace_order_message['shares'] - first_message['shares'] 
+                self.order_store.cancel_quantity(id_cancelled, amount_cancelled)
+                self.touched_orders.append(id_cancelled)
+                shares_diff = replace_order_message['shares'] - store_entry.shares
                 liable_shares = max(0, amount_cancelled + shares_diff )
                 if liable_shares == 0:
                     log.debug('No remaining liable shares on the book to replace')
                     #send cancel
                 else:
+                    replacement_id = self.tokens.intern(replace_order_message['replacement_order_token'])
                     self.order_store.store_order(
-                            id = replace_order_message['replacement_order_token'], 
+                            id = replacement_id, 
                             message = replace_order_message,
-                            original_enter_message = original_enter_message)
+                            original = store_entry)
                     time_in_force = replace_order_message['time_in_force']
                     enter_into_book = True if time_in_force > 0 else False    
                     if time_in_force > 0 and time_in_force < 99998:     #schedule a cancellation at some point in the future
-                        cancel_order_message = self.cancel_order_from_replace_order( replace_order_message )
-                        self.loop.call_later(time_in_force, partial(self.cancel_order_atomic, cancel_order_message, timestamp))
+                        self.expiries.schedule(replacement_id, time_in_force)
                     
-                    enter_order_func = self.order_book.enter_buy if original_enter_message['buy_sell_indicator'] == b'B' else self.order_book.enter_sell
+                    enter_order_func = self.order_book.enter_buy if store_entry.side == b'B' else self.order_book.enter_sell
                     crossed_orders, entered_order, new_bbo_post_enter = enter_order_func(
-                            replace_order_message['replacement_order_token'],
+                            replacement_id,
                             replace_order_message['price'],
                             liable_shares,
                             enter_into_book,
-                            midpoint_peg=original_enter_message['midpoint_peg'])
+                            midpoint_peg=store_entry.midpoint_peg,
+                            entry_time = timestamp)
                     log.debug("Resulting book: %s", self.order_book)
 
                     r = OuchServerMessages.Replaced(
                             timestamp=timestamp,
                             replacement_order_token = replace_order_message['replacement_order_token'],
-                            buy_sell_indicator=original_enter_message['buy_sell_indicator'],
+                            buy_sell_indicator=store_entry.side,
                             shares=liable_shares,
-                            stock=original_enter_message['stock'],
+                            stock=store_entry.stock,
                             price=replace_order_message['price'],
                             time_in_force=replace_order_message['time_in_force'],
-                            firm=original_enter_message['firm'],
+                            firm=store_entry.firm,
                             display=replace_order_message['display'],
                             order_reference_number=next(self.order_ref_numbers), 
                             capacity=b'*',
@@ -184,11 +256,12 @@ class IEXExchange(Exchange):
                             order_state=b'L' if entered_order is not None else b'D',
                             previous_order_token=replace_order_message['existing_order_token'],
                             bbo_weight_indicator=b'*',
-                            midpoint_peg=original_enter_message['midpoint_peg']
+                            midpoint_peg=store_entry.midpoint_peg
                             )
                     r.meta = replace_order_message.meta
                     self.outgoing_messages.append(r)
-                    self.order_store.add_to_order(r['replacement_order_token'], r)        
+                    self.order_store.add_to_order(replacement_id, r)        
+                    self.touched_orders.append(replacement_id)
                     cross_messages = [m for ((id, fulfilling_order_id), price, volume) in crossed_orders 
                                         for m in self.process_cross(id, 
                                                     fulfilling_order_id, 
@@ -208,6 +281,10 @@ class IEXExchange(Exchange):
                         self.outgoing_broadcast_messages.append(bbo_message)
                     self.check_for_peg_update(timestamp)
     
+    def expire_orders(self, order_ids, timestamp):
+        super().expire_orders(order_ids, timestamp)
+        self.check_for_peg_update(timestamp)
+
     # compares book's peg state against exchange's peg state, sending an update
     # if a change is seen
     def check_for_peg_update(self, timestamp):
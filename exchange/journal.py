@@ -0,0 +1,224 @@
+import os
+import glob
+import mmap
+import time
+import struct
+import logging as log
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from OuchServer.metrics import Metrics
+
+RECORD_HEADER = struct.Struct('<QqqH')  # sequence number, timestamp, client token, message length
+NO_CLIENT = -1  # client token recorded for a message without one
+BROADCAST = -2  # client token recorded for a message sent to every client, in an output journal
+EXPIRY = -3     # client token recorded for an order whose time in force ran out, in an inbound journal
+BATCH = -4      # client token recorded for the close or the merge of an FBA batch, in an inbound journal
+
+JournalRecord = namedtuple('JournalRecord', ['sequence', 'timestamp', 'client_token', 'data'])
+
+
+def segment_path(path, index):
+    return '{}.{:06d}'.format(path, index)
+
+def segment_indices(path):
+    '''indices of the segments of the journal at path, in order'''
+    indices = []
+    for name in glob.glob(glob.escape(path) + '.*'):
+        suffix = name[len(path) + 1:]
+        if suffix.isdigit():
+            indices.append(int(suffix))
+    return sorted(indices)
+
+def read_segment(name):
+    '''the records of one segment file, up to its end marker'''
+    with open(name, 'rb') as f:
+        data = f.read()
+    view = memoryview(data)
+    offset = 0
+    end = len(data) - RECORD_HEADER.size
+    while offset <= end:
+        (sequence, timestamp, client_token, length) = RECORD_HEADER.unpack_from(data, offset)
+        if sequence == 0:
+            break
+        offset += RECORD_HEADER.size
+        if offset + length > len(data):
+            log.error('Journal segment %s ends inside record %d', name, sequence)
+            break
+        yield JournalRecord(sequence, timestamp, None if client_token == NO_CLIENT else client_token,
+            bytes(view[offset:offset + length]))
+        offset += length
+
+def read_journal(path, after = 0):
+    '''
+    The records of the journal at path in sequence order, those numbered after `after` only
+    '''
+    for index in segment_indices(path):
+        for record in read_segment(segment_path(path, index)):
+            if record.sequence > after:
+                yield record
+
+
+class Segment:
+    '''One preallocated journal file, mapped into memory'''
+    def __init__(self, name, size):
+        self.name = name
+        self.file = open(name, 'w+b')
+        try:
+            os.posix_fallocate(self.file.fileno(), 0, size)
+        except (AttributeError, OSError):
+            self.file.truncate(size)
+        self.map = mmap.mmap(self.file.fileno(), size)
+        self.size = size
+
+    def close(self):
+        self.map.flush()
+        self.map.close()
+        self.file.close()
+
+
+class Journal:
+    '''
+    Write-ahead journal of the inbound messages the exchange handles, in the order it handles them, with
+    the client token of each, the timestamp the exchange stamped it with and a sequence number counting up
+    from 1. Time in force expiries are recorded among them as CancelOrder messages under EXPIRY, and the
+    closes and merges of FBA batches as SystemStart messages under BATCH. An
+    OutputJournal keeps one of the outgoing messages the same way.
+
+    Records are appended to preallocated segment files <path>.000000, <path>.000001... mapped into memory,
+    so appending one costs a copy into the map. Group commit flushes the map to disk commit_interval
+    seconds after the first record not yet flushed; commit_interval 0 flushes after every append_batch and
+    None leaves writing back to the OS. Flushing and closing full segments happen on the journal's own
+    thread, and the next segment is prepared on another as soon as the last is taken, so neither commits
+    nor rolling over hold up matching. Should a segment fill up before the next is ready, one is allocated
+    on the spot instead, timed in metrics['allocate'].
+
+    A record is RECORD_HEADER followed by the message bytes, header included. Segments are zero filled,
+    so a zero sequence number marks the end of the records in one. A journal reopened at the same path
+    starts a new segment and carries on numbering after its last record.
+    '''
+    def __init__(self, path, loop, segment_size = 64 << 20, commit_interval = 0.01):
+        self.path = path
+        self.loop = loop
+        self.segment_size = segment_size
+        self.commit_interval = commit_interval
+        self.io = ThreadPoolExecutor(max_workers = 1)   # runs flushes and segment closes one at a time, in order
+        self.preparer = ThreadPoolExecutor(max_workers = 1)     # allocates the next segment
+        self.metrics = Metrics()    # allocate: seconds spent allocating a segment the preparer had not finished
+        self.abandoned = []     # futures of segments the preparer was still allocating when they were needed
+        self.commit_handle = None   # TimerHandle of the next group commit, while records wait for one
+        indices = segment_indices(path)
+        self.sequence = self.last_sequence(indices)
+        self.segment_index = indices[-1] + 1 if indices else 0
+        self.segment = Segment(segment_path(path, self.segment_index), segment_size)
+        self.position = 0
+        self.next_segment = self.preparer.submit(Segment, segment_path(path, self.segment_index + 1), segment_size)
+
+    def last_sequence(self, indices):
+        for index in reversed(indices):
+            last = 0
+            for record in read_segment(segment_path(self.path, index)):
+                last = record.sequence
+            if last:
+                return last
+        return 0
+
+    def append(self, message, client_token, timestamp):
+        '''
+        Record message, from or to client_token, stamped at timestamp. Returns its sequence number.
+        '''
+        data = message.raw
+        length = len(data)
+        end = self.position + RECORD_HEADER.size + length
+        if end > self.segment.size:
+            self.roll()
+            end = RECORD_HEADER.size + length
+        self.sequence += 1
+        segment_map = self.segment.map
+        RECORD_HEADER.pack_into(segment_map, self.position, self.sequence, timestamp,
+            NO_CLIENT if client_token is None else client_token, length)
+        segment_map[end - length:end] = data
+        self.position = end
+        return self.sequence
+
+    def append_batch(self, messages, timestamp):
+        '''record a batch of messages stamped at timestamp, each from the client its meta names'''
+        for message in messages:
+            self.append(message, message.meta, timestamp)
+        self.schedule_commit()
+
+    def schedule_commit(self):
+        if self.commit_interval is None or self.commit_handle is not None:
+            return
+        if self.commit_interval == 0:
+            self.commit()
+        else:
+            self.commit_handle = self.loop.call_later(self.commit_interval, self.commit)
+
+    def commit(self):
+        '''flush what has been appended to disk, on the journal's thread'''
+        self.commit_handle = None
+        self.io.submit(self.segment.map.flush)
+
+    def roll(self):
+        '''
+        carry on in the next segment, closing the full one on the journal's thread, or in one allocated here
+        if the preparer has yet to finish it
+        '''
+        full = self.segment
+        index = self.segment_index + 1
+        if self.next_segment.done():
+            self.segment = self.next_segment.result()
+        else:
+            started = time.perf_counter()
+            if not self.next_segment.cancel():
+                # the preparer is busy with it: the segment it gives is left empty, and removed on close
+                self.abandoned.append(self.next_segment)
+                index += 1
+            log.warning('Journal segment not prepared in time, allocating segment %d', index)
+            self.segment = Segment(segment_path(self.path, index), self.segment_size)
+            self.metrics['allocate'].record(time.perf_counter() - started)
+        self.segment_index = index
+        self.position = 0
+        self.io.submit(full.close)
+        self.next_segment = self.preparer.submit(Segment, segment_path(self.path, self.segment_index + 1),
+            self.segment_size)
+
+    def close(self):
+        if self.commit_handle is not None:
+            self.commit_handle.cancel()
+            self.commit_handle = None
+        self.io.submit(self.segment.close)
+        for unused in self.abandoned + [self.next_segment]:
+            unused = unused.result()
+            unused.close()
+            os.remove(unused.name)
+        self.abandoned = []
+        self.preparer.shutdown(wait = True)
+        self.io.shutdown(wait = True)
+
+
+class OutputJournal:
+    '''
+    Stands between the exchange and the server's order_reply_batch and message_broadcast_batch, recording
+    every outgoing message in a Journal before passing it on: replies under the client token they go to,
+    broadcasts under BROADCAST. A replay checks what it sends against this.
+    '''
+    def __init__(self, journal, order_reply_batch, message_broadcast_batch, clock):
+        self.journal = journal
+        self.send_replies = order_reply_batch
+        self.send_broadcasts = message_broadcast_batch
+        self.clock = clock
+
+    async def order_reply_batch(self, messages):
+        timestamp = self.clock()
+        for message in messages:
+            self.journal.append(message, message.meta, timestamp)
+        self.journal.schedule_commit()
+        await self.send_replies(messages)
+
+    async def message_broadcast_batch(self, messages):
+        timestamp = self.clock()
+        for message in messages:
+            self.journal.append(message, BROADCAST, timestamp)
+        self.journal.schedule_commit()
+        await self.send_broadcasts(messages)
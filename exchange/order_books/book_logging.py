@@ -7,10 +7,10 @@ class BookLogger():
 
     def book_to_dict(self, book, order_store):
         return {'Bids':[{'price':b.price, 
-                        'orders':[(id, q) for (id,q) in b.order_q.items()] } 
+                        'orders':[(id, q) for (id,q) in b.items()] } 
                     for b in book.bids.ascending_items()], 
                 'Asks':[{'price':a.price, 
-                        'orders':[(id, q) for (id,q) in a.order_q.items()]} 
+                        'orders':[(id, q) for (id,q) in a.items()]} 
                 for a in book.asks.ascending_items()]} 
 
     def log_book(self, book, timestamp, order_store):
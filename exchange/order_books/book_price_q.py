@@ -1,54 +1,216 @@
 import logging as log
-from collections import OrderedDict
 
 
+class OrderRecord:
+	'''
+	A resting order, linked intrusively into the FIFO of its price level.
+	'''
+	__slots__ = ('token', 'shares', 'owner', 'entry_time', 'batch_number', 'level', 'prev', 'next')
+
+	def __init__(self):
+		self.token = None
+		self.shares = 0
+		self.owner = None
+		self.entry_time = None
+		self.batch_number = None
+		self.level = None
+		self.prev = None
+		self.next = None
+
+	def __repr__(self):
+		return '<order {}: {}>'.format(self.token, self.shares)
+
+class OrderRecordPool:
+	'''
+	Free list of OrderRecords, chained through their next pointers, so that orders entering and leaving
+	the book reuse records instead of allocating new ones.
+	'''
+	def __init__(self):
+		self.free = None
+		self.allocated = 0	#records ever created by this pool
+
+	def acquire(self, token, shares, owner = None, entry_time = None):
+		record = self.free
+		if record is None:
+			record = OrderRecord()
+			self.allocated += 1
+		else:
+			self.free = record.next
+		record.token = token
+		record.shares = shares
+		record.owner = owner
+		record.entry_time = entry_time
+		record.prev = None
+		record.next = None
+		return record
+
+	def release(self, record):
+		record.token = None
+		record.owner = None
+		record.level = None
+		record.prev = None
+		record.next = self.free
+		self.free = record
+
 class BookPriceQ:
-	def __init__(self, price):
+	def __init__(self, price, side = None, order_index = None, pool = None):
+		'''
+		side - b'B' or b'S', the side of the book this level belongs to
+		order_index - order id -> OrderRecord dict shared by every level of a book; the level keeps
+			the entries of its own resting orders up to date
+		pool - OrderRecordPool the level takes its records from
+		'''
 		self.interest = 0 	#sum of interest at this price
-		self.order_q = OrderedDict()
+		self.head = None	#oldest order
+		self.tail = None	#newest order
+		self.count = 0		#number of orders
 		self.price = price
-	
+		self.side = side
+		self.order_index = order_index if order_index is not None else {}
+		self.pool = pool if pool is not None else OrderRecordPool()
+
 	def __str__(self):
 		return '${} Interest: {}, Orders: {}'.format(
 			self.price, self.interest, ', '.join(
-					['{}: {}'.format(id, volume) for (id, volume) 
-					 in self.order_q.items()]))
+					['{}: {}'.format(id, volume) for (id, volume)
+					 in self.items()]))
+
+	def __len__(self):
+		return self.count
+
+	def __iter__(self):
+		record = self.head
+		while record is not None:
+			yield record.token
+			record = record.next
+
+	def __contains__(self, order_id):
+		record = self.order_index.get(order_id)
+		return record is not None and record.level is self
+
+	def __getitem__(self, order_id):
+		record = self.order_index.get(order_id)
+		if record is None or record.level is not self:
+			raise KeyError(order_id)
+		return record.shares
+
+	def reset(self):
+		'''empty the level so it can be reused at the same price'''
+		self.interest = 0
+		self.head = None
+		self.tail = None
+		self.count = 0
+
+	def items(self):
+		'''(order_id, volume) pairs, oldest first'''
+		record = self.head
+		while record is not None:
+			yield (record.token, record.shares)
+			record = record.next
+
+	def append_record(self, record):
+		record.level = self
+		record.prev = self.tail
+		record.next = None
+		if self.tail is None:
+			self.head = record
+		else:
+			self.tail.next = record
+		self.tail = record
+		self.count += 1
+		self.interest += record.shares
+		self.order_index[record.token] = record
+
+	def insert_record_before(self, record, successor):
+		'''link record in front of successor, which must be in this level'''
+		record.level = self
+		record.next = successor
+		record.prev = successor.prev
+		if successor.prev is None:
+			self.head = record
+		else:
+			successor.prev.next = record
+		successor.prev = record
+		self.count += 1
+		self.interest += record.shares
+		self.order_index[record.token] = record
+
+	def remove_record(self, record):
+		'''unlink record, drop it from the index and give it back to the pool'''
+		if record.prev is None:
+			self.head = record.next
+		else:
+			record.prev.next = record.next
+		if record.next is None:
+			self.tail = record.prev
+		else:
+			record.next.prev = record.prev
+		self.count -= 1
+		self.interest -= record.shares
+		del self.order_index[record.token]
+		self.pool.release(record)
+
+	def snapshot(self):
+		'''
+		The level as plain data for a book snapshot: (price, orders), each order an
+		(id, shares, owner, entry_time, batch_number) tuple, oldest first
+		'''
+		orders = []
+		record = self.head
+		while record is not None:
+			orders.append((record.token, record.shares, record.owner, record.entry_time, record.batch_number))
+			record = record.next
+		return (self.price, orders)
+
+	def restore(self, level_state):
+		'''queue the orders of a snapshot() of a level at this price, in the same order'''
+		(_, orders) = level_state[:2]
+		for (order_id, shares, owner, entry_time, batch_number) in orders:
+			record = self.pool.acquire(order_id, shares, owner, entry_time)
+			record.batch_number = batch_number
+			self.append_record(record)
 
-	def add_order(self, order_id, volume):
-		self.interest += volume
-		self.order_q[order_id] = volume
+	def add_order(self, order_id, volume, owner = None, entry_time = None):
+		self.append_record(self.pool.acquire(order_id, volume, owner, entry_time))
 
 	def cancel_order(self, order_id):
-		self.interest -= self.order_q[order_id]
-		del self.order_q[order_id]
+		self.remove_record(self.order_index[order_id])
 
 	def reduce_order(self, order_id, new_volume):
-		volume = self.order_q[order_id]
+		record = self.order_index[order_id]
+		volume = record.shares
 		assert new_volume <= volume
-		self.order_q[order_id] = new_volume
+		record.shares = new_volume
 		self.interest -= (volume - new_volume)
 
 	def fill_order(self, volume):
 		'''
-		For a given order volume to fill, dequeue's the oldest orders 
-		at this price point to be used to fill the order. 
+		For a given order volume to fill, dequeue's the oldest orders
+		at this price point to be used to fill the order.
 
 		Returns a tuple giving the volume filled at this price, and a list of (order_id, order_volume) pairs giving the order volume amount filled from each order in the book.
 		'''
 		volume_to_fill = volume
 		fulfilling_orders = []
-		while volume_to_fill > 0 and len(self.order_q)>0:
-			next_order_id = next(iter(self.order_q))
-			next_order_volume = self.order_q[next_order_id]
+		record = self.head
+		while volume_to_fill > 0 and record is not None:
+			next_order_volume = record.shares
 			if next_order_volume > volume_to_fill:
-				assert self.order_q[next_order_id] ==next_order_volume
-				self.order_q[next_order_id] = next_order_volume-volume_to_fill
-				fulfilling_orders.append((next_order_id, volume_to_fill))
-				self.interest -= volume_to_fill	
-				volume_to_fill = 0			
+				record.shares = next_order_volume - volume_to_fill
+				fulfilling_orders.append((record.token, volume_to_fill))
+				volume_to_fill = 0
 			else:
 				volume_to_fill -= next_order_volume
-				fulfilling_orders.append(self.order_q.popitem(last=False))
-				log.info(self.order_q.values())
-				self.interest -= next_order_volume
+				fulfilling_orders.append((record.token, next_order_volume))
+				self.count -= 1
+				del self.order_index[record.token]
+				filled_record = record
+				record = record.next
+				self.pool.release(filled_record)
+		self.head = record
+		if record is None:
+			self.tail = None
+		else:
+			record.prev = None
+		self.interest -= volume - volume_to_fill
 		return (volume - volume_to_fill, fulfilling_orders)
@@ -1,8 +1,8 @@
 import sys
 from collections import OrderedDict
 import logging as log
-from exchange.order_books.book_price_q import BookPriceQ
-from exchange.order_books.list_elements import SortedIndexedDefaultList
+from exchange.order_books.book_price_q import BookPriceQ, OrderRecordPool
+from exchange.order_books.list_elements import BisectIndexedDefaultList, LevelCache
 from collections import namedtuple
 
 MIN_BID = 0
@@ -11,16 +11,28 @@ MAX_ASK = 2147483647
 bbo = namedtuple('BestQuotes', 'best_bid volume_at_best_bid best_ask volume_at_best_ask next_bid next_ask')
 
 class CDABook:
-	def __init__(self):
+	def __init__(self, ladder = BisectIndexedDefaultList, level_cache_size = 128):
+		'''
+		ladder - price ladder class (or partial) used for both sides of the book, e.g.
+			partial(DenseIndexedDefaultList, min_index=0, max_index=1000) for a bounded price band
+		level_cache_size - emptied price levels kept per side for reuse, 0 to always build new ones
+		'''
+		self.ladder = ladder
+		self.level_cache_size = level_cache_size
 		self.bid = MIN_BID
 		self.ask = MAX_ASK
-		self.bids = SortedIndexedDefaultList(index_func = lambda bq: bq.price, 
-							initializer = lambda p: BookPriceQ(p),
-							index_multiplier = -1)
-		self.asks = SortedIndexedDefaultList(index_func = lambda bq: bq.price, 
-							initializer = lambda p: BookPriceQ(p))
+		self.order_index = {}	#order id -> resting OrderRecord, kept up to date by the levels
+		self.record_pool = OrderRecordPool()
+		self.bids = ladder(index_func = lambda bq: bq.price, 
+							initializer = lambda p: BookPriceQ(p, b'B', self.order_index, self.record_pool),
+							index_multiplier = -1,
+							level_cache = LevelCache(level_cache_size) if level_cache_size else None)
+		self.asks = ladder(index_func = lambda bq: bq.price, 
+							initializer = lambda p: BookPriceQ(p, b'S', self.order_index, self.record_pool),
+							level_cache = LevelCache(level_cache_size) if level_cache_size else None)
 		self.bbo = bbo(best_bid=MIN_BID, volume_at_best_bid=0, best_ask=MAX_ASK,
 			volume_at_best_ask=0, next_bid=MIN_BID, next_ask=MAX_ASK)
+		self.defer_bbo = False	#set while a batch is entered: only bid/ask are kept current, bbo is built at the end
 
 	def __str__(self):
 		return """  Spread: {} - {}
@@ -40,32 +52,59 @@ class CDABook:
     #             	self.bids.remove(id)
 
 	def reset_book(self):
-		self.__init__()	# I dont see a reason not to do this.
+		self.__init__(self.ladder, self.level_cache_size)	# I dont see a reason not to do this.
+
+	def level_cache_stats(self):
+		'''LevelCache counters per side, or None when level caching is off'''
+		if not self.level_cache_size:
+			return None
+		return {'bids': self.bids.level_cache.stats(), 'asks': self.asks.level_cache.stats()}
 
-	def cancel_order(self, id, price, volume, buy_sell_indicator):
+	def snapshot_state(self):
+		'''
+		The book as plain data, for a snapshot: the snapshot() of each level per side, best price first,
+		and the last best quotes
+		'''
+		return {'bids': [price_q.snapshot() for price_q in self.bids.ascending_items()],
+				'asks': [price_q.snapshot() for price_q in self.asks.ascending_items()],
+				'bbo': tuple(self.bbo)}
+
+	def restore_state(self, state):
+		'''empty the book and fill it from snapshot_state, every level in the same queue order'''
+		self.reset_book()
+		for (side, levels) in ((self.bids, state['bids']), (self.asks, state['asks'])):
+			for level_state in levels:
+				side[level_state[0]].restore(level_state)
+		self.update_bid()
+		self.update_ask()
+		self.bbo = bbo(*state['bbo'])
+
+	def __contains__(self, id):
+		return id in self.order_index
+
+	def cancel_order(self, id, price = None, volume = 0, buy_sell_indicator = None):
 		'''
 		Cancel all or part of an order. Volume refers to the desired remaining shares to be executed: if it is 0, the order is
 		fully cancelled, otherwise an order of volume volume remains.
+		The order is found by its id alone; price and buy_sell_indicator are accepted for backwards compatibility and ignored.
 		'''
-		orders = self.bids if buy_sell_indicator == b'B' else self.asks
-		if price not in orders or id not in orders[price].order_q:
-			log.debug('-----------------------------------------------')
-			log.debug('No order in the book to cancel, cancel ignored.')
-			log.debug(f'Token to cancel: {id}. Price: {price}.')
-			log.debug(f'active tokens: {orders[price].order_q}.')
-			log.debug(f'active orders: {orders}')
-			log.debug('-----------------------------------------------')
+		record = self.order_index.get(id)
+		if record is None:
+			log.debug('No order in the book to cancel, cancel ignored. Token to cancel: %s', id)
 			return [], None
 		else:
+			price_q = record.level
+			orders = self.bids if price_q.side == b'B' else self.asks
+			price = price_q.price
 			amount_canceled=0
-			current_volume=orders[price].order_q[id]
+			current_volume=record.shares
 			if volume==0: 										#fully cancel
-				orders[price].cancel_order(id)
+				price_q.remove_record(record)
 				amount_canceled = current_volume
-				if orders[price].interest == 0:
+				if price_q.interest == 0:
 					orders.remove(price)
 			elif current_volume >= volume:
-				orders[price].reduce_order(id, volume)		
+				price_q.reduce_order(id, volume)		
 				amount_canceled = current_volume - volume
 			else:
 				amount_canceled = 0
@@ -79,15 +118,19 @@ class CDABook:
 			
 
 	def update_bid(self):
-		if self.bids.start is None:
+		start = self.bids.start
+		if self.defer_bbo:
+			self.bid = MIN_BID if start is None else start.data.price
+			return None
+		if start is None:
 			self.bid = MIN_BID
 			best_bid, vol_bid = MIN_BID, 0 
 			next_bid = MIN_BID
 		else:
-			self.bid = self.bids.start.data.price
-			best_bid, vol_bid = self.bids.start.data.price, self.bids.start.data.interest
+			self.bid = start.data.price
+			best_bid, vol_bid = start.data.price, start.data.interest
 			try:
-				next_bid = self.bids.start.next.data.price
+				next_bid = start.next.data.price
 			except:
 				next_bid = MIN_BID
 		best_ask, vol_ask, next_ask = self.bbo.best_ask, self.bbo.volume_at_best_ask, self.bbo.next_ask
@@ -100,15 +143,19 @@ class CDABook:
 		#	self.bid -= self.decrement
 
 	def update_ask(self):
-		if self.asks.start is None:
+		start = self.asks.start
+		if self.defer_bbo:
+			self.ask = MAX_ASK if start is None else start.data.price
+			return None
+		if start is None:
 			self.ask = MAX_ASK
 			best_ask, vol_ask = MAX_ASK, 0
 			next_ask = MAX_ASK
 		else:
-			self.ask = self.asks.start.data.price
-			best_ask, vol_ask = self.asks.start.data.price, self.asks.start.data.interest
+			self.ask = start.data.price
+			best_ask, vol_ask = start.data.price, start.data.interest
 			try:
-				next_ask = self.asks.start.next.data.price
+				next_ask = start.next.data.price
 			except:
 				next_ask = MAX_ASK
 		best_bid, vol_bid, next_bid = self.bbo.best_bid, self.bbo.volume_at_best_bid, self.bbo.next_bid
@@ -120,7 +167,51 @@ class CDABook:
 		#while self.price_q[self.ask].interest == 0 and self.ask < self.max_price:
 		#	self.ask += self.decrement		
 
-	def enter_buy(self, id, price, volume, enter_into_book):
+	def flush_bbo(self, old_bbo):
+		'''
+		Rebuild the bbo after a batch entered with defer_bbo set; returns it if it differs from old_bbo, else None
+		'''
+		self.update_bid()
+		self.update_ask()
+		return self.bbo if self.bbo != old_bbo else None
+
+	def enter_orders(self, orders):
+		'''
+		Enter a batch of orders in sequence, each matched as by enter_buy/enter_sell, building the bbo only once at the end.
+		orders - iterable of (id, buy_sell_indicator, price, volume, enter_into_book) tuples; any further fields are
+		passed on to enter_buy/enter_sell, e.g. IEXBook's midpoint_peg
+		Returns the crosses of the whole batch, in order, and the new bbo if the batch changed it.
+		'''
+		crossed_orders = []
+		old_bbo = self.bbo
+		self.defer_bbo = True
+		try:
+			for order in orders:
+				enter_order_func = self.enter_buy if order[1] == b'B' else self.enter_sell
+				(order_crosses, entered_order, _) = enter_order_func(order[0], *order[2:])
+				crossed_orders.extend(order_crosses)
+		finally:
+			self.defer_bbo = False
+		return crossed_orders, self.flush_bbo(old_bbo)
+
+	def cancel_orders(self, orders):
+		'''
+		Cancel a batch of orders as by cancel_order, building the bbo only once at the end.
+		orders - iterable of (id, volume) tuples, volume being the shares to leave in the book
+		Returns the (id, amount_canceled) pairs of the orders found in the book, and the new bbo if the batch changed it.
+		'''
+		cancelled = []
+		old_bbo = self.bbo
+		self.defer_bbo = True
+		try:
+			for (id, volume) in orders:
+				(order_cancels, _) = self.cancel_order(id, volume = volume)
+				cancelled.extend(order_cancels)
+		finally:
+			self.defer_bbo = False
+		return cancelled, self.flush_bbo(old_bbo)
+
+	def enter_buy(self, id, price, volume, enter_into_book, owner = None, entry_time = None):
 		'''
 		Enter a limit order to buy at price price: first, try and fulfill as much as possible, then enter a
 		'''
@@ -147,12 +238,12 @@ class CDABook:
 
 
 		if volume_to_fill > 0 and enter_into_book:
-			self.bids[price].add_order(id, volume_to_fill)
+			self.bids[price].add_order(id, volume_to_fill, owner, entry_time)
 			bbo_update = self.update_bid()
 			entered_order = (id, price, volume_to_fill)
 		return (order_crosses, entered_order, bbo_update) 
 
-	def enter_sell(self, id, price, volume, enter_into_book):
+	def enter_sell(self, id, price, volume, enter_into_book, owner = None, entry_time = None):
 		'''
 		Enter a limit order to sell at price price: first try and fulfill as much as possible, then enter the
 		remaining as a limit sell
@@ -179,7 +270,7 @@ class CDABook:
 					break					
 			
 		if volume_to_fill > 0 and enter_into_book:
-			self.asks[price].add_order(id, volume_to_fill)
+			self.asks[price].add_order(id, volume_to_fill, owner, entry_time)
 			bbo_update = self.update_ask()
 			entered_order = (id, price, volume_to_fill)
 		return (order_crosses, entered_order, bbo_update) 
@@ -1,9 +1,11 @@
 from exchange.order_books.fba_book_price_q import FBABookPriceQ
-from exchange.order_books.list_elements import SortedIndexedDefaultList
+from exchange.order_books.book_price_q import OrderRecordPool
+from exchange.order_books.list_elements import BisectIndexedDefaultList, LevelCache
+from exchange.order_books.volume_curves import VolumeCurves
 import heapq
-import math
 import logging as log
 from itertools import count
+from random import Random
 
 MIN_BID = 0
 MAX_ASK = 2147483647
@@ -51,13 +53,36 @@ def merge(ait, bit, key):
                 return
 
 class FBABook:
-    def __init__(self):
-        self.bids = SortedIndexedDefaultList(index_func = lambda bq: bq.price, 
-                            initializer = lambda p: FBABookPriceQ(p),
-                            index_multiplier = -1)
-        self.asks = SortedIndexedDefaultList(index_func = lambda bq: bq.price, 
-                            initializer = lambda p: FBABookPriceQ(p))
-        self.batch_counter = count(1, 1)
+    def __init__(self, ladder = BisectIndexedDefaultList, level_cache_size = 128, batch_engine = None,
+            shuffle_seed = None):
+        '''
+        batch_engine - clears batches in place of batch_process' own matching when given, e.g. a NumpyBatchEngine
+        shuffle_seed - when given, orders of a batch queue at their level in arrival order and each level's
+            batch is shuffled once when the batch closes, from a Random seeded with it, so that the order of
+            a batch is reproducible. Otherwise every order is placed at random as it arrives.
+        '''
+        self.ladder = ladder
+        self.level_cache_size = level_cache_size
+        self.batch_engine = batch_engine
+        self.shuffle_seed = shuffle_seed
+        if shuffle_seed is None:
+            self.shuffle_rng = self.unshuffled = None
+        else:
+            self.shuffle_rng = Random(shuffle_seed)
+            self.unshuffled = {}    # levels with orders of this batch still in arrival order
+        self.order_index = {}   # order id -> resting OrderRecord, kept up to date by the levels
+        self.record_pool = OrderRecordPool()
+        self.curves = VolumeCurves()    # bid and ask volume by price, kept up to date by the levels
+        self.bids = ladder(index_func = lambda bq: bq.price, 
+                            initializer = lambda p: FBABookPriceQ(p, b'B', self.order_index, self.record_pool,
+                                curves = self.curves, unshuffled = self.unshuffled),
+                            index_multiplier = -1,
+                            level_cache = LevelCache(level_cache_size) if level_cache_size else None)
+        self.asks = ladder(index_func = lambda bq: bq.price, 
+                            initializer = lambda p: FBABookPriceQ(p, b'S', self.order_index, self.record_pool,
+                                curves = self.curves, unshuffled = self.unshuffled),
+                            level_cache = LevelCache(level_cache_size) if level_cache_size else None)
+        self.batch_counter = count(2)    # numbers of the batches after the first
         self.batch_number = 1
 
     def __str__(self):
@@ -69,7 +94,7 @@ class FBABook:
 {}""".format(self.bids, self.asks)
 
     def reset_book(self):						#jason
-        self.__init__()     # I can't see anything wrong with this
+        self.__init__(self.ladder, self.level_cache_size, self.batch_engine, self.shuffle_seed)     # I can't see anything wrong with this
         # log.debug('Clearing All Entries from Order Book')
         # self.bid = MIN_BID
         # self.ask = MAX_ASK
@@ -78,153 +103,184 @@ class FBABook:
         # for id in list(self.bids.index):
         #             self.bids.remove(id)
 
+    def level_cache_stats(self):
+        '''LevelCache counters per side, or None when level caching is off'''
+        if not self.level_cache_size:
+            return None
+        return {'bids': self.bids.level_cache.stats(), 'asks': self.asks.level_cache.stats()}
+
     @property
     def bbo(self):
-        best_bid = self.bids.start.data.price if self.bids.start else MIN_BID
-        best_ask = self.asks.start.data.price if self.asks.start else MAX_ASK
+        bids_start, asks_start = self.bids.start, self.asks.start
+        best_bid = bids_start.data.price if bids_start else MIN_BID
+        best_ask = asks_start.data.price if asks_start else MAX_ASK
         try:
-            next_bid = self.bids.start.next.data.price
+            bids_next = bids_start.next
+            next_bid = bids_next.data.price
         except AttributeError:
             next_bid = MIN_BID
             volume_at_best_bid = 0
         else:
-            volume_at_best_bid = self.bids.start.next.data.interest
+            volume_at_best_bid = bids_next.data.interest
         try:
-            next_ask = self.asks.start.next.data.price
+            asks_next = asks_start.next
+            next_ask = asks_next.data.price
         except AttributeError:
             next_ask = MAX_ASK
             volume_at_best_ask = 0
         else:
-            volume_at_best_ask = self.asks.start.next.data.interest
+            volume_at_best_ask = asks_next.data.interest
         return best_bid, best_ask, next_bid, next_ask, volume_at_best_bid, volume_at_best_ask
 
 
-    def cancel_order(self, id, price, volume, buy_sell_indicator):
+    def snapshot_state(self):
+        '''
+        The book as plain data, for a snapshot: the snapshot() of each level per side, batch markers
+        included, the number of the open batch, and with a shuffle seed the state of the shuffle and the
+        levels still to be shuffled at the close
+        '''
+        return {'bids': [price_q.snapshot() for price_q in self.bids.ascending_items()],
+                'asks': [price_q.snapshot() for price_q in self.asks.ascending_items()],
+                'batch_number': self.batch_number,
+                'shuffle_rng': self.shuffle_rng.getstate() if self.shuffle_rng is not None else None,
+                'unshuffled': [(price_q.side, price_q.price) for price_q in self.unshuffled]
+                    if self.unshuffled is not None else None}
+
+    def restore_state(self, state):
+        '''empty the book and fill it from snapshot_state, every level in the same queue order'''
+        self.reset_book()
+        for (side, levels) in ((self.bids, state['bids']), (self.asks, state['asks'])):
+            for level_state in levels:
+                side[level_state[0]].restore(level_state)
+        self.batch_number = state['batch_number']
+        self.batch_counter = count(self.batch_number + 1)
+        if self.shuffle_rng is not None and state['shuffle_rng'] is not None:
+            self.shuffle_rng.setstate(state['shuffle_rng'])
+            for (side, price) in state['unshuffled']:
+                self.unshuffled[(self.bids if side == b'B' else self.asks)[price]] = None
+
+    def __contains__(self, id):
+        return id in self.order_index
+
+    def cancel_order(self, id, price = None, volume = 0, buy_sell_indicator = None):
         '''
         Cancel all or part of an order. Volume refers to the desired remaining shares to be executed: if it is 0, the order is
         fully cancelled, otherwise an order of volume volume remains.
+        The order is found by its id alone; price and buy_sell_indicator are accepted for backwards compatibility and ignored.
         '''
-        orders = self.bids if buy_sell_indicator == b'B' else self.asks
-        
-        if price not in orders or id not in orders[price].order_q:
+        record = self.order_index.get(id)
+        if record is None:
             log.debug('No order in the book to cancel, cancel ignored.')
             return [], None
         else:
+            price_q = record.level
+            orders = self.bids if price_q.side == b'B' else self.asks
             amount_canceled = 0
-            current_volume, _ = orders[price].order_q[id]
+            current_volume = record.shares
             if volume == 0:
-                current_batch_number = self.batch_number
-                orders[price].cancel_order(id, current_batch_number)
+                price_q.remove_record(record)
                 amount_canceled = current_volume
-                if orders[price].interest == 0:
-                    orders.remove(price)
+                if price_q.interest == 0:
+                    orders.remove(price_q.price)
             elif volume < current_volume:
-                orders[price].reduce_order(id, volume)      
+                price_q.reduce_order(id, volume)      
                 amount_canceled = current_volume - volume
             else:
                 amount_canceled = 0
 
             return [(id, amount_canceled)], None
 
-    def enter_buy(self, id, price, volume, enter_into_book = True):
+    def enter_buy(self, id, price, volume, enter_into_book = True, owner = None, entry_time = None):
         '''
         Enter a limit order to buy at price price: do NOT try and match
         '''
         if enter_into_book:
             current_batch_number = self.batch_number
-            self.bids[price].add_order(id, volume, current_batch_number)
+            self.bids[price].add_order(id, volume, current_batch_number, owner, entry_time)
             entered_order = (id, price, volume)
             return ([], entered_order, None)
         else:
             return ([], None, None)
 
-    def enter_sell(self, id, price, volume, enter_into_book):
+    def enter_sell(self, id, price, volume, enter_into_book, owner = None, entry_time = None):
         '''
         Enter a limit order to sell at price price: do NOT try and match
         '''
         if enter_into_book:
             current_batch_number = self.batch_number
-            self.asks[price].add_order(id, volume, current_batch_number)
+            self.asks[price].add_order(id, volume, current_batch_number, owner, entry_time)
             entered_order = (id, price, volume)
             return ([], entered_order, None) 
         else:
             return ([], None, None)
 
-    def batch_process(self):
-        log.debug('Running batch auction..')
-        log.debug('order book=%s', self)
-        asks_volume = sum([price_book.interest for price_book in self.asks.ascending_items()])
-        log.debug('total volume offered in batch: %d', asks_volume)
-        all_orders_descending = merge(
-            self.asks.descending_items(),
-            self.bids.ascending_items(), 
-            key= lambda bpq: -bpq.price)
-        log.debug('ask prices=%s:%s, \n bid prices=%s:%s', 
-            [(p.price, p.interest) for p in self.asks.ascending_items()],
-            [(p.price, p.interest) for p in self.asks.descending_items()], 
-            [(p.price, p.interest) for p in self.bids.ascending_items()],
-            [(p.price, p.interest) for p in self.bids.descending_items()])
-        assert len([p.price for p in self.asks.descending_items()])==len([p.price for p in self.asks.ascending_items()]) 
-        orders_volume = prior_orders_volume = 0
-        clearing_price=None
-        log.debug('calculating clearing price..')
-        bpq=prior_bpq=None
-
-        min_real_price = None
-        max_real_price = None
+    def enter_orders(self, orders):
+        '''
+        Enter a batch of orders as by enter_buy/enter_sell; nothing matches until the batch auction runs.
+        orders - iterable of (id, buy_sell_indicator, price, volume, enter_into_book) tuples, optionally
+        followed by owner and entry_time, as for CDABook.enter_orders
+        Returns no crosses and no bbo update, like enter_buy/enter_sell.
+        '''
+        for order in orders:
+            enter_order_func = self.enter_buy if order[1] == b'B' else self.enter_sell
+            enter_order_func(order[0], *order[2:])
+        return [], None
 
-        log.debug('all orders descending: %s', [(b.price,b.interest) for b in merge(
-            self.asks.descending_items(),
-            self.bids.ascending_items(), 
-            key= lambda bpq: -bpq.price)])
-        
-        for bpq in all_orders_descending:
-            #update min/max prices
-            if MIN_BID<bpq.price<MAX_ASK:
-                if max_real_price is None or max_real_price < bpq.price:
-                    max_real_price = bpq.price
-                if min_real_price is None or bpq.price<min_real_price:
-                    min_real_price = bpq.price
-            #process and deal with volumes
-            prior_orders_volume = orders_volume
-            orders_volume += bpq.interest
-            log.debug('  checking price %s, vol %s/%s', bpq.price, orders_volume, asks_volume)
-            if orders_volume > asks_volume:
-                break
-            prior_bpq=bpq
+    def cancel_orders(self, orders):
+        '''
+        Cancel a batch of orders as by cancel_order.
+        orders - iterable of (id, volume) tuples, volume being the shares to leave in the book
+        '''
+        cancelled = []
+        for (id, volume) in orders:
+            (order_cancels, _) = self.cancel_order(id, volume = volume)
+            cancelled.extend(order_cancels)
+        return cancelled, None
 
-        #if bpq.price is still at MAX_ASK, loop until price is less than max_ask and use that price
-        if bpq is not None and bpq.price==MAX_ASK:
-            for bpq in all_orders_descending:
-                if max_real_price is None or max_real_price<bpq.price<MAX_ASK:
-                    max_real_price = bpq.price
-                if min_real_price is None or MIN_BID<bpq.price<min_real_price:
-                    min_real_price = bpq.price
-                log.debug(' looping until price <%s: current price:%s', MAX_ASK, bpq.price)
-                if bpq.price<MAX_ASK:
-                    break
+    def freeze(self):
+        '''
+        Close the current batch so that it can be cleared while new orders keep arriving: returns a fresh book
+        with the same settings to take the orders of the next batch in the meantime. Nothing but batch_process
+        may touch this book until merge_batch brings those orders back.
+        '''
+        next_book = FBABook(self.ladder, self.level_cache_size, self.batch_engine, self.shuffle_seed)
+        next_book.batch_number = self.batch_number + 1
+        return next_book
 
-        #If prior_orders_volume exactly hit asks and loop was able to continue, price is averaged, otherwise its the first price that pushed over limit.
-        if max_real_price is None and min_real_price is None:
-            clearing_price = None #no real prices - can't match if all bids/offers are market orders
-        elif prior_orders_volume==asks_volume and prior_bpq is not None:
-            if prior_bpq.price==MAX_ASK and MIN_BID<bpq.price<MAX_ASK:
-                clearing_price=bpq.price
-                log.debug(' clearing price set as bpq: {} -> {}'.format(bpq.price, clearing_price))
-            elif prior_bpq.price<MAX_ASK and MIN_BID<bpq.price:
-                clearing_price = math.ceil((prior_bpq.price+bpq.price)/2)
-                log.debug(' clearing price is the average of {} and {} -> {}'.format(prior_bpq.price, bpq.price, clearing_price))
-            elif MIN_BID<prior_bpq.price<MAX_ASK and MIN_BID==bpq.price:
-                clearing_price=prior_bpq.price
-                log.debug(' clearing price set as prior bpq: {} -> {}'.format(prior_bpq.price, clearing_price))
-            elif prior_bpq.price==MIN_BID:
-                clearing_price=min_real_price
-                log.debug(' clearing price set as min real price: {}'.format(clearing_price))
-        elif orders_volume>asks_volume:
-            clearing_price = max(bpq.price, min_real_price)
-            log.debug(' clearing price set as max of bpq and min real price: {}:{} -> {}'.format(bpq.price, min_real_price, clearing_price))
+    def merge_batch(self, next_book):
+        '''
+        After batch_process, take in the orders next_book (from freeze) received while the batch cleared, in its
+        order, as orders of the batch now open, behind the orders resting here at each price.
+        '''
+        batch_number = self.batch_number
+        for (book_side, next_side) in ((self.bids, next_book.bids), (self.asks, next_book.asks)):
+            for next_q in next_side.ascending_items():
+                price_q = book_side[next_q.price]
+                record = next_q.head
+                while record is not None:
+                    price_q.add_order(record.token, record.shares, batch_number, record.owner, record.entry_time)
+                    record = record.next
 
+    def shuffle_batches(self):
+        '''
+        shuffle the orders of the closing batch at every level that received some, level by level in
+        price order so that the draws do not depend on the order the levels were first used in
+        '''
+        if self.unshuffled:
+            for price_q in sorted(self.unshuffled, key = lambda price_q: (price_q.side, price_q.price)):
+                price_q.shuffle_batch(self.shuffle_rng)
+            self.unshuffled.clear()
 
+    def batch_process(self):
+        log.debug('Running batch auction..')
+        self.shuffle_batches()
+        log.debug('order book=%s', self)
+        log.debug('total volume offered in batch: %d', self.curves.asks_volume)
+        if self.batch_engine is not None:
+            (matches, clearing_price) = self.batch_engine.clear(self)
+            self.batch_number = next(self.batch_counter)
+            return matches, clearing_price or 0
+        clearing_price = self.curves.clearing_price()
 
         log.debug('market clears @ %s', clearing_price)
 
@@ -244,13 +300,13 @@ class FBABook:
                         log.debug('no cross at {}'.format(ask_price))
                         break
                     else:
-                        for (bid_id, (volume, _)) in list(bid_node.order_q.items()):
+                        for (bid_id, volume) in list(bid_node.items()):
                             volume_filled = 0
                             log.debug('      process bid {} with volume {}.'.format(bid_id, volume))
                             while volume_filled < volume and ask_price <= clearing_price:
                                 (filled, fulfilling_orders) = ask_node.fill_order(volume-volume_filled)
                                 volume_filled += filled
-                                matches.extend([((bid_id, ask_id), clearing_price, volume) for (ask_id, (volume, _)) in fulfilling_orders])
+                                matches.extend([((bid_id, ask_id), clearing_price, volume) for (ask_id, volume) in fulfilling_orders])
                                 log.debug('      all matching orders at node {}'.format(matches))
                                 if ask_node.interest == 0:
                                     log.debug('   no more interest at ask node, removing...')
@@ -267,8 +323,7 @@ class FBABook:
                             assert volume_filled<=volume
                             if volume_filled==volume:
                                 log.debug('      bid {} is filled completely {}/{}.'.format(bid_id, volume_filled, volume))
-                                current_batch_number = self.batch_number
-                                bid_node.cancel_order(bid_id, current_batch_number)
+                                bid_node.cancel_order(bid_id)
                                 if bid_node.interest == 0:
                                     log.debug('    no more interest at bid node, removing...')
                                     self.bids.remove(bid_node.price)
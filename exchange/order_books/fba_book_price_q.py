@@ -1,58 +1,142 @@
-from exchange.order_books.book_price_q import BookPriceQ   
+from exchange.order_books.book_price_q import BookPriceQ
 from random import randint
 from itertools import count
 import logging as log
 
 class FBABookPriceQ(BookPriceQ):
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, curves = None, unshuffled = None, **kwargs):
+        '''
+        curves - VolumeCurves of the book, told of every change in interest at this level
+        unshuffled - when given, orders of the current batch are queued in arrival order and the level
+            adds itself to this dict, for the book to shuffle them all at once when the batch closes.
+            Otherwise each order is placed at random among its batch as it arrives.
+        '''
         super().__init__(*args, **kwargs)
         self.current_batch_number = 0
-        self.batch_marker = 0
-    
-    def add_order(self, order_id, volume, order_batch_number):
-        self.interest += volume
-        self.order_q[order_id] = (volume, order_batch_number)
-        if self.current_batch_number == order_batch_number:
-            batch_start_index = self.batch_marker
-            batch_end_index = len(self.order_q) - 1
-            random_index = randint(batch_start_index, batch_end_index)
-            rest_of_batch = list(self.order_q.keys())[random_index : -1]
-            if rest_of_batch:
-                for o in rest_of_batch:
-                    self.order_q.move_to_end(o)
+        self.batch_start = None     # first order of the current batch at this level
+        self.batch_size = 0         # orders of the current batch at this level
+        self.curves = curves
+        self.unshuffled = unshuffled
+
+    def reset(self):
+        super().reset()
+        self.current_batch_number = 0
+        self.batch_start = None
+        self.batch_size = 0
+
+    def snapshot(self):
+        '''
+        As BookPriceQ.snapshot, followed by the level's batch markers: the number of its current batch, the
+        position in the queue of that batch's first order (None if it has none) and its size
+        '''
+        (price, orders) = super().snapshot()
+        batch_start = None
+        position = 0
+        record = self.head
+        while record is not None:
+            if record is self.batch_start:
+                batch_start = position
+                break
+            position += 1
+            record = record.next
+        return (price, orders, self.current_batch_number, batch_start, self.batch_size)
+
+    def restore(self, level_state):
+        (_, _, current_batch_number, batch_start, batch_size) = level_state
+        super().restore(level_state)
+        if self.curves is not None:
+            self.curves.note(self.side, self.price, self.interest)
+        self.current_batch_number = current_batch_number
+        self.batch_size = batch_size
+        self.batch_start = None
+        if batch_start is not None:
+            record = self.head
+            for _ in range(batch_start):
+                record = record.next
+            self.batch_start = record
+
+    def add_order(self, order_id, volume, order_batch_number, owner = None, entry_time = None):
+        record = self.pool.acquire(order_id, volume, owner, entry_time)
+        record.batch_number = order_batch_number
+        if self.unshuffled is not None:
+            self.append_record(record)
+            if self.current_batch_number == order_batch_number and self.batch_size:
+                self.batch_size += 1
+            else:
+                self.batch_start = record
+                self.batch_size = 1
+                self.current_batch_number = order_batch_number
+            self.unshuffled[self] = None
+        elif self.current_batch_number == order_batch_number:
+            # time priority is random within a batch: the new order takes a uniformly
+            # random position among the orders of its batch
+            position = randint(0, self.batch_size)
+            successor = self.batch_start
+            for _ in range(position):
+                successor = successor.next
+            if successor is None:
+                self.append_record(record)
+            else:
+                self.insert_record_before(record, successor)
+            if position == 0:
+                self.batch_start = record
+            self.batch_size += 1
         else:
-            self.order_q[order_id] = (volume, order_batch_number)
-            self.batch_marker = len(self.order_q) - 1
+            self.append_record(record)
+            self.batch_start = record
+            self.batch_size = 1
             self.current_batch_number = order_batch_number
-        
-    def cancel_order(self, order_id, live_batch_number):
-        volume, order_batch_number = self.order_q[order_id]
-        self.interest -= volume
-        del self.order_q[order_id]
-        if order_batch_number != live_batch_number:
-            self.batch_marker -= 1      
-    
+        if self.curves is not None:
+            self.curves.note(self.side, self.price, volume)
+
+    def shuffle_batch(self, rng):
+        '''
+        Put the orders of the current batch, queued in arrival order at the back of the level, into a
+        uniformly random order with one Fisher-Yates shuffle drawn from rng.
+        '''
+        if self.batch_size < 2:
+            return
+        records = []
+        record = self.batch_start
+        while record is not None:
+            records.append(record)
+            record = record.next
+        rng.shuffle(records)
+        prev = self.batch_start.prev
+        for record in records:
+            record.prev = prev
+            if prev is None:
+                self.head = record
+            else:
+                prev.next = record
+            prev = record
+        prev.next = None
+        self.tail = prev
+        self.batch_start = records[0]
+
+    def remove_record(self, record):
+        if record.batch_number == self.current_batch_number:
+            if record is self.batch_start:
+                self.batch_start = record.next
+            self.batch_size -= 1
+        if self.curves is not None:
+            self.curves.note(self.side, self.price, -record.shares)
+        super().remove_record(record)
+
     def reduce_order(self, order_id, new_volume):
-        volume, _ = self.order_q[order_id]
-        assert new_volume <= volume
-        self.order_q[order_id] = (new_volume, _)
-        self.interest -= (volume - new_volume)
+        volume = self.order_index[order_id].shares
+        super().reduce_order(order_id, new_volume)
+        if self.curves is not None:
+            self.curves.note(self.side, self.price, new_volume - volume)
 
     def fill_order(self, volume):
-        volume_to_fill = volume
-        fulfilling_orders = []
-        while volume_to_fill > 0 and len(self.order_q)>0:
-            next_order_id = next(iter(self.order_q))
-            next_order_volume, _ = self.order_q[next_order_id]
-            if next_order_volume > volume_to_fill:
-                assert self.order_q[next_order_id][0] == next_order_volume
-                self.order_q[next_order_id] = (next_order_volume - volume_to_fill, _)
-                fulfilling_orders.append((next_order_id, volume_to_fill))
-                self.interest -= volume_to_fill	
-                volume_to_fill = 0			
-            else:
-                volume_to_fill -= next_order_volume
-                fulfilling_orders.append(self.order_q.popitem(last=False))
-                self.interest -= next_order_volume
-        return (volume - volume_to_fill, fulfilling_orders)
+        batch_start = self.batch_start
+        filled = super().fill_order(volume)
+        if self.curves is not None:
+            self.curves.note(self.side, self.price, -filled[0])
+        if batch_start is not None and batch_start.level is not self:
+            # fills reached into the current batch, whose remaining orders now start at the head
+            self.batch_start = self.head
+            self.batch_size = self.count
+        return filled
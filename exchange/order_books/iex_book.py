@@ -2,14 +2,86 @@ from collections import OrderedDict
 import logging as log
 from .cda_book import CDABook, bbo
 
+class PeggedQueue:
+    '''
+    Midpoint pegged orders of one side of the book, oldest first, with their total volume kept current.
+    '''
+    def __init__(self):
+        self.orders = OrderedDict()     # order id -> volume
+        self.volume = 0
+
+    def __len__(self):
+        return len(self.orders)
+
+    def __contains__(self, order_id):
+        return order_id in self.orders
+
+    def __getitem__(self, order_id):
+        return self.orders[order_id]
+
+    def items(self):
+        return self.orders.items()
+
+    def append(self, order_id, volume):
+        self.orders[order_id] = volume
+        self.volume += volume
+
+    def remove(self, order_id):
+        '''take an order out of the queue, returning its volume'''
+        volume = self.orders.pop(order_id)
+        self.volume -= volume
+        return volume
+
+    def reduce(self, order_id, new_volume):
+        self.volume -= self.orders[order_id] - new_volume
+        self.orders[order_id] = new_volume
+
+    def fill(self, volume):
+        '''
+        Take up to volume shares from the oldest orders; returns (order_id, volume) pairs for the orders filled.
+        '''
+        volume_to_fill = volume
+        fulfilling_orders = []
+        orders = self.orders
+        while volume_to_fill > 0 and orders:
+            (order_id, order_volume) = next(iter(orders.items()))
+            if order_volume > volume_to_fill:
+                orders[order_id] = order_volume - volume_to_fill
+                fulfilling_orders.append( (order_id, volume_to_fill) )
+                volume_to_fill = 0
+            else:
+                del orders[order_id]
+                fulfilling_orders.append( (order_id, order_volume) )
+                volume_to_fill -= order_volume
+        self.volume -= volume - volume_to_fill
+        return fulfilling_orders
+
+def pair_fills(pegged_fills, level_fills, price):
+    '''
+    Crosses between two lists of (order_id, volume) fills of the same total volume, paired off in order
+    '''
+    order_crosses = []
+    level_iter = iter(level_fills)
+    (level_order_id, level_volume) = (None, 0)
+    for (pegged_order_id, pegged_volume) in pegged_fills:
+        while pegged_volume > 0:
+            if level_volume == 0:
+                (level_order_id, level_volume) = next(level_iter)
+            cross_volume = min(pegged_volume, level_volume)
+            order_crosses.append(((pegged_order_id, level_order_id), price, cross_volume))
+            pegged_volume -= cross_volume
+            level_volume -= cross_volume
+    return order_crosses
+
+
 class IEXBook(CDABook):
 
-    def __init__(self):
-        super().__init__()
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
 
         self.peg_price = None
-        self.pegged_bids = OrderedDict()
-        self.pegged_asks = OrderedDict()
+        self.pegged_bids = PeggedQueue()
+        self.pegged_asks = PeggedQueue()
 
     def __str__(self):
         pegged_bids = '\n'.join(
@@ -30,52 +102,58 @@ Peg Price: ${}
 {}
 """.format(self.bid, self.ask, self.peg_price, self.bids, self.asks, pegged_bids, pegged_asks)
 
+    def snapshot_state(self):
+        '''as CDABook.snapshot_state, with the peg price and the pegged orders of each side, oldest first'''
+        state = super().snapshot_state()
+        state.update(peg_price = self.peg_price,
+                     pegged_bids = list(self.pegged_bids.items()),
+                     pegged_asks = list(self.pegged_asks.items()))
+        return state
+
+    def restore_state(self, state):
+        super().restore_state(state)
+        self.peg_price = state['peg_price']
+        for (order_id, volume) in state['pegged_bids']:
+            self.pegged_bids.append(order_id, volume)
+        for (order_id, volume) in state['pegged_asks']:
+            self.pegged_asks.append(order_id, volume)
+
     # fill `volume`'s worth of pegged orders
     # if `fill_bids` is true, bids are filled. else asks are filled
     def fill_pegged_orders(self, volume, fill_bids):
-        volume_to_fill = volume
-        fulfilling_orders = []
         order_queue = self.pegged_bids if fill_bids else self.pegged_asks
-        while volume_to_fill > 0 and len(order_queue) > 0:
-            (order_id, order_volume) = next(iter(order_queue.items()))
-            if order_volume > volume_to_fill:
-                order_queue[order_id] = order_volume - volume_to_fill
-                fulfilling_orders.append( (order_id, volume_to_fill) )
-                volume_to_fill = 0
-            else:
-                del order_queue[order_id]
-                fulfilling_orders.append( (order_id, order_volume) )
-                volume_to_fill -= order_volume
-        return fulfilling_orders
+        return order_queue.fill(volume)
 
-    def cancel_order(self, order_id, price, volume, buy_sell_indicator, midpoint_peg):
+    def __contains__(self, order_id):
+        return order_id in self.pegged_bids or order_id in self.pegged_asks or super().__contains__(order_id)
+
+    def cancel_order(self, order_id, price = None, volume = 0, buy_sell_indicator = None, midpoint_peg = None):
         '''
         Cancel all or part of an order. Volume refers to the desired remaining shares to be executed: if it is 0, the order is
         fully cancelled, otherwise an order of volume volume remains.
+        The order is found by its id alone, pegged or not; the other arguments are accepted for backwards compatibility and ignored.
         '''
-
-        if midpoint_peg:
-            return self.cancel_pegged_order(order_id, volume, buy_sell_indicator)
+        if order_id in self.pegged_bids or order_id in self.pegged_asks:
+            return self.cancel_pegged_order(order_id, volume)
         else:
-            return super().cancel_order(order_id, price, volume, buy_sell_indicator)
+            return super().cancel_order(order_id, volume = volume)
     
-    def cancel_pegged_order(self, order_id, volume, buy_sell_indicator):
-        order_queue = self.pegged_bids if buy_sell_indicator == b'B' else self.pegged_asks
+    def cancel_pegged_order(self, order_id, volume, buy_sell_indicator = None):
+        order_queue = self.pegged_bids if order_id in self.pegged_bids else self.pegged_asks
         if order_id not in order_queue:
             log.debug('No order in the book to cancel, cancel ignored.')
             return [], None
         
         if volume == 0:
-            amount_canceled = order_queue[order_id]
-            del order_queue[order_id]
+            amount_canceled = order_queue.remove(order_id)
         elif order_queue[order_id] > volume:
             amount_canceled = order_queue[order_id] - volume
-            order_queue[order_id] = volume
+            order_queue.reduce(order_id, volume)
         else:
             amount_canceled = 0
         return [(order_id, amount_canceled)], None
 
-    def enter_buy(self, order_id, price, volume, enter_into_book, midpoint_peg):
+    def enter_buy(self, order_id, price, volume, enter_into_book, midpoint_peg, owner = None, entry_time = None):
         '''
         Enter a limit order to buy at price price: first, try and fulfill as much as possible, then enter if required
         '''
@@ -135,9 +213,9 @@ Peg Price: ${}
 
         if volume_to_fill > 0 and enter_into_book:
             if midpoint_peg:
-                self.pegged_bids[order_id] = volume_to_fill
+                self.pegged_bids.append(order_id, volume_to_fill)
             else:
-                self.bids[price].add_order(order_id, volume_to_fill)
+                self.bids[price].add_order(order_id, volume_to_fill, owner, entry_time)
                 new_bbo = self.update_bid()
                 if new_bbo:
                     bbo_update = new_bbo
@@ -145,7 +223,7 @@ Peg Price: ${}
 
         return (order_crosses, entered_order, bbo_update) 
 
-    def enter_sell(self, order_id, price, volume, enter_into_book, midpoint_peg):
+    def enter_sell(self, order_id, price, volume, enter_into_book, midpoint_peg, owner = None, entry_time = None):
         '''
         Enter a limit order to sell at price price: first, try and fulfill as much as possible, then enter if required
         '''
@@ -206,9 +284,9 @@ Peg Price: ${}
 
         if volume_to_fill > 0 and enter_into_book:
             if midpoint_peg:
-                self.pegged_asks[order_id] = volume_to_fill
+                self.pegged_asks.append(order_id, volume_to_fill)
             else:
-                self.asks[price].add_order(order_id, volume_to_fill)
+                self.asks[price].add_order(order_id, volume_to_fill, owner, entry_time)
                 new_bbo = self.update_ask()
                 if new_bbo:
                     bbo_update = new_bbo
@@ -219,59 +297,30 @@ Peg Price: ${}
     # check whether any pegged bids have crossed with non-pegged asks
     # and return crosses/new bbo if they have
     def check_ask_peg_cross(self):
-        if not len(self.pegged_bids) or not len(self.asks):
-            return ([], None)
-
-        order_crosses = []
-        for price_q in self.asks.ascending_items():
-            if price_q.price > self.peg_price:
-                break
-
-            for (pegged_order_id, pegged_order_volume) in list(self.pegged_bids.items()):
-                (filled, fulfilling_orders) = price_q.fill_order(pegged_order_volume)
-                for (fulfilling_order_id, cross_volume) in fulfilling_orders:
-                    order_crosses.append(((pegged_order_id, fulfilling_order_id), price_q.price, cross_volume))
-
-                self.pegged_bids[pegged_order_id] -= filled
-                # if filling this order used all the peg's volume, remove the peg
-                if self.pegged_bids[pegged_order_id] == 0:
-                    del self.pegged_bids[pegged_order_id]
-                
-            if price_q.interest == 0:
-                self.asks.remove(price_q.price)
-
-        bbo_update = None
-        if len(order_crosses):
-            bbo_update = self.update_ask()
-        return (order_crosses, bbo_update)
+        return self.sweep_pegs(self.pegged_bids, self.asks, lambda price: price <= self.peg_price, self.update_ask)
 
     # check whether any pegged asks have crossed with non-pegged bids
     # and return crosses/new bbo if they have
     def check_bid_peg_cross(self):
-        if not len(self.pegged_asks) or not len(self.bids):
-            return ([], None)
+        return self.sweep_pegs(self.pegged_asks, self.bids, lambda price: price >= self.peg_price, self.update_bid)
 
+    def sweep_pegs(self, pegged_queue, book_side, crosses_peg, update_side):
+        '''
+        Fill the pegged queue against the limit levels of book_side that cross the peg, best first, stopping as
+        soon as either runs out; update_side is called once at the end if anything crossed.
+        '''
         order_crosses = []
-        for price_q in self.bids.ascending_items():
-            if price_q.price < self.peg_price:
+        for price_q in book_side.ascending_items():
+            if pegged_queue.volume == 0 or not crosses_peg(price_q.price):
                 break
-
-            for (pegged_order_id, pegged_order_volume) in list(self.pegged_asks.items()):
-                (filled, fulfilling_orders) = price_q.fill_order(pegged_order_volume)
-                for (fulfilling_order_id, cross_volume) in fulfilling_orders:
-                    order_crosses.append(((pegged_order_id, fulfilling_order_id), price_q.price, cross_volume))
-
-                self.pegged_asks[pegged_order_id] -= filled
-                # if filling this order used all the peg's volume, remove the peg
-                if self.pegged_asks[pegged_order_id] == 0:
-                    del self.pegged_asks[pegged_order_id]
-
+            (filled, fulfilling_orders) = price_q.fill_order(pegged_queue.volume)
+            order_crosses.extend(pair_fills(pegged_queue.fill(filled), fulfilling_orders, price_q.price))
             if price_q.interest == 0:
-                self.bids.remove(price_q.price)
+                book_side.remove(price_q.price)
 
         bbo_update = None
         if len(order_crosses):
-            bbo_update = self.update_bid()
+            bbo_update = update_side()
         return (order_crosses, bbo_update)
 
     # called externally:
@@ -1,4 +1,6 @@
 from collections import OrderedDict
+from bisect import bisect_left, bisect_right
+import sys
 import logging as log
 from .book_price_q import BookPriceQ
 
@@ -12,6 +14,67 @@ class Node:
 	def __repr__(self):
 		return '<node  price:{}, lit:{}>'.format(self.data.price, self.data.lit)
 
+def footprint(obj):
+	'''approximate bytes held by obj and its attribute dict (not by what the attributes refer to)'''
+	size = sys.getsizeof(obj)
+	if hasattr(obj, '__dict__'):
+		size += sys.getsizeof(obj.__dict__)
+	return size
+
+class LevelCache:
+	'''
+	Bounded LRU of emptied price levels, keyed by price. A ladder parks a level here when it is removed and
+	takes it back when the same price is asked for again, instead of building a new node and level through
+	its initializer. Once more than capacity levels are parked the least recently parked one is evicted.
+	'''
+	def __init__(self, capacity = 128):
+		self.capacity = capacity
+		self.parked = OrderedDict()	#price -> parked entry (a Node, or the level itself for dense ladders)
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+
+	def __len__(self):
+		return len(self.parked)
+
+	def park(self, index, entry):
+		if self.capacity <= 0:
+			return
+		self.parked[index] = entry
+		self.parked.move_to_end(index)
+		if len(self.parked) > self.capacity:
+			self.parked.popitem(last = False)
+			self.evictions += 1
+
+	def reuse(self, index):
+		entry = self.parked.pop(index, None)
+		if entry is None:
+			self.misses += 1
+		else:
+			self.hits += 1
+		return entry
+
+	def clear(self):
+		self.parked.clear()
+
+	@property
+	def hit_rate(self):
+		lookups = self.hits + self.misses
+		return self.hits / lookups if lookups else 0.0
+
+	@property
+	def bytes_held(self):
+		total = 0
+		for entry in self.parked.values():
+			total += footprint(entry)
+			if isinstance(entry, Node):
+				total += footprint(entry.data)
+		return total
+
+	def stats(self):
+		return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+				'hit_rate': self.hit_rate, 'parked': len(self.parked), 'bytes_held': self.bytes_held}
+
 class SortedIndexedDefaultList:
 	'''
 	This is an indexable, double-linked linked list with insertions coming always form iteration from the start.
@@ -19,15 +82,17 @@ class SortedIndexedDefaultList:
 	Insert: O(n) - but o(1) to put at front
 	Read: : O(1)
 
-	Retrieving a missing element will spur the creation of the element via the initialized.
+	Retrieving a missing element will spur the creation of the element via the initialized, or its reuse from
+	level_cache (a LevelCache) if one is given: removed elements that are empty get parked there.
 	'''
-	def __init__(self, index_func, initializer, index_multiplier = 1 ):
+	def __init__(self, index_func, initializer, index_multiplier = 1, level_cache = None):
 		self.start = None
 		self.end = None
 		self.index_func = index_func
 		self.index_multiplier = index_multiplier
 		self.index = {}
 		self.initializer = initializer
+		self.level_cache = level_cache
 
 	def __str__(self):
 		return ',\n'.join([str(i) for i in self.ascending_items()])
@@ -37,40 +102,49 @@ class SortedIndexedDefaultList:
 		if id in self.index:
 			raise KeyError
 		else:
-			n=Node(data = data)
-			self.index[id] = n
+			return self._link(id, Node(data = data))
+
+	def _link(self, id, n):
+		n.prev = None	#a reused node still carries its old links
+		n.next = None
+		self.index[id] = n
+
+		if self.start is None:	 #insert into linked list from start
+			self.start = n
+			self.end = n
+			return n.data
+		elif self.index_multiplier*self.index_func(self.start.data) > self.index_multiplier*id: #inserting at start
+			self.start.prev = n
+			n.next = self.start
+			self.start = n
+			return n.data
+		else:
+			current = self.start 
+			while current.next is not None and self.index_multiplier*self.index_func(current.next.data) <= self.index_multiplier*id:
+				current = current.next
 
-			if self.start is None:	 #insert into linked list from start
-				self.start = n
+			if current.next is None: #insert into end of linked list
+				current.next = n
+				n.prev = current
 				self.end = n
-				return n.data
-			elif self.index_multiplier*self.index_func(self.start.data) > self.index_multiplier*id: #inserting at start
-				self.start.prev = n
-				n.next = self.start
-				self.start = n
-				return n.data
-			else:
-				current = self.start 
-				while current.next is not None and self.index_multiplier*self.index_func(current.next.data) <= self.index_multiplier*id:
-					current = current.next
-
-				if current.next is None: #insert into end of linked list
-					current.next = n
-					n.prev = current
-					self.end = n
-					return current.next.data
-				else:					#insert into middle of linked list
-					n.next = current.next
-					n.prev = current
-					current.next.prev = n
-					current.next = n
-					return current.next.data
+				return current.next.data
+			else:					#insert into middle of linked list
+				n.next = current.next
+				n.prev = current
+				current.next.prev = n
+				current.next = n
+				return current.next.data
 
 	def __contains__(self, index):
 		return index in self.index
 
 	def __getitem__(self, index):
 		if index not in self.index:
+			if self.level_cache is not None:
+				node = self.level_cache.reuse(index)
+				if node is not None:
+					node.data.reset()
+					return self._link(index, node)
 			return self.insert(self.initializer(index))
 		else:
 			return self.index[index].data	
@@ -97,6 +171,8 @@ class SortedIndexedDefaultList:
 			next.prev = node.prev
 
 		del self.index[index]
+		if self.level_cache is not None and len(node.data) == 0:
+			self.level_cache.park(index, node)
 
 	def ascending_items(self):
 		current = self.start
@@ -109,3 +185,311 @@ class SortedIndexedDefaultList:
 		while current is not None:
 			yield current.data
 			current = current.prev
+
+class BisectIndexedDefaultList(SortedIndexedDefaultList):
+	'''
+	A SortedIndexedDefaultList that also keeps its (multiplied) keys in a sorted array, so the
+	neighbours of a new element are found by bisection instead of by walking the list from the start.
+	The linked nodes are kept, so start/end/next/prev and iterating while removing behave as before.
+	Delete: O(log n) - plus a memmove of the key array
+	Insert: O(log n) - plus a memmove of the key array
+	Read: : O(1), and the best element is always start
+
+	Retrieving a missing element will spur the creation of the element via the initialized.
+	'''
+	def __init__(self, index_func, initializer, index_multiplier = 1, level_cache = None):
+		super().__init__(index_func, initializer, index_multiplier, level_cache)
+		self.keys = []		#sorted index_multiplier*id of every node
+		self.nodes = []		#nodes, in the same order as keys
+
+	def _link(self, id, n):
+		n.prev = None
+		n.next = None
+		self.index[id] = n
+		key = self.index_multiplier*id
+		pos = bisect_left(self.keys, key)
+		self.keys.insert(pos, key)
+		self.nodes.insert(pos, n)
+		if pos == 0:
+			self.start = n
+		else:
+			n.prev = self.nodes[pos - 1]
+			n.prev.next = n
+		if pos == len(self.nodes) - 1:
+			self.end = n
+		else:
+			n.next = self.nodes[pos + 1]
+			n.next.prev = n
+		return n.data
+
+	def remove(self, index):
+		if index not in self.index:
+			log.debug('node at {} already removed'.format(index))
+			return
+		super().remove(index)
+		pos = bisect_left(self.keys, self.index_multiplier*index)
+		del self.keys[pos]
+		del self.nodes[pos]
+
+
+class DenseNode:
+	'''
+	Node-like handle on an element of a DenseIndexedDefaultList: next and prev are found on demand
+	from the ladder's cursors, or by scanning it past the best two ticks, so the usual start.next.data
+	idiom keeps working.
+	'''
+	__slots__ = ('ladder', 'data')
+
+	def __init__(self, ladder, data):
+		self.ladder = ladder
+		self.data = data
+
+	@property
+	def next(self):
+		return self.ladder._neighbour(self.data, 1)
+
+	@property
+	def prev(self):
+		return self.ladder._neighbour(self.data, -1)
+
+	def __repr__(self):
+		return '<dense node  price:{}>'.format(self.data.price)
+
+class DenseIndexedDefaultList:
+	'''
+	A tick-indexed price ladder for markets that trade in a known band [min_index, max_index]: elements in the
+	band live in a preallocated array indexed by price, with cursors on the two lowest and two highest occupied
+	slots, the way quantcup-orderbook/engine.cpp lays out its price points. Elements outside the band (e.g. MAX_ASK market
+	orders) fall back to a BisectIndexedDefaultList. Iteration order and the start/next contract are the same as
+	SortedIndexedDefaultList.
+	Delete: O(1) - plus a scan over the empty ticks to the next occupied one when one of the two best (or
+		worst) elements is removed
+	Insert: O(1)
+	Read: O(1) for start, end and their neighbours; O(gap) in empty ticks for next and prev elsewhere in the band
+
+	Retrieving a missing element will spur the creation of the element via the initialized, or its reuse from
+	level_cache, which is shared with the sparse fallback.
+	'''
+	def __init__(self, index_func, initializer, index_multiplier = 1, min_index = 0, max_index = 0, level_cache = None):
+		if max_index < min_index:
+			raise ValueError('empty band [{}, {}]'.format(min_index, max_index))
+		self.index_func = index_func
+		self.index_multiplier = index_multiplier
+		self.initializer = initializer
+		self.min_index = min_index
+		self.max_index = max_index
+		self.slots = [None] * (max_index - min_index + 1)
+		self.low = None		#lowest occupied slot
+		self.high = None	#highest occupied slot
+		self.low_next = None	#second lowest occupied slot
+		self.high_next = None	#second highest occupied slot
+		self.count = 0
+		self.step = 1 if index_multiplier > 0 else -1	#slot direction of ascending_items
+		self.level_cache = level_cache
+		self.sparse = BisectIndexedDefaultList(index_func, initializer, index_multiplier, level_cache)
+		#sparse keys up to band_start_key come before the band, keys after band_end_key come after it
+		self.band_start_key = min(index_multiplier*min_index, index_multiplier*max_index)
+		self.band_end_key = max(index_multiplier*min_index, index_multiplier*max_index)
+
+	def __str__(self):
+		return ',\n'.join([str(i) for i in self.ascending_items()])
+
+	def in_band(self, index):
+		return self.min_index <= index <= self.max_index
+
+	def insert(self, data):
+		id = self.index_func(data)
+		if not self.in_band(id):
+			return self.sparse.insert(data)
+		slot = id - self.min_index
+		if self.slots[slot] is not None:
+			raise KeyError
+		self.slots[slot] = data
+		self.count += 1
+		if self.low is None:
+			self.low = self.high = slot
+			return data
+		if slot < self.low:
+			self.low_next = self.low
+			self.low = slot
+		elif self.low_next is None or slot < self.low_next:
+			self.low_next = slot
+		if slot > self.high:
+			self.high_next = self.high
+			self.high = slot
+		elif self.high_next is None or slot > self.high_next:
+			self.high_next = slot
+		return data
+
+	def __contains__(self, index):
+		if self.in_band(index):
+			return self.slots[index - self.min_index] is not None
+		return index in self.sparse
+
+	def __getitem__(self, index):
+		if not self.in_band(index):
+			return self.sparse[index]
+		data = self.slots[index - self.min_index]
+		if data is None:
+			if self.level_cache is not None:
+				data = self.level_cache.reuse(index)
+			if data is None:
+				data = self.initializer(index)
+			else:
+				data.reset()
+			data = self.insert(data)
+		return data
+
+	def __len__(self):
+		return self.count + len(self.sparse)
+
+	def remove(self, index):
+		if not self.in_band(index):
+			return self.sparse.remove(index)
+		slot = index - self.min_index
+		if self.slots[slot] is None:
+			log.debug('node at {} already removed'.format(index))
+			return
+		data = self.slots[slot]
+		self.slots[slot] = None
+		self.count -= 1
+		if self.level_cache is not None and len(data) == 0:
+			self.level_cache.park(index, data)
+		if self.count == 0:
+			self.low = self.high = None
+			return
+		if self.count == 1:
+			self.low = self.high = self.high if slot == self.low else self.low
+			self.low_next = self.high_next = None
+			return
+		#two or more are left, between low and high, so each scan stops on one
+		if slot == self.low:
+			self.low = self.low_next
+			self.low_next = self._scan(self.low + 1, 1)
+		elif slot == self.low_next:
+			self.low_next = self._scan(slot + 1, 1)
+		if slot == self.high:
+			self.high = self.high_next
+			self.high_next = self._scan(self.high - 1, -1)
+		elif slot == self.high_next:
+			self.high_next = self._scan(slot - 1, -1)
+
+	def _scan(self, slot, step):
+		'''the first occupied slot from slot on, stepping by step'''
+		slots = self.slots
+		while slots[slot] is None:
+			slot += step
+		return slot
+
+	def _first_slot(self):
+		return self.low if self.step > 0 else self.high
+
+	def _last_slot(self):
+		return self.high if self.step > 0 else self.low
+
+	def _dense_items(self, step):
+		slots = self.slots
+		slot = self._first_slot() if step == self.step else self._last_slot()
+		#only the far cursor bounds the walk: removing the element just yielded may move the near one past us
+		while self.count and (slot <= self.high if step > 0 else slot >= self.low):
+			data = slots[slot]
+			if data is not None:
+				yield data
+			slot += step
+
+	def _sparse_items(self, node, direction):
+		while node is not None:
+			yield node.data
+			node = node.next if direction > 0 else node.prev
+
+	def _sparse_before_band(self, direction):
+		'''sparse elements preceding the band, walked away from (direction -1) or towards (direction 1) it'''
+		if direction > 0:
+			yield from self._sparse_until(self.sparse.start, self.band_start_key)
+		else:
+			pos = bisect_left(self.sparse.keys, self.band_start_key)
+			if pos:
+				yield from self._sparse_items(self.sparse.nodes[pos - 1], -1)
+
+	def _sparse_after_band(self, direction):
+		'''sparse elements following the band, walked away from (direction 1) or towards (direction -1) it'''
+		keys = self.sparse.keys
+		if direction > 0:
+			pos = bisect_right(keys, self.band_end_key)
+			if pos < len(keys):
+				yield from self._sparse_items(self.sparse.nodes[pos], 1)
+		else:
+			node = self.sparse.end
+			while node is not None and self.index_multiplier*self.index_func(node.data) > self.band_end_key:
+				yield node.data
+				node = node.prev
+
+	def _sparse_until(self, node, key):
+		while node is not None and self.index_multiplier*self.index_func(node.data) < key:
+			yield node.data
+			node = node.next
+
+	def ascending_items(self):
+		yield from self._sparse_before_band(1)
+		yield from self._dense_items(self.step)
+		yield from self._sparse_after_band(1)
+
+	def descending_items(self):
+		yield from self._sparse_after_band(-1)
+		yield from self._dense_items(-self.step)
+		yield from self._sparse_before_band(-1)
+
+	def _neighbour(self, data, direction):
+		'''
+		The node after (direction 1) or before (direction -1) data in ascending order, or None.
+		'''
+		id = self.index_func(data)
+		if self.in_band(id):
+			step = direction*self.step
+			slot = id - self.min_index
+			if slot == (self.low if step > 0 else self.high):
+				#the best two ticks are tracked, so stepping off the best is O(1)
+				slot = self.low_next if step > 0 else self.high_next
+				if slot is not None:
+					return DenseNode(self, self.slots[slot])
+				slot = self.high + 1 if step > 0 else self.low - 1
+			else:
+				slot += step
+			while self.count and (slot <= self.high if step > 0 else slot >= self.low):
+				if self.slots[slot] is not None:
+					return DenseNode(self, self.slots[slot])
+				slot += step
+			following = self._sparse_after_band(1) if direction > 0 else self._sparse_before_band(-1)
+		else:
+			node = self.sparse.index[id]
+			node = node.next if direction > 0 else node.prev
+			key = self.index_multiplier*id
+			crossing_band = key < self.band_start_key if direction > 0 else key > self.band_end_key
+			if crossing_band and self.count and (node is None or
+					(self.index_multiplier*self.index_func(node.data) > self.band_end_key) == (direction > 0)):
+				slot = self._first_slot() if direction > 0 else self._last_slot()
+				return DenseNode(self, self.slots[slot])
+			following = iter(()) if node is None else iter((node.data,))
+		for data in following:
+			return DenseNode(self, data)
+		return None
+
+	@property
+	def start(self):
+		node = self.sparse.start
+		if node is not None and (not self.count
+				or self.index_multiplier*self.index_func(node.data) < self.band_start_key):
+			return DenseNode(self, node.data)
+		if self.count:
+			return DenseNode(self, self.slots[self._first_slot()])
+		return None
+
+	@property
+	def end(self):
+		node = self.sparse.end
+		if node is not None and (not self.count
+				or self.index_multiplier*self.index_func(node.data) > self.band_end_key):
+			return DenseNode(self, node.data)
+		if self.count:
+			return DenseNode(self, self.slots[self._last_slot()])
+		return None
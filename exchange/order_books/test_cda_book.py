@@ -0,0 +1,165 @@
+import pickle
+import unittest
+from functools import partial
+from random import Random
+from exchange.order_books.cda_book import CDABook
+from exchange.order_books.list_elements import DenseIndexedDefaultList
+
+def random_orders(seed, n):
+    rng = Random(seed)
+    for order_id in range(n):
+        if rng.random() < 0.05:
+            price = 2147483647 if rng.random() < 0.5 else 0     # market orders
+        else:
+            price = rng.randrange(80, 121)
+        yield order_id, rng.choice((b'B', b'S')), price, rng.randrange(1, 6)
+
+class TestCDABook(unittest.TestCase):
+
+    def test_dense_backend_matches_sparse(self):
+        sparse = CDABook()
+        dense = CDABook(ladder = partial(DenseIndexedDefaultList, min_index = 90, max_index = 110))
+        live = []
+        rng = Random(3)
+        for (order_id, side, price, volume) in random_orders(5, 3000):
+            results = []
+            for book in (sparse, dense):
+                enter = book.enter_buy if side == b'B' else book.enter_sell
+                results.append(enter(order_id, price, volume, True))
+            self.assertEqual(results[0], results[1])
+            live.append((order_id, price, side))
+            if rng.random() < 0.3:
+                (cancel_id, cancel_price, cancel_side) = live.pop(rng.randrange(len(live)))
+                self.assertEqual(
+                    sparse.cancel_order(cancel_id, cancel_price, 0, cancel_side),
+                    dense.cancel_order(cancel_id, cancel_price, 0, cancel_side))
+            self.assertEqual(sparse.bbo, dense.bbo)
+
+    def test_enter_orders_matches_sequential_entry(self):
+        sequential = CDABook()
+        batched = CDABook()
+        orders = [(order_id, side, price, volume, True)
+                    for (order_id, side, price, volume) in random_orders(8, 2000)]
+        crossed_orders = []
+        for (order_id, side, price, volume, enter_into_book) in orders:
+            enter = sequential.enter_buy if side == b'B' else sequential.enter_sell
+            crossed_orders.extend(enter(order_id, price, volume, enter_into_book)[0])
+        for start in range(0, len(orders), 50):
+            (crosses, new_bbo) = batched.enter_orders(orders[start:start + 50])
+            crossed_orders[:len(crosses)], expected = [], crossed_orders[:len(crosses)]
+            self.assertEqual(crosses, expected)
+            if new_bbo is not None:
+                self.assertEqual(new_bbo, batched.bbo)
+        self.assertEqual(batched.bbo, sequential.bbo)
+        self.assertEqual((batched.bid, batched.ask), (sequential.bid, sequential.ask))
+
+        resting = list(sequential.order_index)
+        cancels = [(order_id, 0) for order_id in resting[::2]] + [(order_id, 1) for order_id in resting[1::2]]
+        self.assertEqual(batched.cancel_orders(cancels)[0],
+            [sequential.cancel_order(order_id, volume = volume)[0][0] for (order_id, volume) in cancels])
+        self.assertEqual(batched.bbo, sequential.bbo)
+
+    def test_enter_orders_reports_bbo_once(self):
+        book = CDABook()
+        (crossed_orders, new_bbo) = book.enter_orders([(1, b'B', 10, 2, True), (2, b'S', 12, 1, True),
+            (3, b'S', 10, 1, True), (4, b'B', 9, 1, True)])
+        self.assertEqual(crossed_orders, [((3, 1), 10, 1)])
+        self.assertEqual(new_bbo, book.bbo)
+        self.assertEqual((new_bbo.best_bid, new_bbo.volume_at_best_bid, new_bbo.next_bid, new_bbo.best_ask), (10, 1, 9, 12))
+        # a batch that leaves the top of the book as it was reports no update
+        self.assertEqual(book.enter_orders([(5, b'B', 5, 1, True), (6, b'B', 5, 1, False)]), ([], None))
+        self.assertEqual(book.cancel_orders([(5, 0), (7, 0)]), ([(5, 1)], None))
+
+    def test_cancel_by_token(self):
+        book = CDABook()
+        book.enter_buy(1, 10, 5, True)
+        book.enter_buy(2, 10, 1, True)
+        book.enter_sell(3, 12, 2, True)
+        self.assertIn(1, book)
+
+        # partial reduce, then full cancel, without giving price or side
+        (cancelled, new_bbo) = book.cancel_order(1, volume = 2)
+        self.assertEqual(cancelled, [(1, 3)])
+        self.assertEqual(book.bids[10].interest, 3)
+        (cancelled, new_bbo) = book.cancel_order(3)
+        self.assertEqual(cancelled, [(3, 2)])
+        self.assertEqual(new_bbo.best_ask, 2147483647)
+        self.assertNotIn(3, book)
+        self.assertEqual(len(book.asks), 0)
+
+    def test_cancel_unknown_order_creates_no_level(self):
+        book = CDABook()
+        self.assertEqual(book.cancel_order(9, 15, 0, b'B'), ([], None))
+        self.assertEqual(len(book.bids), 0)
+        self.assertNotIn(15, book.bids)
+
+    def test_filled_orders_leave_index(self):
+        book = CDABook()
+        book.enter_sell(1, 10, 1, True)
+        book.enter_sell(2, 10, 3, True)
+        book.enter_buy(3, 10, 2, True)
+        self.assertNotIn(1, book)
+        self.assertIn(2, book)
+        self.assertNotIn(3, book)
+        self.assertEqual(book.cancel_order(1), ([], None))
+
+    def test_level_is_fifo_and_reuses_records(self):
+        book = CDABook()
+        for order_id in range(4):
+            book.enter_sell(order_id, 10, 2, True, entry_time = 100 + order_id)
+        book.cancel_order(1)
+        self.assertEqual(list(book.asks[10].items()), [(0, 2), (2, 2), (3, 2)])
+        self.assertEqual(book.order_index[3].entry_time, 103)
+
+        (crossed, entered, bbo) = book.enter_buy(4, 10, 3, True)
+        self.assertEqual([(ask_id, volume) for ((_, ask_id), _, volume) in crossed], [(0, 2), (2, 1)])
+        self.assertEqual(list(book.asks[10].items()), [(2, 1), (3, 2)])
+
+        # records of filled and cancelled orders go back to the pool
+        for order_id in range(5, 7):
+            book.enter_sell(order_id, 11, 1, True)
+        self.assertEqual(book.record_pool.allocated, 4)
+
+    def test_flickering_level_is_reused(self):
+        book = CDABook()
+        level = book.asks[10]
+        book.asks.remove(10)
+        for order_id in range(0, 20, 2):
+            book.enter_sell(order_id, 10, 1, True)
+            self.assertIs(book.asks[10], level)
+            book.enter_buy(order_id + 1, 10, 1, True)
+            self.assertNotIn(10, book.asks)
+        self.assertEqual(book.level_cache_stats()['asks']['hits'], 10)
+        self.assertIsNone(CDABook(level_cache_size = 0).level_cache_stats())
+
+    def test_reset_keeps_ladder(self):
+        ladder = partial(DenseIndexedDefaultList, min_index = 0, max_index = 10)
+        book = CDABook(ladder = ladder)
+        book.enter_buy(1, 5, 1, True)
+        book.reset_book()
+        self.assertIsInstance(book.bids, DenseIndexedDefaultList)
+        self.assertEqual(len(book.bids), 0)
+
+    def test_restored_snapshot_carries_on_the_same(self):
+        book = CDABook()
+        restored = None
+        for (order_id, side, price, volume) in random_orders(11, 3000):
+            if order_id == 1500:
+                restored = CDABook()
+                restored.restore_state(pickle.loads(pickle.dumps(book.snapshot_state())))
+                self.assertEqual(restored.bbo, book.bbo)
+                self.assertEqual(set(restored.order_index), set(book.order_index))
+            for each_book in (book, restored) if restored is not None else (book,):
+                enter = each_book.enter_buy if side == b'B' else each_book.enter_sell
+                results = [enter(order_id, price, volume, True, entry_time = order_id)]
+                if order_id % 5 == 0:
+                    results.append(each_book.cancel_order(order_id - 3, volume = order_id % 2))
+                if each_book is book:
+                    expected = results
+                else:
+                    self.assertEqual(results, expected)
+        self.assertEqual((restored.bid, restored.ask, restored.bbo), (book.bid, book.ask, book.bbo))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,310 @@
+import math
+import pickle
+import unittest
+from random import Random, seed
+from exchange.order_books.fba_book import FBABook, merge, MIN_BID, MAX_ASK
+from exchange.order_books.numpy_batch_engine import NumpyBatchEngine, np
+
+def walk_clearing_price(book):
+    '''
+    The clearing price as batch_process used to find it, walking both sides of the book level by level.
+    '''
+    asks_volume = sum([price_book.interest for price_book in book.asks.ascending_items()])
+    all_orders_descending = merge(
+        book.asks.descending_items(),
+        book.bids.ascending_items(),
+        key= lambda bpq: -bpq.price)
+    orders_volume = prior_orders_volume = 0
+    clearing_price = None
+    bpq = prior_bpq = None
+    min_real_price = None
+    max_real_price = None
+    for bpq in all_orders_descending:
+        if MIN_BID<bpq.price<MAX_ASK:
+            if max_real_price is None or max_real_price < bpq.price:
+                max_real_price = bpq.price
+            if min_real_price is None or bpq.price<min_real_price:
+                min_real_price = bpq.price
+        prior_orders_volume = orders_volume
+        orders_volume += bpq.interest
+        if orders_volume > asks_volume:
+            break
+        prior_bpq=bpq
+    if bpq is not None and bpq.price==MAX_ASK:
+        for bpq in all_orders_descending:
+            if max_real_price is None or max_real_price<bpq.price<MAX_ASK:
+                max_real_price = bpq.price
+            if min_real_price is None or MIN_BID<bpq.price<min_real_price:
+                min_real_price = bpq.price
+            if bpq.price<MAX_ASK:
+                break
+    if max_real_price is None and min_real_price is None:
+        clearing_price = None
+    elif prior_orders_volume==asks_volume and prior_bpq is not None:
+        if prior_bpq.price==MAX_ASK and MIN_BID<bpq.price<MAX_ASK:
+            clearing_price=bpq.price
+        elif prior_bpq.price<MAX_ASK and MIN_BID<bpq.price:
+            clearing_price = math.ceil((prior_bpq.price+bpq.price)/2)
+        elif MIN_BID<prior_bpq.price<MAX_ASK and MIN_BID==bpq.price:
+            clearing_price=prior_bpq.price
+        elif prior_bpq.price==MIN_BID:
+            clearing_price=min_real_price
+    elif orders_volume>asks_volume and min_real_price is not None:
+        clearing_price = max(bpq.price, min_real_price)
+    return clearing_price
+
+def random_book(rng, levels):
+    book = FBABook()
+    prices = [MIN_BID, MAX_ASK, MAX_ASK + 1] + [rng.randrange(1, 4 * levels) for _ in range(levels)]
+    for order_id in range(rng.randrange(1, 3 * levels)):
+        enter = book.enter_buy if rng.random() < 0.5 else book.enter_sell
+        price = rng.choice(prices) if rng.random() < 0.9 else rng.choice(prices[:3])
+        enter(order_id, price, rng.randrange(1, 10), True)
+    return book
+
+class TestFBABook(unittest.TestCase):
+
+    def test_clearing_price_matches_walk(self):
+        rng = Random(17)
+        seed(17)
+        for trial in range(3000):
+            book = random_book(rng, rng.choice((1, 2, 5, 20)))
+            # thin the book out through cancels and partial cancels
+            for order_id in list(book.order_index):
+                if rng.random() < 0.2:
+                    book.cancel_order(order_id, volume = rng.choice((0, 1)))
+            self.assertEqual(book.curves.clearing_price(), walk_clearing_price(book), trial)
+
+    def test_curves_follow_batches(self):
+        rng = Random(4)
+        seed(4)
+        book = FBABook()
+        order_id = 0
+        for batch in range(200):
+            for _ in range(rng.randrange(0, 30)):
+                enter = book.enter_buy if rng.random() < 0.5 else book.enter_sell
+                enter(order_id, rng.randrange(90, 111), rng.randrange(1, 10), True)
+                order_id += 1
+            expected = walk_clearing_price(book)
+            (matches, clearing_price) = book.batch_process()
+            self.assertEqual(clearing_price, expected or 0)
+            asks = dict((bq.price, bq.interest) for bq in book.asks.ascending_items())
+            bids = dict((bq.price, bq.interest) for bq in book.bids.ascending_items())
+            self.assertEqual(book.curves.asks, asks)
+            self.assertEqual(book.curves.bids, bids)
+            self.assertEqual(book.curves.asks_volume, sum(asks.values()))
+            self.assertEqual(book.curves.volume_at_or_above(100),
+                sum(v for (p, v) in asks.items() if p >= 100) + sum(v for (p, v) in bids.items() if p >= 100))
+
+    def test_one_sided_book_does_not_match(self):
+        book = FBABook()
+        self.assertEqual(book.batch_process(), ([], 0))
+        book.enter_buy(1, MAX_ASK, 5, True)
+        book.enter_buy(2, 10, 5, True)
+        # a price is still reported, as before, but there is nothing to match
+        self.assertEqual(book.curves.clearing_price(), walk_clearing_price(book))
+        self.assertEqual(book.batch_process()[0], [])
+        self.assertEqual(book.curves.bids, {MAX_ASK: 5, 10: 5})
+
+    def test_enter_orders_takes_the_cda_tuples(self):
+        book = FBABook()
+        self.assertEqual(book.enter_orders([(1, b'B', 100, 5, True, 'a', 10), (2, b'S', 99, 3, True),
+                                            (3, b'S', 99, 1, False, 'c', 12)]), ([], None))
+        self.assertEqual(book.bids[100].snapshot()[1], [(1, 5, 'a', 10, 1)])
+        self.assertEqual(book.asks[99].snapshot()[1], [(2, 3, None, None, 1)])
+        self.assertNotIn(3, book)
+        self.assertEqual(book.batch_process(), ([((1, 2), 100, 3)], 100))
+
+
+
+def run_batches(book, corpus_seed, batches):
+    '''
+    Enter a seeded stream of orders, cancels and market orders into book, running a batch every so often.
+    Returns every batch's result and the resting book.
+    '''
+    rng = Random(corpus_seed)
+    seed(corpus_seed)
+    results = []
+    order_id = 0
+    for _ in range(batches):
+        for _ in range(rng.randrange(0, 60)):
+            if book.order_index and rng.random() < 0.15:
+                book.cancel_order(rng.choice(list(book.order_index)), volume = rng.choice((0, 1)))
+                continue
+            enter = book.enter_buy if rng.random() < 0.5 else book.enter_sell
+            price = rng.randrange(95, 106) if rng.random() < 0.95 else rng.choice((MIN_BID, MAX_ASK))
+            enter(order_id, price, rng.randrange(1, 20), True)
+            order_id += 1
+        results.append(book.batch_process())
+    resting = [[(bq.price, list(bq.items())) for bq in side.ascending_items()] for side in (book.bids, book.asks)]
+    return results, resting
+
+@unittest.skipIf(np is None, 'numpy is not installed')
+class TestNumpyBatchEngine(unittest.TestCase):
+
+    def test_same_results_as_batch_process(self):
+        for corpus_seed in range(20):
+            (expected, expected_book) = run_batches(FBABook(), corpus_seed, 40)
+            (results, book) = run_batches(FBABook(batch_engine = NumpyBatchEngine()), corpus_seed, 40)
+            self.assertEqual(results, expected)
+            self.assertEqual(book, expected_book)
+            self.assertTrue(any(matches for (matches, _) in results))
+
+    def test_reset_keeps_engine(self):
+        engine = NumpyBatchEngine()
+        book = FBABook(batch_engine = engine)
+        book.reset_book()
+        self.assertIs(book.batch_engine, engine)
+
+
+
+class TestDeferredShuffle(unittest.TestCase):
+
+    def batch_order(self, shuffle_seed, batch):
+        '''orders at level 10 after entering two batches of bids there, the first of them already closed'''
+        book = FBABook(shuffle_seed = shuffle_seed)
+        book.enter_buy('old', 10, 1)
+        book.batch_process()
+        for order_id in batch:
+            book.enter_buy(order_id, 10, 1)
+        book.batch_process()
+        return [order_id for (order_id, _) in book.bids[10].items()]
+
+    def test_arrival_order_until_batch_closes(self):
+        book = FBABook(shuffle_seed = 1)
+        for order_id in range(20):
+            book.enter_buy(order_id, 10, 1)
+        self.assertEqual([order_id for (order_id, _) in book.bids[10].items()], list(range(20)))
+        book.batch_process()
+        order = [order_id for (order_id, _) in book.bids[10].items()]
+        self.assertNotEqual(order, list(range(20)))
+        self.assertEqual(sorted(order), list(range(20)))
+
+    def test_reproducible_under_seed(self):
+        batch = list(range(50))
+        self.assertEqual(self.batch_order(7, batch), self.batch_order(7, batch))
+        self.assertNotEqual(self.batch_order(7, batch), self.batch_order(8, batch))
+
+    def test_earlier_batches_keep_priority(self):
+        for shuffle_seed in range(20):
+            order = self.batch_order(shuffle_seed, ['a', 'b', 'c'])
+            self.assertEqual(order[0], 'old')
+
+    def test_every_order_is_reachable(self):
+        seen = set()
+        for shuffle_seed in range(200):
+            seen.add(tuple(self.batch_order(shuffle_seed, ['a', 'b', 'c'])[1:]))
+        self.assertEqual(len(seen), 6)
+
+    def test_cancels_within_batch(self):
+        book = FBABook(shuffle_seed = 3)
+        book.enter_buy('old', 10, 5)
+        book.batch_process()
+        for order_id in range(10):
+            book.enter_buy(order_id, 10, 1)
+        book.cancel_order(0)
+        book.cancel_order(9)
+        book.enter_sell('s', 10, 6, True)
+        (matches, price) = book.batch_process()
+        self.assertEqual(price, 10)
+        self.assertEqual(matches[0], (('old', 's'), 10, 5))
+        self.assertEqual(len(matches), 2)
+        level = book.bids[10]
+        self.assertEqual(len(level), 7)
+        self.assertEqual(sorted(order_id for (order_id, _) in level.items()), [o for o in range(1, 9) if o != matches[1][0][0]])
+        self.assertIs(level.tail.next, None)
+        self.assertIs(level.head.prev, None)
+
+    def test_batch_refilled_after_cancels(self):
+        # every order of the batch at the level is cancelled before more of the same batch arrive
+        book = FBABook(shuffle_seed = 4)
+        book.enter_buy('old', 10, 1)
+        book.batch_process()
+        book.enter_buy('a', 10, 1)
+        book.cancel_order('a')
+        book.enter_buy('b', 10, 1)
+        book.enter_buy('c', 10, 1)
+        book.batch_process()
+        order = [order_id for (order_id, _) in book.bids[10].items()]
+        self.assertEqual((order[0], sorted(order[1:])), ('old', ['b', 'c']))
+
+
+class TestFreezeAndMerge(unittest.TestCase):
+
+    def test_orders_during_clearing_rank_behind_residuals(self):
+        book = FBABook(shuffle_seed = 1)
+        book.enter_buy('rest', 10, 5)
+        book.enter_sell('s', 10, 2, True)
+        next_book = book.freeze()
+        next_book.enter_buy('new', 10, 3)
+        next_book.enter_buy('other', 11, 1)
+        next_book.cancel_order('other')
+        next_book.enter_sell('s2', 12, 4, True)
+        (matches, price) = book.batch_process()
+        self.assertEqual(matches, [(('rest', 's'), 10, 2)])
+        book.merge_batch(next_book)
+        self.assertEqual(list(book.bids[10].items()), [('rest', 3), ('new', 3)])
+        self.assertEqual([bq.price for bq in book.bids.ascending_items()], [10])
+        self.assertEqual(list(book.asks[12].items()), [('s2', 4)])
+        self.assertEqual(book.order_index['new'].batch_number, book.batch_number)
+        self.assertEqual(book.curves.bids, {10: 6})
+
+    def test_same_results_as_a_single_book(self):
+        # a batch entered into the next book while the book clears an (idle) batch, and merged back,
+        # clears as if it had been entered into the book directly
+        rng = Random(5)
+        single, buffered = FBABook(shuffle_seed = 2), FBABook(shuffle_seed = 2)
+        for batch in range(30):
+            next_book = buffered.freeze()
+            for order_id in range(batch * 20, batch * 20 + 20):
+                (side, price, volume) = (rng.choice('BS'), rng.randrange(95, 106), rng.randrange(1, 10))
+                for book in (single, next_book):
+                    (book.enter_buy if side == 'B' else book.enter_sell)(order_id, price, volume, True)
+            self.assertEqual(buffered.batch_process()[0], [])
+            buffered.merge_batch(next_book)
+            self.assertEqual(buffered.batch_process(), single.batch_process())
+            for side in ('bids', 'asks'):
+                self.assertEqual([(bq.price, list(bq.items())) for bq in getattr(buffered, side).ascending_items()],
+                                 [(bq.price, list(bq.items())) for bq in getattr(single, side).ascending_items()])
+
+
+class TestSnapshot(unittest.TestCase):
+
+    def enter_orders(self, book, rng, first_id, count):
+        for order_id in range(first_id, first_id + count):
+            enter = book.enter_buy if rng.random() < 0.5 else book.enter_sell
+            enter(order_id, rng.randrange(95, 106), rng.randrange(1, 20), True, entry_time = order_id)
+            if order_id % 7 == 0 and order_id - 4 in book:
+                book.cancel_order(order_id - 4, volume = order_id % 2)
+
+    def carry_on(self, book):
+        '''batch results, batch markers and resting orders of book over a few more batches'''
+        rng = Random(8)
+        seed(8)
+        results = []
+        for batch in range(10):
+            self.enter_orders(book, rng, 1000 + batch * 40, 40)
+            results.append(book.batch_process())
+            results.append([(bq.price, bq.current_batch_number, bq.batch_size, list(bq.items()))
+                            for side in (book.bids, book.asks) for bq in side.ascending_items()])
+        return results
+
+    def test_restored_snapshot_carries_on_the_same(self):
+        for shuffle_seed in (None, 6):
+            rng = Random(3)
+            seed(3)
+            book = FBABook(shuffle_seed = shuffle_seed)
+            for batch in range(5):
+                self.enter_orders(book, rng, batch * 40, 40)
+                book.batch_process()
+            # snapshot half way through a batch, with orders of it resting behind older ones
+            self.enter_orders(book, rng, 200, 25)
+            restored = FBABook(shuffle_seed = shuffle_seed)
+            restored.restore_state(pickle.loads(pickle.dumps(book.snapshot_state())))
+            self.assertEqual(restored.curves.bids, book.curves.bids)
+            self.assertEqual(restored.curves.asks, book.curves.asks)
+            self.assertEqual(restored.batch_number, book.batch_number)
+            self.assertEqual(self.carry_on(restored), self.carry_on(book), shuffle_seed)
+
+if __name__ == '__main__':
+    unittest.main()
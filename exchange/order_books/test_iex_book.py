@@ -1,5 +1,6 @@
+import pickle
 import unittest
-from iex_book import IEXBook
+from exchange.order_books.iex_book import IEXBook
 
 class TestIEXBook(unittest.TestCase):
 
@@ -302,6 +303,91 @@ class TestIEXBook(unittest.TestCase):
         self.assertEqual(len(book.pegged_bids), 0)
         self.assertEqual(len(book.pegged_asks), 0)
 
+    def test_cancel_by_token(self):
+        book = IEXBook()
+        book.update_peg_price(10)
+
+        book.enter_sell(1, 15, 2, True, midpoint_peg=False)
+        book.enter_sell(2, 8, 3, True, midpoint_peg=True)
+
+        # orders are found by token alone, pegged or not
+        (cancelled_orders, new_bbo) = book.cancel_order(2, volume=1)
+        self.assertEqual(cancelled_orders, [(2, 2)])
+        self.assertEqual(book.pegged_asks[2], 1)
+        (cancelled_orders, new_bbo) = book.cancel_order(1)
+        self.assertEqual(cancelled_orders, [(1, 2)])
+        self.assertEqual(len(book.asks), 0)
+        self.assertNotIn(1, book)
+        self.assertIn(2, book)
+
+    def test_enter_orders_batch(self):
+        book = IEXBook()
+        book.update_peg_price(10)
+        book.enter_sell(1, 12, 2, True, midpoint_peg=False)
+
+        # a pegged sell, a buy crossing it at the peg and then the $12 ask, and a resting bid
+        (crossed_orders, new_bbo) = book.enter_orders([
+            (2, b'S', 8, 1, True, True),
+            (3, b'B', 12, 2, True, False),
+            (4, b'B', 9, 5, True, False)])
+        self.assertEqual(crossed_orders, [((3, 2), 10, 1), ((3, 1), 12, 1)])
+        self.assertEqual((new_bbo.best_bid, new_bbo.best_ask), (9, 12))
+        self.assertEqual(book.bbo, new_bbo)
+        self.assertEqual(len(book.pegged_asks), 0)
+
+
+    def test_peg_repricing_sweeps_levels(self):
+        book = IEXBook()
+        book.update_peg_price(15)
+
+        # bids at $12, $11 and $10, then pegged sells totalling 6 units
+        book.enter_buy(1, 12, 2, True, midpoint_peg=False)
+        book.enter_buy(2, 11, 1, True, midpoint_peg=False)
+        book.enter_buy(3, 11, 3, True, midpoint_peg=False)
+        book.enter_buy(4, 10, 5, True, midpoint_peg=False)
+        book.enter_sell(5, 9, 3, True, midpoint_peg=True)
+        book.enter_sell(6, 9, 3, True, midpoint_peg=True)
+        self.assertEqual(book.pegged_asks.volume, 6)
+
+        # the peg moves through $12 and $11: the pegs fill in time order until they run out
+        (crossed_orders, new_bbo) = book.update_peg_price(9)
+        self.assertEqual(crossed_orders, [((5, 1), 12, 2), ((5, 2), 11, 1), ((6, 3), 11, 3)])
+        self.assertEqual((new_bbo.best_bid, new_bbo.volume_at_best_bid), (10, 5))
+        self.assertEqual(len(book.pegged_asks), 0)
+        self.assertEqual(book.pegged_asks.volume, 0)
+        self.assertEqual([price_q.price for price_q in book.bids.ascending_items()], [10])
+
+    def test_pegged_volume_follows_cancels(self):
+        book = IEXBook()
+        book.update_peg_price(10)
+        book.enter_buy(1, 12, 4, True, midpoint_peg=True)
+        book.enter_buy(2, 12, 2, True, midpoint_peg=True)
+        book.cancel_order(1, volume=1)
+        self.assertEqual(book.pegged_bids.volume, 3)
+        book.cancel_order(2)
+        self.assertEqual(book.pegged_bids.volume, 1)
+        (crossed_orders, entered_order, new_bbo) = book.enter_sell(3, 10, 2, True, midpoint_peg=False)
+        self.assertEqual(crossed_orders, [((3, 1), 10, 1)])
+        self.assertEqual(book.pegged_bids.volume, 0)
+
+    def test_restored_snapshot_carries_on_the_same(self):
+        book = IEXBook()
+        book.update_peg_price(10)
+        book.enter_buy(1, 9, 2, True, midpoint_peg=False)
+        book.enter_buy(2, 12, 4, True, midpoint_peg=True)
+        book.enter_buy(3, 12, 1, True, midpoint_peg=True)
+        book.enter_sell(4, 13, 3, True, midpoint_peg=False)
+        book.enter_sell(5, 8, 2, True, midpoint_peg=True)
+        restored = IEXBook()
+        restored.restore_state(pickle.loads(pickle.dumps(book.snapshot_state())))
+        self.assertEqual(restored.peg_price, 10)
+        self.assertEqual(restored.get_peg_state(), book.get_peg_state())
+        self.assertEqual(restored.pegged_bids.volume, book.pegged_bids.volume)
+        self.assertEqual(restored.update_peg_price(12), book.update_peg_price(12))
+        self.assertEqual(restored.enter_sell(6, 9, 4, True, midpoint_peg=False), book.enter_sell(6, 9, 4, True, midpoint_peg=False))
+        self.assertEqual(restored.update_peg_price(8), book.update_peg_price(8))
+        self.assertEqual(restored.bbo, book.bbo)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,172 @@
+import unittest
+from random import Random
+from exchange.order_books.book_price_q import BookPriceQ
+from exchange.order_books.list_elements import SortedIndexedDefaultList, BisectIndexedDefaultList, DenseIndexedDefaultList, LevelCache
+
+def make_lists(index_multiplier):
+    return [cls(index_func = lambda bq: bq.price,
+                initializer = lambda p: BookPriceQ(p),
+                index_multiplier = index_multiplier)
+            for cls in (SortedIndexedDefaultList, BisectIndexedDefaultList)]
+
+def linked_prices(l):
+    forward = [bq.price for bq in l.ascending_items()]
+    backward = [bq.price for bq in l.descending_items()]
+    assert forward == backward[::-1]
+    return forward
+
+class TestBisectIndexedDefaultList(unittest.TestCase):
+
+    def test_ordering_matches_linked_list(self):
+        rng = Random(7)
+        for index_multiplier in (1, -1):
+            reference, ladder = make_lists(index_multiplier)
+            for _ in range(2000):
+                price = rng.randrange(0, 200)
+                if rng.random() < 0.6:
+                    reference[price]
+                    ladder[price]
+                else:
+                    reference.remove(price)
+                    ladder.remove(price)
+                self.assertEqual(linked_prices(ladder), linked_prices(reference))
+                self.assertEqual(len(ladder), len(reference))
+                if reference.start is None:
+                    self.assertIsNone(ladder.start)
+                else:
+                    self.assertEqual(ladder.start.data.price, reference.start.data.price)
+                    self.assertEqual(ladder.end.data.price, reference.end.data.price)
+
+    def test_best_is_start(self):
+        bids = BisectIndexedDefaultList(index_func = lambda bq: bq.price,
+                            initializer = lambda p: BookPriceQ(p),
+                            index_multiplier = -1)
+        for price in (10, 12, 11, 9):
+            bids[price]
+        self.assertEqual(bids.start.data.price, 12)
+        self.assertEqual(bids.start.next.data.price, 11)
+        bids.remove(12)
+        self.assertEqual(bids.start.data.price, 11)
+        self.assertIsNone(bids.start.prev)
+
+    def test_remove_while_iterating(self):
+        asks = BisectIndexedDefaultList(index_func = lambda bq: bq.price,
+                            initializer = lambda p: BookPriceQ(p))
+        for price in (5, 3, 4, 6):
+            asks[price]
+        seen = []
+        for price_q in asks.ascending_items():
+            seen.append(price_q.price)
+            asks.remove(price_q.price)
+        self.assertEqual(seen, [3, 4, 5, 6])
+        self.assertEqual(len(asks), 0)
+        self.assertIsNone(asks.start)
+        self.assertEqual(asks.keys, [])
+
+
+class TestDenseIndexedDefaultList(unittest.TestCase):
+
+    def test_ordering_matches_linked_list(self):
+        rng = Random(11)
+        for index_multiplier in (1, -1):
+            reference, _ = make_lists(index_multiplier)
+            ladder = DenseIndexedDefaultList(index_func = lambda bq: bq.price,
+                            initializer = lambda p: BookPriceQ(p),
+                            index_multiplier = index_multiplier,
+                            min_index = 50, max_index = 150)
+            for _ in range(3000):
+                # a quarter of the prices fall outside the dense band
+                price = rng.randrange(0, 200)
+                if rng.random() < 0.6:
+                    reference[price]
+                    ladder[price]
+                else:
+                    reference.remove(price)
+                    ladder.remove(price)
+                prices = linked_prices(reference)
+                self.assertEqual(linked_prices(ladder), prices)
+                self.assertEqual(len(ladder), len(reference))
+                self.assertEqual(price in ladder, price in reference)
+                # the cursors track the two lowest and two highest occupied slots
+                band = [p - 50 for p in prices if 50 <= p <= 150][::index_multiplier] + [None, None]
+                self.assertEqual((ladder.low, ladder.low_next), tuple(band[:2]))
+                band = band[-3::-1] + [None, None]
+                self.assertEqual((ladder.high, ladder.high_next), tuple(band[:2]))
+                if not prices:
+                    self.assertIsNone(ladder.start)
+                    self.assertIsNone(ladder.end)
+                    continue
+                # walk the node contract both ways
+                node, walked = ladder.start, []
+                while node is not None:
+                    walked.append(node.data.price)
+                    node = node.next
+                self.assertEqual(walked, prices)
+                node, walked = ladder.end, []
+                while node is not None:
+                    walked.append(node.data.price)
+                    node = node.prev
+                self.assertEqual(walked, prices[::-1])
+
+    def test_market_orders_outside_band(self):
+        bids = DenseIndexedDefaultList(index_func = lambda bq: bq.price,
+                            initializer = lambda p: BookPriceQ(p),
+                            index_multiplier = -1, min_index = 1, max_index = 100)
+        bids[2147483647]
+        bids[40]
+        bids[0]
+        self.assertEqual([bq.price for bq in bids.ascending_items()], [2147483647, 40, 0])
+        self.assertEqual(bids.start.next.data.price, 40)
+        self.assertEqual(bids.start.next.next.data.price, 0)
+        self.assertEqual(len(bids.sparse), 2)
+
+
+class TestLevelCache(unittest.TestCase):
+
+    def test_reused_levels_relink_in_order(self):
+        rng = Random(13)
+        for make in (BisectIndexedDefaultList, SortedIndexedDefaultList,
+                     lambda **kw: DenseIndexedDefaultList(min_index = 20, max_index = 60, **kw)):
+            reference = BisectIndexedDefaultList(index_func = lambda bq: bq.price,
+                            initializer = lambda p: BookPriceQ(p), index_multiplier = -1)
+            ladder = make(index_func = lambda bq: bq.price,
+                            initializer = lambda p: BookPriceQ(p), index_multiplier = -1,
+                            level_cache = LevelCache(8))
+            for _ in range(2000):
+                price = rng.randrange(0, 80)
+                if rng.random() < 0.5:
+                    reference[price]
+                    self.assertEqual(ladder[price].price, price)
+                else:
+                    reference.remove(price)
+                    ladder.remove(price)
+                self.assertEqual(linked_prices(ladder), linked_prices(reference))
+            self.assertGreater(ladder.level_cache.hits, 0)
+            self.assertLessEqual(len(ladder.level_cache), 8)
+
+    def test_park_reuse_and_evict(self):
+        cache = LevelCache(2)
+        asks = BisectIndexedDefaultList(index_func = lambda bq: bq.price,
+                            initializer = lambda p: BookPriceQ(p), level_cache = cache)
+        levels = [asks[price] for price in (10, 11, 12)]
+        levels[0].add_order(1, 5)
+        for price in (10, 11, 12):
+            asks.remove(price)
+        # the level still holding an order is dropped, not parked
+        self.assertEqual(list(cache.parked), [11, 12])
+        self.assertGreater(cache.bytes_held, 0)
+
+        self.assertIs(asks[12], levels[2])
+        self.assertIsNot(asks[10], levels[0])
+        self.assertEqual((cache.hits, cache.misses), (1, 4))
+        self.assertEqual(cache.hit_rate, 0.2)
+
+        for price in (10, 12, 13):
+            asks[price]
+            asks.remove(price)
+        self.assertEqual(list(cache.parked), [12, 13])
+        self.assertEqual(cache.evictions, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
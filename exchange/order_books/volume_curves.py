@@ -0,0 +1,180 @@
+import math
+
+MIN_BID = 0
+MAX_ASK = 2147483647
+MAX_PRICE = 2**32 - 1     # OUCH prices are unsigned 32 bit
+
+
+class FenwickTree:
+    '''
+    Binary indexed tree over indices 1..size, kept in a dict so that only the nodes on the paths of
+    touched indices take memory. Values must stay non-negative for search() to be meaningful.
+    '''
+    def __init__(self, size):
+        self.size = size
+        self.tree = {}
+        self.top_bit = 1 << (size.bit_length() - 1)
+
+    def add(self, index, delta):
+        tree = self.tree
+        while index <= self.size:
+            value = tree.get(index, 0) + delta
+            if value:
+                tree[index] = value
+            else:
+                del tree[index]
+            index += index & -index
+
+    def prefix(self, index):
+        '''sum of the values at indices 1..index'''
+        tree = self.tree
+        total = 0
+        while index > 0:
+            total += tree.get(index, 0)
+            index -= index & -index
+        return total
+
+
+class VolumeCurves:
+    '''
+    Cumulative bid and ask volume by price for an FBABook, from which the clearing price is found by
+    binary search instead of by walking every level of the book.
+
+    Levels report their interest changes through note(). Per-price volumes and the ask total are kept
+    current; the trees are brought up to date lazily, once per touched price, when next searched.
+    Both trees are indexed by descending price (index = MAX_PRICE - price + 1), so a prefix sum is the
+    volume at or above a price, which is the order FBABook.batch_process accumulates volume in.
+    Levels holding no volume are invisible to the curves; only zero-share orders can make one.
+    '''
+    def __init__(self):
+        self.asks = {}          # price -> ask volume
+        self.bids = {}          # price -> bid volume
+        self.asks_volume = 0
+        self.ask_tree = FenwickTree(MAX_PRICE + 1)
+        self.bid_tree = FenwickTree(MAX_PRICE + 1)
+        self.pending_asks = {}  # price -> ask volume change not yet in ask_tree
+        self.pending_bids = {}
+
+    def note(self, side, price, delta):
+        if side == b'S':
+            volumes, pending = self.asks, self.pending_asks
+            self.asks_volume += delta
+        else:
+            volumes, pending = self.bids, self.pending_bids
+        volume = volumes.get(price, 0) + delta
+        if volume:
+            volumes[price] = volume
+        else:
+            volumes.pop(price, None)
+        pending[price] = pending.get(price, 0) + delta
+
+    def flush(self):
+        for (tree, pending) in ((self.ask_tree, self.pending_asks), (self.bid_tree, self.pending_bids)):
+            for (price, delta) in pending.items():
+                if delta:
+                    tree.add(MAX_PRICE - price + 1, delta)
+            pending.clear()
+
+    def volume_at_or_above(self, price):
+        self.flush()
+        index = MAX_PRICE - price + 1
+        return self.ask_tree.prefix(index) + self.bid_tree.prefix(index)
+
+    def search(self, volume):
+        '''
+        The highest price at which the volume at or above it (bids and asks) exceeds volume, and the volume
+        strictly above that price; the price is None if there is not that much volume in the book.
+        '''
+        self.flush()
+        asks, bids = self.ask_tree.tree, self.bid_tree.tree
+        size = self.ask_tree.size
+        index = total = 0
+        bit = self.ask_tree.top_bit
+        while bit:
+            candidate = index + bit
+            if candidate <= size:
+                value = asks.get(candidate, 0) + bids.get(candidate, 0)
+                if total + value <= volume:
+                    index = candidate
+                    total += value
+            bit >>= 1
+        if index == size:
+            return None, total
+        return MAX_PRICE - index, total
+
+    def ask_volume_at(self, price):
+        return self.asks.get(price, 0)
+
+    def bid_volume_at(self, price):
+        return self.bids.get(price, 0)
+
+    def clearing_price(self):
+        return find_clearing_price(self)
+
+
+def lowest_price_above(curves, volume):
+    '''price of the lowest level in the top volume shares of the book'''
+    if volume <= 0:
+        return None
+    return curves.search(volume - 1)[0]
+
+def find_clearing_price(curves):
+    '''
+    The FBA clearing price, following the same rules as walking both sides of the book from the highest
+    price down until the volume passed exceeds the volume offered. None if nothing clears.
+    curves - VolumeCurves, or anything else with asks_volume, search, volume_at_or_above, ask_volume_at and
+        bid_volume_at
+    '''
+    asks_volume = curves.asks_volume
+    # the level at which the volume passed first exceeds the asks, and the one before it
+    price, above = curves.search(asks_volume)
+    if price is None:
+        return None
+    ask_here = curves.ask_volume_at(price)
+    crossing_ask = above + ask_here > asks_volume
+    if crossing_ask:
+        prior_volume = above
+        prior_price = lowest_price_above(curves, above)
+    else:
+        prior_volume = above + ask_here
+        prior_price = price if ask_here else lowest_price_above(curves, above)
+
+    if price == MAX_ASK:
+        # a market buy sets no price: the walk carries on down to the first level priced below it, and
+        # takes the first level it passes on the way as its lowest real price, whatever its price
+        passed = []
+        if crossing_ask and curves.bid_volume_at(MAX_ASK):
+            passed.append(MAX_ASK)
+        below, _ = curves.search(curves.volume_at_or_above(MAX_ASK))
+        if below is not None:
+            passed.append(below)
+        if not passed:
+            return None
+        min_real_price = None
+        for passed_price in passed:
+            if min_real_price is None or MIN_BID < passed_price < min_real_price:
+                min_real_price = passed_price
+        price = passed[-1]
+    elif MIN_BID < price < MAX_ASK:
+        min_real_price = price
+    elif price == MIN_BID:
+        # the lowest real price of all levels
+        min_real_price = lowest_price_above(curves, curves.volume_at_or_above(MIN_BID + 1))
+        if min_real_price is not None and min_real_price >= MAX_ASK:
+            min_real_price = None
+    else:
+        min_real_price = None
+    if min_real_price is None:
+        return None     # no real prices - can't match if all bids/offers are market orders
+
+    if prior_volume == asks_volume and prior_price is not None:
+        if prior_price == MAX_ASK and MIN_BID < price < MAX_ASK:
+            return price
+        elif prior_price < MAX_ASK and MIN_BID < price:
+            return math.ceil((prior_price + price)/2)
+        elif MIN_BID < prior_price < MAX_ASK and MIN_BID == price:
+            return prior_price
+        elif prior_price == MIN_BID:
+            return min_real_price
+        return None
+    return max(price, min_real_price)
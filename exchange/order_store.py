@@ -1,14 +1,35 @@
 import logging as log
+from concurrent.futures import ThreadPoolExecutor
+from OuchServer.ouch_messages import OuchServerMessages
+
+LIVE = b'L'	#order states, as in OUCH's order_state
+DEAD = b'D'
 
 
 class OrderStore:
 	'''
 	An order store keeps tracks of orders submitted to the exchange and their
 	status.
+
+	Only open orders are kept in memory, as compact OrderStoreEntry records of their live state. Once an
+	order is done the exchange retires it: it leaves orders and its final state is appended to the archive
+	file if there is one. Archive lines are buffered and written archive_chunk at a time by a writer thread,
+	so retiring an order never waits on the disk; close() writes out the rest. Orders are keyed by the ids the exchange's TokenInterner gives their tokens, which
+	also remembers the tokens that have been used.
 	'''
 
-	def __init__(self):
+	def __init__(self, archive_path = None, archive_chunk = 1024):
+		'''
+		archive_path - file retired orders are appended to, one line each; None to keep no archive
+		archive_chunk - number of archive lines buffered before they are handed to the writer thread
+		'''
 		self.orders = {}
+		self.archive_path = archive_path
+		self.archive = open(archive_path, 'a') if archive_path is not None else None
+		self.archive_chunk = archive_chunk
+		self.archive_lines = []		#lines not yet handed to the writer
+		self.archive_writer = ThreadPoolExecutor(max_workers = 1) if archive_path is not None else None
+		self.shared_values = {}		#stocks and firms, see shared
 
 	def __str__(self):
 		return """  
@@ -16,31 +37,38 @@ class OrderStore:
 {}
 """.format( self.orders)
 
-	# def reset_book(self):						#jason
-	# 	log.info('Clearing All Entries from Order Book')
-	# 	self.bid = MIN_BID
-	# 	self.ask = MAX_ASK
-	# 	for id in list(self.asks.index):		#force as list because can't interate dict and delete keys at same time
-    #             	self.asks.remove(id)
-	# 	for id in list(self.bids.index):
-    #             	self.bids.r
+	def __contains__(self, id):
+		return id in self.orders
 
-	def store_order(self, id, message, original_enter_message = None, executed_quantity = 0):
+	def store_order(self, id, message, original = None, executed_quantity = 0):
 		'''
 		Called to create a new order store entry, either with an EnterOrder message, or a replace order message that creates a new order.
+		original - the entry of the order a replace order message replaces, which the new one takes its side, stock, firm and midpoint peg from
 
-		Returns true if successful in storing it; false if unsuccesful because the order token is already used.
+		Returns the new entry if successful in storing it; false if unsuccesful because the order token is already used.
+		Only the fields replies need are copied out of the message; the store keeps no message.
 		'''
 		if id in self.orders:
 			log.info('Ignoring store_order command: id %s already in the order store', id)
 			return False
 		else:
-			self.orders[id] = OrderStoreEntry(message, original_enter_message = original_enter_message, executed_quantity = executed_quantity)
-			return self.orders[id]
+			entry = self.orders[id] = OrderStoreEntry.from_message(message, original, executed_quantity, self.shared)
+			return entry
+
+	def restore_order(self, id, fields):
+		'''store an entry from its snapshot()'''
+		entry = self.orders[id] = OrderStoreEntry(*fields)
+		entry.stock = self.shared(entry.stock)
+		entry.firm = self.shared(entry.firm)
+		return entry
+
+	def shared(self, value):
+		'''one object for every equal stock or firm, instead of a copy per order'''
+		return self.shared_values.setdefault(value, value)
 
 	def add_to_order(self, id, message):
 		'''
-		Called to add a message an existing order.
+		Called to add a message an existing order: the order's live state is updated from it.
 		'''
 		if id not in self.orders:
 			log.error('Unknown existing order %s', id)
@@ -49,21 +77,103 @@ class OrderStore:
 			self.orders[id].add_to_order(message)
 
 	def execute_quantity(self, id, quantity):
-		self.orders[id].executed_quantity += quantity
+		self.orders[id].execute(quantity)
+
+	def cancel_quantity(self, id, quantity):
+		entry = self.orders[id]
+		entry.remaining -= quantity
+
+	def retire(self, id):
+		'''
+		Called once an order is done - filled, cancelled or replaced, and out of the book - to drop it from memory.
+		'''
+		entry = self.orders.pop(id, None)
+		if entry is None:
+			return
+		entry.state = DEAD
+		if self.archive is not None:
+			self.archive_lines.append(entry.archive_line())
+			if len(self.archive_lines) >= self.archive_chunk:
+				self.flush_archive()
+
+	def flush_archive(self):
+		'''hand the buffered archive lines to the writer thread'''
+		if self.archive_lines:
+			self.archive_writer.submit(self.write_archive, ''.join(self.archive_lines))
+			self.archive_lines = []
+
+	def write_archive(self, chunk):
+		self.archive.write(chunk)
+		self.archive.flush()
 
 	def clear_order_store(self):				
 		self.orders.clear()
+		if self.archive is not None:
+			self.flush_archive()
 		log.info('orderstore after clear: %s' % str(self.orders))
 
+	def close(self):
+		'''write out the archive and close it'''
+		if self.archive is not None:
+			self.flush_archive()
+			self.archive_writer.shutdown(wait = True)
+			self.archive.close()
+			self.archive = None
+
 
 class OrderStoreEntry:
-	def __init__(self, message,  executed_quantity, original_enter_message = None):
-		self.history = []
+	'''
+	Live state of an open order, with the few fields of the messages that created it that replies need:
+	its token and the shares it was entered for, and the side, stock, firm and midpoint peg of the
+	order it replaces, if any, or its own.
+	'''
+	__slots__ = ('token', 'side', 'price', 'shares', 'remaining', 'executed_quantity', 'owner', 'stock', 'firm',
+		'midpoint_peg', 'state')
+
+	def __init__(self, token, side, price, shares, remaining, executed_quantity, owner, stock, firm, midpoint_peg):
+		self.token = token
+		self.side = side
+		self.price = price
+		self.shares = shares
+		self.remaining = remaining
 		self.executed_quantity = executed_quantity
-		self.first_message = message
-		self.original_enter_message = original_enter_message if original_enter_message is not None else message
-		self.history.append(message)
+		self.owner = owner
+		self.stock = stock
+		self.firm = firm
+		self.midpoint_peg = midpoint_peg
+		self.state = LIVE
+
+	@classmethod
+	def from_message(cls, message, original = None, executed_quantity = 0, shared = lambda value: value):
+		'''the entry of an EnterOrder, or of a ReplaceOrder replacing the order of entry original'''
+		if original is None:
+			return cls(message['order_token'], message['buy_sell_indicator'], message['price'], message['shares'],
+				message['shares'], executed_quantity, getattr(message, 'meta', None), shared(message['stock']),
+				shared(message['firm']), message['midpoint_peg'])
+		return cls(message['replacement_order_token'], original.side, message['price'], message['shares'],
+			message['shares'], executed_quantity, getattr(message, 'meta', None), original.stock, original.firm,
+			original.midpoint_peg)
+
+	def __repr__(self):
+		return '<{} {} {}@{} executed {}>'.format(self.state, self.side, self.remaining, self.price,
+			self.executed_quantity)
+
+	def execute(self, quantity):
+		self.executed_quantity += quantity
+		self.remaining -= quantity
 
 	def add_to_order(self, message):
-		self.history.append(message)
+		if message.message_type == OuchServerMessages.Executed:
+			self.execute(message['executed_shares'])
+		elif message.message_type == OuchServerMessages.Replaced:
+			self.remaining = message['shares']	#the shares actually entered for the replacement
+
+	def snapshot(self):
+		'''The entry as plain data, the arguments to build it again with'''
+		return (self.token, self.side, self.price, self.shares, self.remaining, self.executed_quantity, self.owner,
+			self.stock, self.firm, self.midpoint_peg)
 
+	def archive_line(self):
+		'''token, side, price, remaining and executed shares, and owner, tab separated'''
+		return '{}\t{}\t{}\t{}\t{}\t{}\n'.format(self.token.decode('ascii', 'replace'), self.side.decode('ascii'),
+			self.price, self.remaining, self.executed_quantity, self.owner)
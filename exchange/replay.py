@@ -0,0 +1,179 @@
+import asyncio
+import selectors
+import concurrent.futures
+from itertools import groupby
+from collections import defaultdict, deque
+from operator import attrgetter
+
+from exchange.exchange import client_message
+from exchange.journal import BROADCAST, EXPIRY, BATCH
+
+
+class VirtualTimeSelector(selectors.DefaultSelector):
+    '''
+    Selector of a VirtualTimeLoop: where the loop would wait for its next timer, it moves the loop's clock
+    on to it instead of sleeping.
+    '''
+    def __init__(self, loop):
+        super().__init__()
+        self.loop = loop
+
+    def select(self, timeout = None):
+        ready = super().select(0)
+        if ready or timeout is None:
+            return ready or super().select(None)
+        if timeout > 0:
+            self.loop.virtual_time += timeout
+        return ready
+
+
+class VirtualTimeLoop(asyncio.SelectorEventLoop):
+    '''
+    Event loop on a simulated clock, for replaying as fast as possible: sleeps and timers take no time, but
+    still run in the order and at the loop times they would have.
+    '''
+    def __init__(self, start = 0.0):
+        self.virtual_time = start
+        super().__init__(VirtualTimeSelector(self))
+
+    def time(self):
+        return self.virtual_time
+
+
+class InlineExecutor(concurrent.futures.Executor):
+    '''Runs what is submitted to it straight away, e.g. so that a replayed FBA batch clears in no time'''
+    def submit(self, fn, *args, **kwargs):
+        future = concurrent.futures.Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except BaseException as exc:
+            future.set_exception(exc)
+        return future
+
+
+class ReplayClock:
+    '''
+    Exchange clock of a replay, in nanoseconds since midnight: the recorded timestamp of the first batch
+    when the replay starts, and moving on with the loop's time from there.
+    '''
+    def __init__(self, loop):
+        self.loop = loop
+        self.start = 0          # recorded timestamp the replay started from
+        self.origin = loop.time()   # loop time it started at
+
+    def reset(self, start):
+        self.start = start
+        self.origin = self.loop.time()
+
+    def at(self, timestamp):
+        '''the loop time the recorded timestamp falls at'''
+        return self.origin + (timestamp - self.start) / 1e9
+
+    def __call__(self):
+        return self.start + int(round((self.loop.time() - self.origin) * 1e9))
+
+
+class ReplayPostOffice:
+    '''
+    Takes the place of the server in a replay: counts what the exchange sends and, given the records of an
+    output journal, checks each message against the next one recorded for the same client, or the next
+    broadcast, keeping the first that differs. Each client's stream and the broadcasts are checked in
+    order, but not how they interleave, which depends on when the exchange's timers happened to fire.
+    '''
+    def __init__(self, expected = None):
+        self.expected = iter(expected) if expected is not None else None
+        self.ahead = defaultdict(deque)     # client token -> expected records read past while looking for another's
+        self.sent = 0
+        self.mismatch = None    # (index, expected record or None, client token, bytes) of the first difference
+
+    def next_expected(self, client_token):
+        ahead = self.ahead[client_token]
+        if ahead:
+            return ahead.popleft()
+        for record in self.expected:
+            if record.client_token == client_token:
+                return record
+            self.ahead[record.client_token].append(record)
+        return None
+
+    def check(self, client_token, data):
+        self.sent += 1
+        if self.expected is None or self.mismatch is not None:
+            return
+        record = self.next_expected(client_token)
+        if record is None or record.data != data:
+            self.mismatch = (self.sent, record, client_token, data)
+
+    def unsent(self):
+        '''the number of expected messages left over once the replay is done, if none differed'''
+        if self.expected is None or self.mismatch is not None:
+            return 0
+        return sum(len(ahead) for ahead in self.ahead.values()) + sum(1 for record in self.expected)
+
+    async def order_reply(self, message):
+        self.check(message.meta, bytes(message))
+
+    async def order_reply_batch(self, messages):
+        for message in messages:
+            self.check(message.meta, bytes(message))
+
+    async def message_broadcast(self, message):
+        self.check(BROADCAST, bytes(message))
+
+    async def message_broadcast_batch(self, messages):
+        for message in messages:
+            self.check(BROADCAST, bytes(message))
+
+
+def batches(records):
+    '''
+    The messages of journal records as (timestamp, messages) batches, one per timestamp the engine stamped,
+    each message carrying its recorded client token as meta. Expiries, under EXPIRY, and FBA batch closes and
+    merges, under BATCH, come in batches of their own, for apply_batch to tell apart.
+    '''
+    def key(record):
+        return (record.timestamp, record.client_token if record.client_token in (EXPIRY, BATCH) else None)
+    for ((timestamp, _), group) in groupby(records, key = key):
+        yield (timestamp, [client_message(record.data, record.client_token) for record in group])
+
+async def apply_batch(exchange, messages, timestamp):
+    '''
+    have the exchange handle a batch from batches, as it did when it was journaled, once it has run the
+    events its timers posted meanwhile, as its engine would have
+    '''
+    await exchange.run_events()
+    if messages[0].meta == EXPIRY:
+        await exchange.process_expiries(messages, timestamp)
+    elif messages[0].meta == BATCH:
+        await exchange.process_batch_events(messages, timestamp)
+    else:
+        await exchange.process_messages(messages, timestamp)
+
+
+async def replay(exchange, records, clock, tail = 0, start = None):
+    '''
+    Feed journal records through the exchange in order, each batch stamped with its recorded timestamp and
+    handled once the loop reaches the time it was recorded at. clock is the exchange's ReplayClock. tail -
+    seconds to carry on for after the last batch, for speed-bumped orders to come out. start -
+    recorded timestamp the replay starts from, e.g. that of the snapshot the exchange was restored from;
+    by default that of the first batch. Orders expire, and FBA batches close and merge, as the journal
+    recorded: the exchange's expiries are held, and an FBA exchange's batch timer is not to be started.
+    Returns the number of messages replayed.
+    '''
+    loop = clock.loop
+    exchange.expiries.hold()
+    count = 0
+    if start is not None:
+        clock.reset(start)
+    for (timestamp, messages) in batches(records):
+        if count == 0 and start is None:
+            clock.reset(timestamp)
+        delay = clock.at(timestamp) - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        await apply_batch(exchange, messages, timestamp)
+        count += len(messages)
+    if tail:
+        await asyncio.sleep(tail)
+    await exchange.run_events()
+    return count
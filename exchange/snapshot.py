@@ -0,0 +1,144 @@
+import os
+import time
+import pickle
+import asyncio
+import logging as log
+from concurrent.futures import ThreadPoolExecutor
+
+from exchange.journal import read_journal
+from OuchServer.metrics import Metrics
+from exchange.replay import batches, apply_batch, ReplayPostOffice
+
+SNAPSHOT_MAGIC = b'EXSNAP\x00\x03'  # file type and format version, ahead of the pickled snapshot
+
+
+def take_snapshot(exchange, output_journal = None):
+    '''
+    The snapshot_state of the exchange as it is, with the sequence numbers of the last records in its journal
+    and in output_journal - the snapshot covers those records and none after - and the time it was taken at
+    '''
+    journal = exchange.journal
+    return {'sequence': journal.sequence if journal is not None else 0,
+            'output_sequence': output_journal.sequence if output_journal is not None else 0,
+            'timestamp': exchange.clock(),
+            'exchange': exchange.snapshot_state()}
+
+def write_snapshot(path, snapshot):
+    '''write snapshot to a temporary file, renamed over path once it is on disk, so path is always whole'''
+    temporary = path + '.tmp'
+    with open(temporary, 'wb') as f:
+        f.write(SNAPSHOT_MAGIC)
+        pickle.dump(snapshot, f, protocol = pickle.HIGHEST_PROTOCOL)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary, path)
+
+def read_snapshot(path):
+    with open(path, 'rb') as f:
+        if f.read(len(SNAPSHOT_MAGIC)) != SNAPSHOT_MAGIC:
+            raise ValueError('{} is not an exchange snapshot'.format(path))
+        return pickle.load(f)
+
+
+class Snapshotter:
+    '''
+    Writes a snapshot of an exchange to path every interval seconds. The engine task takes it between two
+    batches, so that no message is half handled in it, once what the exchange has queued to send is sent:
+    it copies the exchange's state out as plain data, and matching waits for that, about a microsecond per
+    live order (metrics['pause'], and benchmarks/bench_snapshot.py). A writer thread then pickles and writes
+    the copy while the engine goes back to matching. A snapshot falling due while the last is still to be
+    taken or written is skipped, as is one due while an FBA batch clears.
+    '''
+    def __init__(self, exchange, path, interval, output_journal = None):
+        self.exchange = exchange
+        self.path = path
+        self.interval = interval
+        self.output_journal = output_journal
+        self.loop = exchange.loop
+        self.timer = None       # TimerHandle of the next snapshot
+        self.requested = False  # whether the engine has a snapshot queued for it to take
+        self.closed = False
+        self.writer = ThreadPoolExecutor(max_workers = 1)
+        self.writing = None     # Future of the last snapshot's write
+        self.metrics = Metrics()    # pause: seconds the engine stopped for to take a snapshot
+
+    def start(self):
+        self.timer = self.loop.call_later(self.interval, self.due)
+
+    def due(self):
+        self.timer = self.loop.call_later(self.interval, self.due)
+        if self.requested:
+            log.warning('Snapshot skipped: the engine has yet to take the last one')
+        elif self.writing is not None and not self.writing.done():
+            log.warning('Snapshot skipped: the last one is still being written')
+        elif self.exchange.call_between_batches(self.take):
+            self.requested = True
+        else:
+            log.warning('Snapshot skipped: the inbound queue is full')
+
+    async def take(self):
+        self.requested = False
+        exchange = self.exchange
+        if self.closed:
+            return
+        if not exchange.can_snapshot():
+            log.info('Snapshot skipped: the exchange is half way through a batch')
+            return
+        await exchange.send_outgoing_messages()
+        await exchange.send_outgoing_broadcast_messages()
+        started = time.perf_counter()
+        snapshot = take_snapshot(exchange, self.output_journal)
+        self.metrics['pause'].record(time.perf_counter() - started)
+        self.writing = self.writer.submit(self.write, snapshot)
+
+    def write(self, snapshot):
+        try:
+            write_snapshot(self.path, snapshot)
+        except Exception:
+            log.exception('Writing snapshot %s failed', self.path)
+
+    def close(self):
+        '''stop taking snapshots, once the one being written is done'''
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        self.closed = True
+        self.writer.shutdown(wait = True)
+
+
+async def warm_start(exchange, snapshot, journal_path = None, settle = 0):
+    '''
+    Restore the exchange from snapshot (None to start from an empty one) and bring it up to date with the
+    records of the journal at journal_path after it, handled as fast as they can be, each batch stamped with
+    its recorded timestamp, orders expiring and FBA batches closing and merging as recorded. An FBA exchange's
+    batch timer is not to be started until it is done; a batch closed but not merged by the end of the
+    journal is merged by the timer's first close. What the exchange sends meanwhile went out
+    before the restart and is dropped; settle - seconds to carry on dropping it for, for the speed bump to
+    empty. Orders expire by the exchange's timers again once it is done, and the orders it restored are
+    detached from the client tokens of the process that entered them. Returns the number of messages
+    handled.
+    '''
+    outputs = ('order_reply', 'order_reply_batch', 'message_broadcast', 'message_broadcast_batch')
+    sinks = {name: getattr(exchange, name) for name in outputs}
+    post_office = ReplayPostOffice()
+    for name in outputs:
+        setattr(exchange, name, getattr(post_office, name))
+    exchange.expiries.hold()
+    try:
+        if snapshot is not None:
+            exchange.restore_state(snapshot['exchange'])
+        count = 0
+        if journal_path is not None:
+            after = snapshot['sequence'] if snapshot is not None else 0
+            for (timestamp, messages) in batches(read_journal(journal_path, after = after)):
+                await apply_batch(exchange, messages, timestamp)
+                count += len(messages)
+        if settle:
+            await asyncio.sleep(settle)
+        await exchange.run_events()
+        exchange.detach_owners()
+    finally:
+        for name in outputs:
+            setattr(exchange, name, sinks[name])
+        exchange.expiries.release()
+    return count
@@ -0,0 +1,111 @@
+import asyncio
+import unittest
+from exchange.exchange import Exchange, client_message
+from exchange.order_books.cda_book import CDABook
+from exchange.test_order_store import enter_order
+from OuchServer.ouch_messages import OuchClientMessages
+
+
+class FailingBook(CDABook):
+    def enter_buy(self, *args, **kwargs):
+        raise RuntimeError('broken book')
+
+async def ignore(messages):
+    pass
+
+def batch(*indices):
+    return [client_message(bytes(enter_order(index)), 0) for index in indices]
+
+class TestEngine(unittest.TestCase):
+
+    def run_engine(self, book, batches, events = ()):
+        '''
+        queue batches, and post events, for a new exchange's engine and run it until it has handled them, or has
+        stopped the loop
+        '''
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        asyncio.set_event_loop(loop)   # the exchange's queue binds to it before Python 3.10
+        self.addCleanup(asyncio.set_event_loop, None)
+        exchange = Exchange(book, None, loop, order_reply_batch = ignore, message_broadcast_batch = ignore,
+                            clock = lambda: 1)
+        for messages in batches:
+            exchange.inbound.put_nowait(messages)
+        for event in events:
+            exchange.post_event(event)
+        async def stop():
+            loop.stop()
+        exchange.call_between_batches(stop)
+        loop.call_soon(exchange.start_engine)
+        loop.run_forever()
+        def finish():
+            exchange.engine.cancel()
+            loop.run_until_complete(asyncio.gather(exchange.engine, return_exceptions = True))
+        self.addCleanup(finish)
+        return exchange
+
+    def test_engine_handles_batches(self):
+        exchange = self.run_engine(CDABook(), [batch(1), batch(2, 3)])
+        self.assertFalse(exchange.engine.done())
+        self.assertEqual(len(exchange.order_store.orders), 3)
+
+    def test_failed_batch_stops_the_engine_and_the_loop(self):
+        with self.assertLogs(level = 'CRITICAL'):
+            exchange = self.run_engine(FailingBook(), [batch(1), batch(2)])
+        self.assertIsInstance(exchange.engine.exception(), RuntimeError)
+        # nothing after the failed batch is handled
+        self.assertEqual(exchange.inbound.qsize(), 2)
+
+    def test_failed_event_stops_the_engine_and_the_loop(self):
+        async def fail():
+            raise RuntimeError('broken timer')
+        with self.assertLogs(level = 'CRITICAL'):
+            exchange = self.run_engine(CDABook(), [batch(1)], [fail])
+        self.assertIsInstance(exchange.engine.exception(), RuntimeError)
+        # events go before the batches queued with them
+        self.assertEqual(len(exchange.order_store.orders), 0)
+
+    def test_expiries_are_handled_by_the_engine(self):
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        asyncio.set_event_loop(loop)
+        self.addCleanup(asyncio.set_event_loop, None)
+        replies = []
+        async def order_reply_batch(messages):
+            replies.extend(message.message_type.name for message in messages)
+        exchange = Exchange(CDABook(), None, loop, order_reply_batch = order_reply_batch,
+                            message_broadcast_batch = ignore, clock = lambda: 1)
+        loop.run_until_complete(exchange.process_messages(batch(0, 1), 1))
+        exchange.on_expiry([0])
+        self.assertEqual((len(exchange.events), len(exchange.order_store.orders)), (1, 2))
+        loop.run_until_complete(exchange.run_events())
+        self.assertEqual(replies, ['Accepted'] * 2 + ['Canceled'])
+        self.assertEqual(list(exchange.order_store.orders), [1])
+
+class TestTokens(unittest.TestCase):
+
+    def test_retired_orders_release_their_ids_but_not_their_tokens(self):
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        asyncio.set_event_loop(loop)
+        self.addCleanup(asyncio.set_event_loop, None)
+        replies = []
+        async def order_reply_batch(messages):
+            replies.extend(message.message_type.name for message in messages)
+        exchange = Exchange(CDABook(), None, loop, order_reply_batch = order_reply_batch,
+                            message_broadcast_batch = ignore, clock = lambda: 1)
+        sell = enter_order(9)
+        sell['buy_sell_indicator'] = b'S'
+        sell['price'] = 100
+        cancel = OuchClientMessages.CancelOrder(order_token = enter_order(0)['order_token'], shares = 0)
+        for messages in (batch(0, 1), [client_message(bytes(sell), 0), client_message(bytes(cancel), 0)],
+                         batch(0, 1, 2)):
+            loop.run_until_complete(exchange.process_messages(messages, 1))
+        # 1 filled and 0 cancelled: entering either again is ignored, and 2 takes a released id
+        self.assertEqual(replies, ['Accepted'] * 3 + ['Executed'] * 2 + ['Canceled', 'Accepted'])
+        self.assertEqual(len(exchange.tokens), 1)
+        self.assertEqual(len(exchange.tokens.tokens), 3)
+        self.assertEqual(list(exchange.order_store.orders), [exchange.tokens.id_of(enter_order(2)['order_token'])])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+import unittest
+from exchange.expiry_scheduler import ExpiryScheduler
+
+
+class ManualLoop:
+    '''just enough of an event loop for ExpiryScheduler: a clock that only moves when told to, and timers'''
+    def __init__(self):
+        self.now = 0.0
+        self.timers = []
+
+    def time(self):
+        return self.now
+
+    def call_at(self, when, callback):
+        timer = ManualTimer(when, callback)
+        self.timers.append(timer)
+        return timer
+
+    def advance(self, seconds):
+        '''move the clock on, running the timers that come due in the order they are due'''
+        self.now += seconds
+        while True:
+            due = [timer for timer in self.timers if not timer.cancelled and timer.when <= self.now]
+            if not due:
+                break
+            timer = min(due, key = lambda timer: timer.when)
+            self.timers.remove(timer)
+            timer.callback()
+
+class ManualTimer:
+    def __init__(self, when, callback):
+        self.when = when
+        self.callback = callback
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class TestExpiryScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = ManualLoop()
+        self.expired = []
+        self.scheduler = ExpiryScheduler(self.loop, self.expired.append, tick = 0.01)
+
+    def test_expires_in_order_of_scheduling_within_a_tick(self):
+        for token in ('a', 'b', 'c'):
+            self.scheduler.schedule(token, 0.005)
+        self.scheduler.schedule('later', 0.5)
+        self.loop.advance(0.01)
+        self.assertEqual(self.expired, [['a', 'b', 'c']])
+        self.assertEqual(len(self.scheduler), 1)
+        self.loop.advance(0.5)
+        self.assertEqual(self.expired, [['a', 'b', 'c'], ['later']])
+        self.assertEqual(len(self.scheduler), 0)
+        self.assertIsNone(self.scheduler.timer)
+
+    def test_unschedule_and_reschedule(self):
+        self.scheduler.schedule('a', 0.1)
+        self.scheduler.schedule('b', 0.1)
+        self.scheduler.unschedule('a')
+        self.scheduler.unschedule('missing')
+        self.scheduler.schedule('b', 0.3)
+        self.assertNotIn('a', self.scheduler)
+        self.loop.advance(0.2)
+        self.assertEqual(self.expired, [])
+        self.loop.advance(0.1)
+        self.assertEqual(self.expired, [['b']])
+
+    def test_earlier_expiry_rearms_the_timer(self):
+        self.scheduler.schedule('late', 1)
+        self.scheduler.schedule('early', 0.05)
+        self.assertEqual(self.scheduler.timer_tick, 5)
+        self.loop.advance(0.05)
+        self.assertEqual(self.expired, [['early']])
+        self.assertEqual(self.scheduler.timer_tick, 100)
+
+    def test_late_timer_fires_every_tick_due(self):
+        self.scheduler.schedule('a', 0.01)
+        self.scheduler.schedule('b', 0.02)
+        self.loop.now = 0.05    # the loop was busy past both ticks
+        self.scheduler.fire()
+        self.assertEqual(self.expired, [['a', 'b']])
+
+    def test_remaining(self):
+        self.scheduler.schedule('b', 0.2)
+        self.scheduler.schedule('a', 0.1)
+        self.loop.now = 0.05
+        self.assertEqual([(token, round(seconds, 6)) for (token, seconds) in self.scheduler.remaining()],
+                         [('a', 0.05), ('b', 0.15)])
+
+    def test_clear(self):
+        self.scheduler.schedule('a', 0.1)
+        timer = self.scheduler.timer
+        self.scheduler.clear()
+        self.assertTrue(timer.cancelled)
+        self.assertEqual((len(self.scheduler), self.scheduler.remaining()), (0, []))
+        self.loop.advance(1)
+        self.assertEqual(self.expired, [])
+        self.scheduler.schedule('b', 0.1)
+        self.loop.advance(0.1)
+        self.assertEqual(self.expired, [['b']])
+
+    def test_hold_and_release(self):
+        self.scheduler.schedule('a', 0.05)
+        self.scheduler.hold()
+        self.scheduler.schedule('b', 0.05)
+        self.scheduler.schedule('c', 0.5)
+        self.scheduler.unschedule('b')
+        self.loop.advance(0.1)
+        self.assertEqual(self.expired, [])
+        self.assertIsNone(self.scheduler.timer)
+        self.scheduler.release()
+        self.loop.advance(0)
+        self.assertEqual(self.expired, [['a']])
+        self.loop.advance(0.5)
+        self.assertEqual(self.expired, [['a'], ['c']])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+import asyncio
+import threading
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from exchange.exchange import client_message
+from exchange.fba_exchange import FBAExchange
+from exchange.order_books.fba_book import FBABook
+from exchange.test_order_store import enter_order
+from OuchServer.ouch_messages import OuchClientMessages, OuchServerMessages
+
+
+class GatedBook(FBABook):
+    '''an FBABook whose batch_process waits for gate, with the orders it fills already out of its index'''
+    def __init__(self, gate):
+        super().__init__()
+        self.gate = gate
+
+    def freeze(self):
+        next_book = super().freeze()
+        next_book.gate = self.gate
+        return next_book
+
+    def batch_process(self):
+        result = super().batch_process()
+        self.gate.wait()
+        return result
+
+def cancel(index):
+    return client_message(bytes(OuchClientMessages.CancelOrder(order_token = enter_order(index)['order_token'],
+                                                               shares = 0)), 0)
+
+class TestBufferedBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+        asyncio.set_event_loop(self.loop)
+        self.addCleanup(asyncio.set_event_loop, None)
+        executor = ThreadPoolExecutor(max_workers = 1)
+        self.addCleanup(executor.shutdown)
+        self.gate = threading.Event()
+        self.addCleanup(self.gate.set)
+        self.replies = []
+        async def order_reply_batch(messages):
+            self.replies.extend(messages)
+        async def ignore(messages):
+            pass
+        self.exchange = FBAExchange(1, GatedBook(self.gate), None, self.loop, clearing_executor = executor,
+                                    order_reply_batch = order_reply_batch, message_broadcast_batch = ignore,
+                                    clock = lambda: 1)
+
+    def test_cancels_of_the_clearing_batch_wait_for_the_merge(self):
+        exchange = self.exchange
+        sell = enter_order(1)
+        sell['buy_sell_indicator'] = b'S'
+        sell['price'] = 100
+        low_bid = enter_order(2)
+        low_bid['price'] = 99
+        self.loop.run_until_complete(exchange.process_messages(
+            [client_message(bytes(order), 0) for order in (enter_order(0), sell, low_bid)]))
+        async def run():
+            batch = asyncio.ensure_future(exchange.run_batch_buffered())
+            while exchange.clearing_book is None:
+                await asyncio.sleep(0)
+            # the executor drops 0 and 1 from the book's index as it fills them; the loop reads the ids frozen
+            self.assertEqual(exchange.clearing_ids, {0, 1, 2})
+            await exchange.process_messages([cancel(0), cancel(2)])
+            self.assertEqual(len(exchange.deferred), 2)
+            self.gate.set()
+            await batch
+            await exchange.send_outgoing_messages()
+        self.loop.run_until_complete(run())
+        self.assertEqual(exchange.clearing_ids, frozenset())
+        types = [message.message_type for message in self.replies[3:]]
+        self.assertEqual(types, [OuchServerMessages.Executed] * 2 + [OuchServerMessages.Canceled])
+        self.assertNotIn(2, exchange.order_book)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+import os
+import tempfile
+import unittest
+from concurrent.futures import Future
+from exchange.exchange import client_message
+from exchange.journal import (Journal, JournalRecord, RECORD_HEADER, BROADCAST, read_journal, read_segment,
+    segment_indices, segment_path)
+from exchange.test_order_store import enter_order
+
+
+def message(index, client_token = 0):
+    return client_message(bytes(enter_order(index)), client_token)
+
+MESSAGE_SIZE = len(bytes(enter_order(0)))
+RECORD_SIZE = RECORD_HEADER.size + MESSAGE_SIZE
+
+class TestJournal(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'journal')
+
+    def open(self, records_per_segment = 100):
+        return Journal(self.path, None, segment_size = records_per_segment * RECORD_SIZE, commit_interval = 0)
+
+    def test_records_round_trip(self):
+        journal = self.open()
+        journal.append_batch([message(1, 4), message(2, None)], 1000)
+        self.assertEqual(journal.append(message(3), BROADCAST, -5), 3)
+        journal.close()
+        self.assertEqual(list(read_journal(self.path)), [
+            JournalRecord(1, 1000, 4, bytes(enter_order(1))),
+            JournalRecord(2, 1000, None, bytes(enter_order(2))),
+            JournalRecord(3, -5, BROADCAST, bytes(enter_order(3)))])
+        # the header is little endian sequence, timestamp, client token and length, ahead of the message
+        with open(segment_path(self.path, 0), 'rb') as f:
+            self.assertEqual(RECORD_HEADER.unpack(f.read(RECORD_HEADER.size)), (1, 1000, 4, MESSAGE_SIZE))
+        self.assertEqual(segment_indices(self.path), [0])
+
+    def test_roll_keeps_order(self):
+        journal = self.open(records_per_segment = 3)
+        for index in range(1, 11):
+            journal.next_segment.result()   # as it is in time unless segments fill up faster than they are allocated
+            journal.append_batch([message(index, index)], index)
+        journal.close()
+        self.assertEqual(segment_indices(self.path), [0, 1, 2, 3])
+        self.assertEqual([len(list(read_segment(segment_path(self.path, index)))) for index in range(4)],
+                         [3, 3, 3, 1])
+        records = list(read_journal(self.path))
+        self.assertEqual([(record.sequence, record.timestamp, record.client_token) for record in records],
+                         [(index, index, index) for index in range(1, 11)])
+        self.assertEqual([record.data for record in records], [bytes(enter_order(index)) for index in range(1, 11)])
+        self.assertEqual([record.sequence for record in read_journal(self.path, after = 7)], [8, 9, 10])
+
+    def test_reopen_after_crash(self):
+        journal = self.open(records_per_segment = 3)
+        for index in range(1, 6):
+            journal.next_segment.result()
+            journal.append(message(index), 0, index)
+        journal.commit()
+        journal.next_segment.result()
+        # the process dies: nothing is closed, and the next segment is left allocated and empty
+        journal.preparer.shutdown(wait = True)
+        journal.io.shutdown(wait = True)
+        self.assertEqual(segment_indices(self.path), [0, 1, 2])
+        self.assertEqual(list(read_segment(segment_path(self.path, 2))), [])
+
+        reopened = self.open(records_per_segment = 3)
+        self.assertEqual((reopened.sequence, reopened.segment_index), (5, 3))
+        for index in range(6, 9):
+            reopened.next_segment.result()
+            reopened.append(message(index), 0, index)
+        reopened.close()
+        self.assertEqual([record.sequence for record in read_journal(self.path)], list(range(1, 9)))
+        self.assertEqual([record.data for record in read_journal(self.path, after = 4)],
+                         [bytes(enter_order(index)) for index in range(5, 9)])
+
+    def test_roll_before_the_next_segment_is_started(self):
+        journal = self.open(records_per_segment = 2)
+        journal.next_segment.result().close()
+        journal.next_segment = Future()     # queued behind another allocation: it is taken over here
+        for index in range(1, 4):
+            journal.append(message(index), 0, index)
+        self.assertEqual((journal.segment_index, journal.metrics['allocate'].count), (1, 1))
+        journal.close()
+        self.assertEqual(segment_indices(self.path), [0, 1])
+        self.assertEqual([record.sequence for record in read_journal(self.path)], [1, 2, 3])
+
+    def test_roll_while_the_next_segment_is_allocated(self):
+        journal = self.open(records_per_segment = 2)
+        prepared = journal.next_segment.result()
+        journal.next_segment = allocating = Future()
+        allocating.set_running_or_notify_cancel()
+        for index in range(1, 4):
+            journal.append(message(index), 0, index)
+        # the segment being allocated is skipped, and removed once it is done
+        self.assertEqual((journal.segment_index, journal.metrics['allocate'].count), (2, 1))
+        allocating.set_result(prepared)
+        journal.close()
+        self.assertEqual(segment_indices(self.path), [0, 2])
+        self.assertEqual([record.sequence for record in read_journal(self.path)], [1, 2, 3])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+import os
+import tempfile
+import unittest
+from OuchServer.ouch_messages import OuchClientMessages
+from exchange.order_store import OrderStore
+
+
+def enter_order(index):
+    return OuchClientMessages.EnterOrder(
+        order_token='{:014d}'.format(index).encode('ascii'), buy_sell_indicator=b'B', shares=10,
+        stock=b'AMAZGOOG', price=100 + index, time_in_force=99999, firm=b'OUCH', display=b'N',
+        capacity=b'O', intermarket_sweep_eligibility=b'N', minimum_quantity=1, cross_type=b'N',
+        customer_type=b' ', midpoint_peg=False)
+
+class TestOrderStoreArchive(unittest.TestCase):
+
+    def test_retired_orders_archived_in_order_by_close(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'archive')
+            store = OrderStore(archive_path = path, archive_chunk = 4)
+            for index in range(10):
+                store.store_order(index, enter_order(index))
+                store.execute_quantity(index, index % 3)
+            for index in range(10):
+                store.retire(index)
+            self.assertEqual(len(store.archive_lines), 2)    # two chunks went to the writer, two lines wait
+            store.close()
+            with open(path) as f:
+                lines = [line.split('\t') for line in f]
+            self.assertEqual([(token, price, remaining) for (token, _, price, remaining, _, _) in lines],
+                             [('{:014d}'.format(index), str(100 + index), str(10 - index % 3)) for index in range(10)])
+            self.assertEqual(store.orders, {})
+
+class TestOrderStore(unittest.TestCase):
+
+    def test_entries_keep_fields_not_messages(self):
+        read = memoryview(b''.join(bytes(enter_order(index)) for index in range(3)))
+        size = len(read) // 3
+        message = OuchClientMessages.EnterOrder.view(read, size)
+        message.meta = 7
+        store = OrderStore()
+        entry = store.store_order(1, message)
+        self.assertEqual(entry.snapshot(), (b'00000000000001', b'B', 101, 10, 10, 0, 7, b'AMAZGOOG', b'OUCH', False))
+        self.assertFalse(any(isinstance(value, memoryview) for value in entry.snapshot()))
+        replace = OuchClientMessages.ReplaceOrder(existing_order_token = entry.token,
+            replacement_order_token = b'00000000000009', shares = 4, price = 99, time_in_force = 99999,
+            display = b'N', intermarket_sweep_eligibility = b'N', minimum_quantity = 1)
+        replace.meta = 8
+        replacement = store.store_order(9, replace, original = entry)
+        self.assertEqual(replacement.snapshot(), (b'00000000000009', b'B', 99, 4, 4, 0, 8, b'AMAZGOOG', b'OUCH', False))
+        self.assertIs(replacement.stock, entry.stock)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,153 @@
+import os
+import asyncio
+import tempfile
+import unittest
+from random import Random
+from concurrent.futures import Executor, Future
+from exchange.exchange import Exchange, client_message
+from exchange.fba_exchange import FBAExchange
+from exchange.journal import Journal, OutputJournal, read_journal, BATCH
+from exchange.order_books.cda_book import CDABook
+from exchange.order_books.fba_book import FBABook
+from exchange.replay import VirtualTimeLoop, InlineExecutor, ReplayClock, ReplayPostOffice, replay
+from exchange.test_order_store import enter_order
+from OuchServer.ouch_messages import OuchClientMessages
+
+async def ignore(messages):
+    pass
+
+def session(rng, count, cancels = False):
+    '''
+    (seconds, messages) batches of a client session: orders on both sides, some crossing, with times in force,
+    and with cancels, every fourth batch a cancel of an earlier order too
+    '''
+    t = 0.0
+    batches = []
+    for index in range(count):
+        t += rng.uniform(0.01, 0.4)
+        order = enter_order(index)
+        order['buy_sell_indicator'] = rng.choice((b'B', b'S'))
+        order['price'] = rng.randrange(95, 106)
+        order['time_in_force'] = rng.choice((1, 2, 3, 99999))
+        messages = [client_message(bytes(order), rng.randrange(3) * 2)]
+        if cancels and index % 4 == 3:
+            cancel = OuchClientMessages.CancelOrder(order_token = enter_order(rng.randrange(index))['order_token'],
+                                                    shares = 0)
+            messages.append(client_message(bytes(cancel), 0))
+        batches.append((t, messages))
+    return batches
+
+def cda_exchange(loop, **kwargs):
+    return Exchange(CDABook(), None, loop, **kwargs)
+
+class SlowExecutor(Executor):
+    '''
+    Runs what is submitted to it up to most seconds later on the loop's clock, as a thread clearing a batch
+    while orders keep coming would, but on a simulated clock
+    '''
+    def __init__(self, loop, most):
+        self.loop = loop
+        self.most = most
+        self.rng = Random(5)
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        def run():
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except BaseException as exc:
+                future.set_exception(exc)
+        self.loop.call_later(self.rng.uniform(0, self.most), run)
+        return future
+
+def fba_exchange(slow = False):
+    '''
+    builds FBA exchanges with half second batches, shuffled from a seed; slow - whether batches clear up to 0.7
+    seconds after they close, and so at times after the next one is due, rather than at once
+    '''
+    def build(loop, **kwargs):
+        executor = SlowExecutor(loop, 0.7) if slow else InlineExecutor()
+        return FBAExchange(0.5, FBABook(shuffle_seed = 3), None, loop, clearing_executor = executor, **kwargs)
+    return build
+
+class TestReplay(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.inbound = os.path.join(directory.name, 'in')
+        self.outbound = os.path.join(directory.name, 'out')
+
+    def record(self, batches, jitter, build = cda_exchange):
+        '''
+        run an exchange from build live on a simulated clock over batches, journaling what it receives and
+        sends; its timers, expiries included, fire up to jitter seconds late, and its clock is read a little
+        after them
+        '''
+        loop = VirtualTimeLoop(start = 1000.0)
+        self.addCleanup(loop.close)
+        asyncio.set_event_loop(loop)   # the exchange's queue binds to it before Python 3.10
+        self.addCleanup(asyncio.set_event_loop, None)
+        rng = Random(2)
+        journal = Journal(self.inbound, loop, commit_interval = 0)
+        output_journal = Journal(self.outbound, loop, commit_interval = 0)
+        clock = lambda: int(loop.time() * 1e9) + rng.randrange(int(jitter * 1e9) + 1)
+        recorder = OutputJournal(output_journal, ignore, ignore, clock)
+        exchange = build(loop, order_reply_batch = recorder.order_reply_batch,
+                         message_broadcast_batch = recorder.message_broadcast_batch, journal = journal, clock = clock)
+        async def run():
+            if isinstance(exchange, FBAExchange):
+                exchange.start()
+            exchange.start_engine()
+            start = loop.time()
+            for (t, messages) in batches:
+                await asyncio.sleep(start + t + rng.uniform(0, jitter) - loop.time())
+                await exchange.enqueue_messages(messages)
+            await asyncio.sleep(5)
+            exchange.engine.cancel()
+            if isinstance(exchange, FBAExchange):
+                exchange.batch_timer.cancel()
+        loop.run_until_complete(run())
+        journal.close()
+        output_journal.close()
+
+    def replay(self, build = cda_exchange):
+        loop = VirtualTimeLoop()
+        self.addCleanup(loop.close)
+        asyncio.set_event_loop(loop)
+        self.addCleanup(asyncio.set_event_loop, None)
+        clock = ReplayClock(loop)
+        post_office = ReplayPostOffice(read_journal(self.outbound))
+        exchange = build(loop, order_reply_batch = post_office.order_reply_batch,
+                         message_broadcast_batch = post_office.message_broadcast_batch, clock = clock)
+        loop.run_until_complete(replay(exchange, read_journal(self.inbound), clock, tail = 5))
+        return post_office
+
+    def test_replay_reproduces_the_session(self):
+        for jitter in (0, 0.003):
+            self.record(session(Random(9), 200), jitter)
+            post_office = self.replay()
+            self.assertIsNone(post_office.mismatch, jitter)
+            self.assertEqual(post_office.unsent(), 0, jitter)
+            self.assertGreater(post_office.sent, 400)
+            self.clear_journals()
+
+    def test_replay_runs_the_journaled_fba_batches(self):
+        # cancels and expiries of orders in a batch still clearing wait for it to merge, which the replay's
+        # batches, cleared at once, only reproduce from the merges journaled
+        for jitter in (0, 0.003):
+            self.record(session(Random(9), 200, cancels = True), jitter, fba_exchange(slow = True))
+            self.assertGreater(sum(record.client_token == BATCH for record in read_journal(self.inbound)), 150)
+            post_office = self.replay(fba_exchange())
+            self.assertIsNone(post_office.mismatch, jitter)
+            self.assertEqual(post_office.unsent(), 0, jitter)
+            self.assertGreater(post_office.sent, 400)
+            self.clear_journals()
+
+    def clear_journals(self):
+        directory = os.path.dirname(self.inbound)
+        for name in os.listdir(directory):
+            os.remove(os.path.join(directory, name))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+import os
+import asyncio
+import tempfile
+import unittest
+from random import Random
+from exchange.exchange import Exchange, client_message
+from exchange.journal import Journal
+from exchange.order_books.cda_book import CDABook
+from exchange.replay import VirtualTimeLoop
+from exchange.snapshot import take_snapshot, write_snapshot, read_snapshot, warm_start, Snapshotter
+from exchange.test_order_store import enter_order
+from exchange.test_replay import session, fba_exchange
+from OuchServer.ouch_messages import OuchServerMessages
+
+async def ignore(messages):
+    pass
+
+class TestWarmStart(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'snap')
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+        asyncio.set_event_loop(self.loop)   # the exchange's queue binds to it before Python 3.10
+        self.addCleanup(asyncio.set_event_loop, None)
+
+    def exchange(self, order_reply_batch = ignore):
+        return Exchange(CDABook(), None, self.loop, order_reply_batch = order_reply_batch,
+                        message_broadcast_batch = ignore, clock = lambda: 1)
+
+    def test_restored_orders_are_detached_from_the_old_clients(self):
+        before = self.exchange()
+        self.loop.run_until_complete(before.process_messages([client_message(bytes(enter_order(0)), 2)], 1))
+        write_snapshot(self.path, take_snapshot(before))
+
+        replies = []
+        async def order_reply_batch(messages):
+            replies.extend((message.meta, message.message_type) for message in messages)
+        after = self.exchange(order_reply_batch)
+        self.loop.run_until_complete(warm_start(after, read_snapshot(self.path)))
+        self.assertEqual([entry.owner for entry in after.order_store.orders.values()], [None])
+        # client token 2 names some other client in this process: the resting order's fill goes to nobody
+        sell = enter_order(1)
+        sell['buy_sell_indicator'] = b'S'
+        sell['price'] = 100
+        self.loop.run_until_complete(after.process_messages([client_message(bytes(sell), 2)], 2))
+        executed = [meta for (meta, message_type) in replies if message_type == OuchServerMessages.Executed]
+        self.assertEqual(sorted(executed, key = str), [2, None])
+
+    def test_fba_warm_start_runs_the_journaled_batches(self):
+        # live, on a simulated clock, with batches clearing a while after they close; snapshot half way through
+        loop = VirtualTimeLoop(start = 1000.0)
+        self.addCleanup(loop.close)
+        asyncio.set_event_loop(loop)
+        journal_path = self.path + '.in'
+        journal = Journal(journal_path, loop, commit_interval = 0)
+        live = fba_exchange(slow = True)(loop, order_reply_batch = ignore, message_broadcast_batch = ignore,
+                                         journal = journal, clock = lambda: int(loop.time() * 1e9))
+        async def take():
+            if live.can_snapshot() and not os.path.exists(self.path):
+                write_snapshot(self.path, take_snapshot(live))
+        async def run():
+            live.start()
+            live.start_engine()
+            start = loop.time()
+            for (index, (t, messages)) in enumerate(session(Random(4), 120, cancels = True)):
+                await asyncio.sleep(start + t - loop.time())
+                await live.enqueue_messages(messages)
+                if index >= 60:
+                    live.call_between_batches(take)
+            await asyncio.sleep(2)
+            live.batch_timer.cancel()
+            live.engine.cancel()
+            await live.run_batch_merge()
+        loop.run_until_complete(run())
+        journal.close()
+
+        after = fba_exchange()(loop, order_reply_batch = ignore, message_broadcast_batch = ignore,
+                               clock = lambda: int(loop.time() * 1e9))
+        count = loop.run_until_complete(warm_start(after, read_snapshot(self.path), journal_path))
+        self.assertGreater(count, 100)
+        # every batch closed and merged just where it did live: the same fills, the same orders left
+        self.assertEqual(after.next_match_number, live.next_match_number)
+        self.assertGreater(live.next_match_number, 20)
+        self.assertEqual(after.order_book.snapshot_state(), live.order_book.snapshot_state())
+        self.assertEqual({order_id: entry.snapshot()[:6] for (order_id, entry) in after.order_store.orders.items()},
+                         {order_id: entry.snapshot()[:6] for (order_id, entry) in live.order_store.orders.items()})
+
+class TestSnapshotter(unittest.TestCase):
+
+    def test_snapshot_taken_between_batches_and_written_by_the_writer(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'snap')
+            loop = asyncio.new_event_loop()
+            self.addCleanup(loop.close)
+            asyncio.set_event_loop(loop)
+            self.addCleanup(asyncio.set_event_loop, None)
+            exchange = Exchange(CDABook(), None, loop, order_reply_batch = ignore,
+                                message_broadcast_batch = ignore, clock = lambda: 1)
+            for index in range(3):
+                exchange.inbound.put_nowait([client_message(bytes(enter_order(index)), 0)])
+            snapshotter = Snapshotter(exchange, path, interval = 0.01)
+            async def run():
+                exchange.start_engine()
+                snapshotter.start()
+                while snapshotter.writing is None:
+                    await asyncio.sleep(0.01)
+                snapshotter.close()
+                exchange.engine.cancel()
+                await asyncio.gather(exchange.engine, return_exceptions = True)
+            loop.run_until_complete(run())
+            self.assertIsNone(snapshotter.writing.exception())
+            self.assertEqual(snapshotter.metrics['pause'].count, 1)
+            snapshot = read_snapshot(path)
+            self.assertEqual(len(snapshot['exchange']['orders']), 3)
+            self.assertFalse(os.path.exists(path + '.tmp'))
+
+if __name__ == '__main__':
+    unittest.main()
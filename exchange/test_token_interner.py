@@ -0,0 +1,68 @@
+import pickle
+import unittest
+from exchange.token_interner import TokenInterner, UsedTokens
+
+
+def token(index):
+    return '{:014d}'.format(index).encode('ascii')
+
+class TestTokenInterner(unittest.TestCase):
+
+    def test_released_ids_are_reused_and_tokens_stay_used(self):
+        tokens = TokenInterner()
+        self.assertEqual([tokens.intern(token(index)) for index in range(3)], [0, 1, 2])
+        self.assertEqual(tokens.intern(token(1)), 1)
+        tokens.release(1)
+        tokens.release(0)
+        self.assertIsNone(tokens.id_of(token(1)))
+        self.assertIn(token(1), tokens)
+        self.assertNotIn(token(3), tokens)
+        self.assertEqual([tokens.intern(token(index)) for index in (3, 4, 5)], [0, 1, 3])
+        self.assertEqual(len(tokens), 4)
+        self.assertEqual((tokens.token(0), tokens.token(1)), (token(3), token(4)))
+
+    def test_snapshot_restores_ids_free_ids_and_used_tokens(self):
+        tokens = TokenInterner()
+        for index in range(10):
+            tokens.intern(token(index))
+        for order_id in (7, 2, 5):
+            tokens.release(order_id)
+        restored = TokenInterner()
+        restored.restore(pickle.loads(pickle.dumps(tokens.snapshot())))
+        self.assertEqual(restored.ids, tokens.ids)
+        self.assertIn(token(2), restored)
+        self.assertEqual([restored.intern(token(index)) for index in (10, 11, 12, 13)],
+                         [tokens.intern(token(index)) for index in (10, 11, 12, 13)])
+
+    def test_clear(self):
+        tokens = TokenInterner()
+        tokens.release(tokens.intern(token(0)))
+        tokens.clear()
+        self.assertNotIn(token(0), tokens)
+        self.assertEqual(tokens.intern(token(0)), 0)
+
+class TestUsedTokens(unittest.TestCase):
+
+    def test_membership_through_growth(self):
+        used = UsedTokens(capacity = 4)
+        for index in range(0, 2000, 2):
+            used.add(token(index))
+            used.add(token(index))
+        self.assertEqual(len(used), 1000)
+        self.assertGreaterEqual(used.capacity * 3, len(used) * 4)
+        self.assertTrue(all(token(index) in used for index in range(0, 2000, 2)))
+        self.assertFalse(any(token(index) in used for index in range(1, 2000, 2)))
+
+    def test_short_tokens_and_packing(self):
+        used = UsedTokens()
+        for value in (b'', b'a', b'a\0', b'abc', token(7)):
+            used.add(value)
+        self.assertNotIn(b'ab', used)
+        restored = UsedTokens.unpacked(pickle.loads(pickle.dumps(used.packed())))
+        self.assertEqual(len(restored), 5)
+        self.assertTrue(all(value in restored for value in (b'', b'a', b'a\0', b'abc', token(7))))
+        with self.assertRaises(ValueError):
+            used.add(b'x' * 15)
+
+if __name__ == '__main__':
+    unittest.main()
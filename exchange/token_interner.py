@@ -0,0 +1,156 @@
+class TokenInterner:
+    '''
+    Dense integer ids for the order tokens of live orders. A token is given an id when the order it names
+    is stored, and the exchange works with the id from then on - in the order store, the books and the
+    expiries - turning it back into the token only for outgoing messages. Once the order is retired its id
+    is released and given to the next new token, so ids stay as few as the live orders.
+    Every token interned is also recorded in used until clear(), so a token that has been used can be
+    recognised as such after its order is gone.
+    '''
+    def __init__(self):
+        self.ids = {}       # token -> id, for live orders
+        self.tokens = []    # id -> token, None for a released id
+        self.free = []      # released ids, the last released given out first
+        self.used = UsedTokens()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, token):
+        '''whether token has been used, by a live order or a retired one'''
+        return token in self.used
+
+    def intern(self, token):
+        '''id of token, giving it a free one if it has none yet'''
+        order_id = self.ids.get(token)
+        if order_id is None:
+            if self.free:
+                order_id = self.free.pop()
+                self.tokens[order_id] = token
+            else:
+                order_id = len(self.tokens)
+                self.tokens.append(token)
+            self.ids[token] = order_id
+            self.used.add(token)
+        return order_id
+
+    def id_of(self, token):
+        '''id of token, None if no live order has it'''
+        return self.ids.get(token)
+
+    def token(self, order_id):
+        return self.tokens[order_id]
+
+    def release(self, order_id):
+        '''free the id of a retired order; its token stays used'''
+        token = self.tokens[order_id]
+        self.tokens[order_id] = None
+        del self.ids[token]
+        self.free.append(order_id)
+
+    def snapshot(self):
+        '''the interner as plain data: the token of each id, None for the free ones, the free ids and used'''
+        return (list(self.tokens), list(self.free), self.used.packed())
+
+    def restore(self, state):
+        '''take up a snapshot() in place of the interner's own ids and used tokens'''
+        (tokens, free, used) = state
+        self.tokens = list(tokens)
+        self.ids = {token: order_id for (order_id, token) in enumerate(tokens) if token is not None}
+        self.free = list(free)
+        self.used = UsedTokens.unpacked(used)
+
+    def clear(self):
+        self.ids.clear()
+        self.tokens.clear()
+        self.free.clear()
+        self.used = UsedTokens()
+
+
+class UsedTokens:
+    '''
+    Set of the order tokens used in a session, for the duplicate token check. It only ever grows, so it
+    keeps each token as a fixed size slot of one bytearray hash table, probed linearly, rather than as a
+    bytes object and a set entry: 20 to 40 bytes a token instead of 75 to 90. A slot is the token's length
+    plus one (0 for an empty slot) followed by the token, padded to width.
+    '''
+    def __init__(self, width = 14, capacity = 1024):
+        '''
+        width - the longest token, 14 bytes for OUCH order tokens
+        capacity - slots to start with, a power of two; the table doubles once it is three quarters full
+        '''
+        self.width = width
+        self.slot_size = width + 1
+        self.full = bytes((width + 1,))     # the length byte of a full width token
+        self.capacity = capacity
+        self.table = bytearray(capacity * self.slot_size)
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def slot(self, token):
+        '''the slot token is in, or the empty one it would go in, and the slot's content for token'''
+        length = len(token)
+        if length == self.width:
+            record = self.full + token
+        elif length < self.width:
+            record = bytes((length + 1,)) + token.ljust(self.width, b'\0')
+        else:
+            raise ValueError('token {!r} is longer than {} bytes'.format(token, self.width))
+        table = self.table
+        slot_size = self.slot_size
+        mask = self.capacity - 1
+        index = hash(token) & mask
+        while True:
+            start = index * slot_size
+            if table[start] == 0 or table[start:start + slot_size] == record:
+                return start, record
+            index = (index + 1) & mask
+
+    def __contains__(self, token):
+        (start, _) = self.slot(token)
+        return self.table[start] != 0
+
+    def add(self, token):
+        (start, record) = self.slot(token)
+        if self.table[start] != 0:
+            return
+        self.table[start:start + self.slot_size] = record
+        self.count += 1
+        if self.count * 4 > self.capacity * 3:
+            self.grow()
+
+    def grow(self):
+        records = self.records()
+        self.capacity *= 2
+        self.table = bytearray(self.capacity * self.slot_size)
+        self.count = 0
+        for record in records:
+            self.add(record[1:record[0]])
+
+    def records(self):
+        slot_size = self.slot_size
+        table = self.table
+        return [bytes(table[start:start + slot_size]) for start in range(0, len(table), slot_size) if table[start]]
+
+    def packed(self):
+        '''
+        the tokens as plain data for a snapshot: width, and a copy of the table, which is all the engine waits
+        for; its slots are only sorted out again by unpacked, which hashes the tokens anew, as hashes of bytes
+        differ from one process to the next
+        '''
+        return (self.width, bytes(self.table))
+
+    @classmethod
+    def unpacked(cls, packed):
+        (width, data) = packed
+        slot_size = width + 1
+        tokens = [data[start + 1:start + data[start]] for start in range(0, len(data), slot_size) if data[start]]
+        capacity = 1024
+        while len(tokens) * 4 > capacity * 3:
+            capacity *= 2
+        used = cls(width, capacity)
+        for token in tokens:
+            used.add(token)
+        return used
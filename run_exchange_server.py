@@ -1,64 +1,151 @@
+import os
 import sys
 import asyncio
 import configargparse
 import logging as log
 from functools import partial
-from OuchServer.ouch_server import ProtocolMessageServer
+from OuchServer.ouch_server import ProtocolMessageServer, nanoseconds_since_midnight
 from OuchServer.ouch_messages import OuchClientMessages, OuchServerMessages
 from exchange.order_books.cda_book import CDABook
 from exchange.order_books.fba_book import FBABook
+from exchange.order_books.numpy_batch_engine import NumpyBatchEngine, np
 from exchange.order_books.iex_book import IEXBook
 from exchange.exchange import Exchange
 from exchange.fba_exchange import FBAExchange
 from exchange.iex_exchange import IEXExchange
+from exchange.order_store import OrderStore
+from exchange.journal import Journal, OutputJournal
+from exchange.snapshot import Snapshotter, read_snapshot, warm_start
 from exchange.order_books.book_logging import BookLogger
+from exchange.order_books.list_elements import BisectIndexedDefaultList, DenseIndexedDefaultList
 
-p = configargparse.getArgParser()
-p.add('--port', default=12345)
-p.add('--host', default='127.0.0.1', help="Address to bind to / listen on")
-p.add('--debug', action='store_true')
-p.add('--logfile', default=None, type=str)
-p.add('--inputlogfile', default=None, type=str)
-p.add('--outputlogfile', default=None, type=str)
-p.add('--book_log', default=None)
-p.add('--mechanism', choices=['cda', 'fba', 'iex'], default = 'cda')
-p.add('--interval', default = None, type=float, help="(FBA) Interval between batch auctions in seconds")
-p.add('--delay', default = None, type=float, help="(IEX) 'speed bump' time that orders are delayed before being entered")
-options, args = p.parse_known_args()
+def arg_parser():
+    '''the server's options, on a parser of their own, which run_replay.py adds its own options to'''
+    p = configargparse.ArgParser()
+    p.add('--port', default=12345)
+    p.add('--host', default='127.0.0.1', help="Address to bind to / listen on")
+    p.add('--debug', action='store_true')
+    p.add('--logfile', default=None, type=str)
+    p.add('--inputlogfile', default=None, type=str, help="Journal inbound messages to segment files with this prefix")
+    p.add('--journal_commit_interval', default=0.01, type=float,
+        help="Seconds between flushes of the journal to disk, 0 to flush after every batch, negative to leave it to the OS")
+    p.add('--journal_segment_size', default=64 << 20, type=int, help="Bytes preallocated for each journal segment file")
+    p.add('--outputlogfile', default=None, type=str, help="Journal outgoing messages to segment files with this prefix, for replays to check against")
+    p.add('--snapshot_file', default=None, type=str, help="Write snapshots of the book and the live orders to this file")
+    p.add('--snapshot_interval', default=60, type=float, help="Seconds between snapshots")
+    p.add('--restore', action='store_true',
+        help="Start from --snapshot_file, if there is one, and the records of the --inputlogfile journal after it")
+    p.add('--book_log', default=None)
+    p.add('--mechanism', choices=['cda', 'fba', 'iex'], default = 'cda')
+    p.add('--interval', default = None, type=float, help="(FBA) Interval between batch auctions in seconds")
+    p.add('--delay', default = None, type=float, help="(IEX) 'speed bump' time that orders are delayed before being entered")
+    p.add('--book_backend', choices=['sparse', 'dense'], default = 'sparse',
+        help="Price ladder behind the book: sparse sorted levels, or a dense array over [min_price, max_price]")
+    p.add('--min_price', default = 0, type=int, help="(dense backend) lowest price held in the dense array")
+    p.add('--max_price', default = None, type=int, help="(dense backend) highest price held in the dense array")
+    p.add('--fba_engine', choices=['python', 'numpy'], default = 'python', help="(FBA) Batch clearing implementation")
+    p.add('--fba_shuffle_seed', default = None, type=int,
+        help="(FBA) Shuffle each batch once at its close from this seed, instead of placing orders at random on arrival")
+    p.add('--order_archive', default = None, type=str, help="File retired orders are appended to, one line each")
+    p.add('--transport', choices=['streams', 'buffered'], default = 'streams',
+        help="Read clients through asyncio streams, or through a BufferedProtocol framing each read in place")
+    p.add('--outbound_high_water', default = 1 << 20, type=int, help="Bytes buffered for a client before it is treated as a slow consumer")
+    p.add('--slow_consumer', choices=['conflate', 'drop', 'disconnect'], default = 'conflate',
+        help="Once a client is slow: keep only the latest market data of each kind, drop market data, or disconnect it; "
+        "under the first two it is disconnected once its unwritten replies reach the high water too")
+    p.add('--level_cache_size', default = 128, type=int, help="Emptied price levels kept per side for reuse, 0 to disable")
+    return p
+
+
+def parse_options(p):
+    options, args = p.parse_known_args()
+    if options.book_backend == 'dense' and options.max_price is None:
+        p.error('--max_price is required with --book_backend dense')
+    if options.mechanism == 'fba' and options.interval is None:
+        p.error('--mechanism fba needs --interval')
+    if options.fba_engine == 'numpy' and np is None:
+        p.error('--fba_engine numpy needs numpy, which is not installed')
+    return options
+
+
+def book_ladder(options):
+    if options.book_backend == 'dense':
+        return partial(DenseIndexedDefaultList, min_index = options.min_price, max_index = options.max_price)
+    return BisectIndexedDefaultList
+
+
+def open_journal(options, path, loop):
+    if path is None:
+        return None
+    return Journal(path, loop, segment_size = options.journal_segment_size,
+        commit_interval = options.journal_commit_interval if options.journal_commit_interval >= 0 else None)
+
+
+def build_exchange(options, loop, **kwargs):
+    '''
+    The exchange options ask for, on a new book; kwargs go to its constructor
+    '''
+    if options.mechanism == 'cda':        
+        book = CDABook(ladder = book_ladder(options), level_cache_size = options.level_cache_size)
+        return Exchange(order_book = book, loop = loop, **kwargs)
+    elif options.mechanism == 'fba':
+        if options.fba_engine == 'numpy':
+            batch_engine = NumpyBatchEngine()
+        else:
+            batch_engine = None
+        book = FBABook(ladder = book_ladder(options), level_cache_size = options.level_cache_size,
+                        batch_engine = batch_engine, shuffle_seed = options.fba_shuffle_seed)
+        return FBAExchange(order_book = book, loop = loop, interval = options.interval, **kwargs)
+    elif options.mechanism == 'iex':
+        book = IEXBook(ladder = book_ladder(options), level_cache_size = options.level_cache_size)
+        return IEXExchange(order_book = book, loop = loop, delay = options.delay, **kwargs)
 
 
 def main():
+    p = arg_parser()
+    options = parse_options(p)
     log.basicConfig(level=log.DEBUG if options.debug else log.INFO,
         format = "[%(asctime)s.%(msecs)03d] %(levelname)s [%(name)s.%(funcName)s:%(lineno)d] %(message)s",
         datefmt = '%H:%M:%S',
         filename = options.logfile)
 
     loop = asyncio.get_event_loop()
-    server = ProtocolMessageServer(OuchClientMessages)
+    server = ProtocolMessageServer(OuchClientMessages, transport = options.transport,
+        outbound_high_water = options.outbound_high_water, slow_consumer_policy = options.slow_consumer)
+    order_store = OrderStore(archive_path = options.order_archive)
+    journal = open_journal(options, options.inputlogfile, loop)
+    output_journal = open_journal(options, options.outputlogfile, loop)
   
-    if options.mechanism == 'cda':        
-        book = CDABook()
-        exchange = Exchange(order_book = book,
-                            order_reply = server.send_server_response,
-                            message_broadcast = server.broadcast_server_message,
-                            loop = loop)
-    elif options.mechanism == 'fba':
-        book = FBABook()
-        exchange = FBAExchange(order_book = book,
+    order_reply_batch = server.send_server_responses
+    message_broadcast_batch = server.broadcast_server_messages
+    if output_journal is not None:
+        recorder = OutputJournal(output_journal, order_reply_batch, message_broadcast_batch, nanoseconds_since_midnight)
+        order_reply_batch = recorder.order_reply_batch
+        message_broadcast_batch = recorder.message_broadcast_batch
+    exchange = build_exchange(options, loop,
                             order_reply = server.send_server_response,
+                            order_reply_batch = order_reply_batch,
                             message_broadcast = server.broadcast_server_message,
-                            loop = loop, 
-                            interval = options.interval)
+                            message_broadcast_batch = message_broadcast_batch,
+                            order_store = order_store,
+                            journal = journal)
+    if options.restore:
+        if options.snapshot_file is None and options.inputlogfile is None:
+            p.error('--restore needs --snapshot_file or --inputlogfile')
+        snapshot = None
+        if options.snapshot_file is not None and os.path.exists(options.snapshot_file):
+            snapshot = read_snapshot(options.snapshot_file)
+        count = loop.run_until_complete(warm_start(exchange, snapshot, options.inputlogfile, settle = options.delay or 0))
+        log.info('Restored %s and %d journaled messages after it', options.snapshot_file if snapshot else 'nothing', count)
+    if options.mechanism == 'fba':
         exchange.start()
-    elif options.mechanism == 'iex':
-        book = IEXBook()
-        exchange = IEXExchange(order_book = book,
-                            order_reply = server.send_server_response,
-                            message_broadcast = server.broadcast_server_message,
-                            loop = loop,
-                            delay = options.delay)
-    
-    server.register_listener(exchange.process_message)
+
+    server.register_batch_listener(exchange.enqueue_messages)
+    exchange.start_engine()
+    snapshotter = None
+    if options.snapshot_file is not None:
+        snapshotter = Snapshotter(exchange, options.snapshot_file, options.snapshot_interval, output_journal)
+        snapshotter.start()
     server.start(loop)
 
     try:
@@ -66,7 +153,16 @@ def main():
     except KeyboardInterrupt:
         loop.close()
     finally:
+        if snapshotter is not None:
+            snapshotter.close()
+        for each_journal in (journal, output_journal):
+            if each_journal is not None:
+                each_journal.close()
+        order_store.close()
         loop.close()
+    for task in (exchange.engine, getattr(exchange, 'batch_timer', None)):
+        if task is not None and task.done() and not task.cancelled() and task.exception() is not None:
+            sys.exit('The matching engine failed, see the log')
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,86 @@
+import sys
+import time
+import asyncio
+import logging as log
+from OuchServer.ouch_messages import OuchServerMessages
+from exchange.order_store import OrderStore
+from exchange.journal import read_journal, BROADCAST
+from exchange.replay import VirtualTimeLoop, InlineExecutor, ReplayClock, ReplayPostOffice, replay
+from exchange.snapshot import read_snapshot
+from run_exchange_server import arg_parser, parse_options, build_exchange
+
+
+def describe(client_token, data):
+    header_size = OuchServerMessages.get_message_class().get_header_class().size
+    message = OuchServerMessages.lookup_by_header_bytes(data[:header_size]).from_bytes(data)
+    return '{} to {}'.format(message, 'all' if client_token == BROADCAST else client_token)
+
+
+def main():
+    # the journals the server wrote: --inputlogfile is replayed and what is sent checked against --outputlogfile;
+    # with --restore, from --snapshot_file on
+    p = arg_parser()
+    p.add('--pace', choices=['max', 'recorded'], default='max',
+        help="Replay as fast as possible on a simulated clock, or wait out the recorded gaps between messages")
+    options = parse_options(p)
+    if options.inputlogfile is None:
+        p.error('--inputlogfile, the journal to replay, is required')
+    log.basicConfig(level=log.DEBUG if options.debug else log.INFO,
+        format = "[%(asctime)s.%(msecs)03d] %(levelname)s [%(name)s.%(funcName)s:%(lineno)d] %(message)s",
+        datefmt = '%H:%M:%S',
+        filename = options.logfile)
+
+    loop = VirtualTimeLoop() if options.pace == 'max' else asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    clock = ReplayClock(loop)
+    snapshot = None
+    if options.restore:
+        if options.snapshot_file is None:
+            p.error('--restore needs --snapshot_file')
+        snapshot = read_snapshot(options.snapshot_file)
+    (sequence, output_sequence) = (snapshot['sequence'], snapshot['output_sequence']) if snapshot else (0, 0)
+    post_office = ReplayPostOffice(read_journal(options.outputlogfile, after = output_sequence)
+        if options.outputlogfile is not None else None)
+    kwargs = {'clearing_executor': InlineExecutor()} if options.mechanism == 'fba' else {}
+    exchange = build_exchange(options, loop,
+                            order_reply = post_office.order_reply,
+                            order_reply_batch = post_office.order_reply_batch,
+                            message_broadcast = post_office.message_broadcast,
+                            message_broadcast_batch = post_office.message_broadcast_batch,
+                            order_store = OrderStore(),
+                            clock = clock,
+                            **kwargs)
+
+    async def run():
+        if snapshot is not None:
+            exchange.restore_state(snapshot['exchange'])
+        return await replay(exchange, read_journal(options.inputlogfile, after = sequence), clock,
+            tail = options.delay or 0, start = snapshot['timestamp'] if snapshot else None)
+
+    started = time.perf_counter()
+    count = loop.run_until_complete(run())
+    elapsed = time.perf_counter() - started
+    pending = asyncio.all_tasks(loop)
+    for task in pending:
+        task.cancel()
+    loop.run_until_complete(asyncio.gather(*pending, return_exceptions = True))
+    loop.close()
+    print('replayed {} messages in {:.3f} s, {:.0f} messages/s; {} sent'.format(
+        count, elapsed, count / elapsed if elapsed else 0, post_office.sent))
+
+    if options.outputlogfile is None:
+        return
+    if post_office.mismatch is not None:
+        (index, record, client_token, data) = post_office.mismatch
+        print('output differs at message {}: recorded {}, replayed {}'.format(index,
+            describe(record.client_token, record.data) if record is not None else 'nothing',
+            describe(client_token, data)))
+        sys.exit(1)
+    unsent = post_office.unsent()
+    if unsent:
+        print('output matches as far as it goes, but {} recorded messages were not sent'.format(unsent))
+        sys.exit(1)
+    print('output matches the recording')
+
+if __name__ == '__main__':
+    main()
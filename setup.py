@@ -3,10 +3,14 @@ from setuptools import setup, find_packages
 setup(
     name='OuchServer',
     version='0.0.1',
+    python_requires='>=3.8',
     install_requires=[
         'ConfigArgParse==0.13.0',
         'pytz==2017.3',
     ],
+    extras_require={
+        'numpy': ['numpy==1.24.4'],     # the optional FBA batch engine, --fba_engine numpy
+    },
     packages=find_packages(
         include=['OuchServer']
     ),